@@ -0,0 +1,64 @@
+""" Benchmark: deterministic metrics with per-metric Python loops vs. one pass over the utterance frame.
+
+Run from the repository root:  python benchmarks/bench_basic_metrics.py --transcripts 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "convospector"))
+import analyzer.conversation.basic as basic
+from synthetic_corpus import generate_transcripts
+
+
+def loop_metrics_all(transcripts, resultDF):
+    """ Reference: the seven metrics of computeBasicMetrics with one Python loop per metric (style of basic.py). """
+    basic.countTurnsInTranscripts(transcripts, resultDF, True)
+    basic.maxWordCountUserUtterances(transcripts, resultDF)
+    resultDF["userUtteranceCount"] = [sum(1 for u in t["conversation"]["utterances"] if u["role"] == "user") for t in transcripts]
+    resultDF["botUtteranceCount"] = [sum(1 for u in t["conversation"]["utterances"] if u["role"] != "user") for t in transcripts]
+    resultDF["totalWordCount"] = [sum(len(u["content"].split()) for u in t["conversation"]["utterances"]) for t in transcripts]
+    userWords = [[len(u["content"].split()) for u in t["conversation"]["utterances"] if u["role"] == "user"] for t in transcripts]
+    resultDF["meanUserWordCount"] = [sum(words) / len(words) if words else float("nan") for words in userWords]
+    resultDF["userBotUtteranceRatio"] = [user / bot if bot else float("nan") for user, bot in zip(resultDF["userUtteranceCount"], resultDF["botUtteranceCount"])]
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    print(f"{label:<45} {duration:8.3f}s")
+    return duration, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts", type=int, default=100000, help="number of synthetic transcripts")
+    parser.add_argument("--mean-utterances", type=int, default=8, help="mean number of utterances per transcript")
+    args = parser.parse_args()
+
+    transcripts = generate_transcripts(args.transcripts, mean_utterances=args.mean_utterances)
+    sessionIds = [transcript["conversation"]["sessionId"] for transcript in transcripts]
+    print(f"{len(transcripts)} transcripts, {sum(len(t['conversation']['utterances']) for t in transcripts)} utterances")
+
+    loopDF = pd.DataFrame({"sessionId": sessionIds})
+    timed("loops (turnCount, maxUserWordCount only)", lambda: (basic.countTurnsInTranscripts(transcripts, loopDF, True), basic.maxWordCountUserUtterances(transcripts, loopDF)))
+    loop_time, _ = timed("loops (all 7 metrics)", lambda: loop_metrics_all(transcripts, loopDF))
+
+    frameDF = pd.DataFrame({"sessionId": sessionIds})
+    frame_build_time, utterancesDF = timed("utterance frame (load once)", lambda: basic.transcripts_to_utterance_frame(transcripts))
+    metrics_time, _ = timed("vectorized metrics (all 7 metrics)", lambda: basic.computeBasicMetrics(utterancesDF, frameDF, True))
+
+    for column in ["turnCount", "maxUserWordCount", "userUtteranceCount", "botUtteranceCount", "totalWordCount"]:
+        assert (loopDF[column] == frameDF[column]).all(), column
+    for column in ["meanUserWordCount", "userBotUtteranceRatio"]:
+        assert ((loopDF[column] - frameDF[column]).abs().fillna(0) < 1e-9).all(), column
+    print(f"speedup for all 7 metrics: {loop_time / metrics_time:.1f}x for the metrics pass, "
+          f"{loop_time / (frame_build_time + metrics_time):.1f}x including building the frame")
+
+
+if __name__ == "__main__":
+    main()
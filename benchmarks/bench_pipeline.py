@@ -0,0 +1,202 @@
+""" Benchmark: complete analysis run (analysisLoop) against the local mock LLM server.
+
+Generates a synthetic corpus, runs the analysis pipeline (or the fused analyses) with the real
+OpenAI client against mock_llm_server and reports the throughput, the latency of the LLM calls
+(exact percentiles measured by the client) and the peak memory (RSS) while each stage was active.
+
+Run from the repository root:  python benchmarks/bench_pipeline.py --transcripts 2000 --latency-ms 300 --error-rate 0.02
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+CONVOSPECTOR_PATH = os.path.join(BENCHMARK_PATH, "..", "convospector")
+sys.path.insert(0, CONVOSPECTOR_PATH)
+
+from mock_llm_server import start_mock_server
+from synthetic_corpus import write_corpus
+
+# seconds between two samples of the memory usage
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss_bytes():
+    """ Return the resident set size of the process (Linux /proc, None elsewhere). """
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class StageMemorySampler:
+    """ Samples the RSS periodically and attributes it to all stages active at that moment. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_stages = {}     # name -> number of active calls
+        self.peak_rss = {}          # name -> peak RSS while the stage was active
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+
+    def _sample(self):
+        while not self.stop_event.wait(MEMORY_SAMPLE_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss_bytes()
+        if rss is None:
+            return
+        with self.lock:
+            for name, active in self.active_stages.items():
+                if active:
+                    self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+
+    @contextmanager
+    def track(self, name):
+        with self.lock:
+            self.active_stages[name] = self.active_stages.get(name, 0) + 1
+        self.sample()
+        try:
+            yield
+        finally:
+            self.sample()
+            with self.lock:
+                self.active_stages[name] -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts", type=int, default=1000, help="number of synthetic transcripts")
+    parser.add_argument("--mean-utterances", type=int, default=8, help="mean number of utterances per transcript")
+    parser.add_argument("--max-utterances", type=int, default=80, help="maximum number of utterances per transcript")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="median latency of the mock LLM")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the log-normal latency (tail)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of LLM requests failing with 429/500")
+    parser.add_argument("--refusal-rate", type=float, default=0.0, help="share of LLM requests refused")
+    parser.add_argument("--batch-size", type=int, default=50, help="transcripts per batch (analysisLoop.batch_size)")
+    parser.add_argument("--llm-workers", type=int, default=2, help="batches analyzed concurrently (analysisLoop.llm_stage_workers)")
+    parser.add_argument("--max-concurrent-requests", type=int, default=8, help="LLM requests in flight per batch")
+    parser.add_argument("--fused", action="store_true", help="apply all analyses with one combined request")
+    parser.add_argument("--dedup", action="store_true", help="analyze only one representative of (near-)identical conversations")
+    parser.add_argument("--report-format", default="parquet", choices=["parquet", "csv", "xlsx"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="also write the results to this JSON file (for regression comparisons)")
+    parser.add_argument("--keep", action="store_true", help="keep the corpus and result directory")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # mock server and client configuration (before the LLM client is created)
+    server, server_state = start_mock_server(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                                             error_rate=args.error_rate, refusal_rate=args.refusal_rate, seed=args.seed)
+    os.environ.pop("AZURE_OPENAI_API_KEY", None)
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["LLM_MAX_CONCURRENT_REQUESTS"] = str(args.max_concurrent_requests)
+
+    os.chdir(CONVOSPECTOR_PATH)  # the prompt files are referenced relative to the package
+    import analysisLoop
+    import analyzer.conversation.basic_llm
+    import run_metrics
+
+    work_path = tempfile.mkdtemp(prefix="convospector-bench-")
+    transcript_path = os.path.join(work_path, "transcripts")
+    result_path = os.path.join(work_path, "results")
+    os.makedirs(result_path)
+    start = time.perf_counter()
+    write_corpus(transcript_path, args.transcripts, args.mean_utterances, args.max_utterances, args.seed)
+    print(f"Generated {args.transcripts} transcripts in {time.perf_counter() - start:.1f}s ({work_path})")
+
+    analysisLoop.transcript_path = transcript_path
+    analysisLoop.result_path = result_path
+    analysisLoop.batch_size = args.batch_size
+    analysisLoop.llm_stage_workers = args.llm_workers
+    analysisLoop.fuse_llm_analyses = args.fused
+    analysisLoop.deduplicate_transcripts = args.dedup
+    analysisLoop.categories_file = None
+    analyzer.conversation.basic_llm.max_concurrent_requests = args.max_concurrent_requests
+
+    # instrumentation of the benchmark: exact client latencies and the memory per stage
+    latencies = []
+    observe_llm_call = run_metrics.observe_llm_call
+    def observe_and_record(seconds):
+        latencies.append(seconds)
+        observe_llm_call(seconds)
+    run_metrics.observe_llm_call = observe_and_record
+
+    memory_sampler = StageMemorySampler()
+    metrics_stage_timer = run_metrics.stage_timer
+    @contextmanager
+    def stage_timer(name):
+        with memory_sampler.track(name), metrics_stage_timer(name):
+            yield
+    run_metrics.stage_timer = stage_timer
+    memory_sampler.thread.start()
+
+    try:
+        start = time.perf_counter()
+        database_engine = analysisLoop.analyze_transcript_files(analysisLoop.compileTranscriptFileListInPath(transcript_path), result_path)
+        analysisLoop.create_final_report(database_engine, os.path.join(result_path, f"report.{args.report_format}"))
+        wall_seconds = time.perf_counter() - start
+        summary = run_metrics.run_metrics.summary(analysisLoop.llm_client.llm_scheduler.usage_statistics() if analysisLoop.llm_client.llm_scheduler else None)
+        database_engine.dispose()
+    finally:
+        memory_sampler.stop_event.set()
+        server.shutdown()
+
+    # results
+    results = {
+        "options": vars(args),
+        "wall_seconds": wall_seconds,
+        "transcripts_per_second": args.transcripts / wall_seconds,
+        "stages": {},
+        "llm_latency_seconds": {},
+        "errors": summary["errors"],
+        "tokens": summary["tokens"],
+        "mock_server": server_state.statistics,
+        "peak_rss_bytes": max(memory_sampler.peak_rss.values(), default=None),
+    }
+    for name, stage in summary["stages"].items():
+        results["stages"][name] = {
+            "calls": stage["calls"],
+            "seconds": stage["seconds"],
+            "transcripts_per_busy_second": args.transcripts / stage["seconds"] if stage["seconds"] > 0 else None,
+            "peak_rss_bytes": memory_sampler.peak_rss.get(name),
+        }
+    if latencies:
+        latency_array = np.array(latencies)
+        results["llm_latency_seconds"] = {"calls": len(latencies), "p50": float(np.percentile(latency_array, 50)), "p90": float(np.percentile(latency_array, 90)),
+                                          "p99": float(np.percentile(latency_array, 99)), "max": float(latency_array.max())}
+
+    print()
+    print(f"{args.transcripts} transcripts in {wall_seconds:.1f}s: {results['transcripts_per_second']:.1f} transcripts/s")
+    print(f"{'stage':<22} {'calls':>7} {'busy s':>9} {'transcripts/busy s':>19} {'peak RSS MB':>12}")
+    for name, stage in results["stages"].items():
+        throughput = f"{stage['transcripts_per_busy_second']:.1f}" if stage["transcripts_per_busy_second"] else "-"
+        peak_rss = f"{stage['peak_rss_bytes'] / 2**20:.0f}" if stage["peak_rss_bytes"] else "-"
+        print(f"{name:<22} {stage['calls']:>7} {stage['seconds']:>9.2f} {throughput:>19} {peak_rss:>12}")
+    if latencies:
+        latency = results["llm_latency_seconds"]
+        print(f"LLM calls: {latency['calls']}, latency p50 {latency['p50'] * 1000:.0f}ms, p90 {latency['p90'] * 1000:.0f}ms, p99 {latency['p99'] * 1000:.0f}ms, max {latency['max'] * 1000:.0f}ms")
+    print(f"Errors: {results['errors']}, mock server: {results['mock_server']}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.json}")
+    if not args.keep:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
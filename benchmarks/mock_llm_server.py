@@ -0,0 +1,254 @@
+""" Local mock of an OpenAI-compatible API for benchmarks (no API costs, reproducible).
+
+Serves POST /v1/responses (structured outputs via text.format json_schema) and
+POST /v1/chat/completions. Structured outputs are canned from the properties of the requested
+JSON schema (strings "mock <property>", first enum value, nested objects and $refs resolved), so
+the existing Pydantic schemas of the analyses - also the combined schema of fused analyses - parse.
+
+Latency, error rates (429 with retry-after-ms, 500) and refusals are configurable. Repeated
+system prompts of at least 1024 tokens are reported as cached input tokens, like the prompt
+caching of the service.
+
+Run standalone:  python benchmarks/mock_llm_server.py --port 8765 --latency-ms 400
+and point the client at it:  OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=mock
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+import uuid
+
+# minimum prompt prefix (tokens) served from the prompt cache and its granularity
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT_TOKENS = 128
+
+
+def estimate_tokens(text):
+    """ Rough token count (about four characters per token). """
+    return len(text) // 4 + 1
+
+
+def canned_value(schema, definitions, name="value"):
+    """ Return a canned value matching a JSON schema. """
+    if "$ref" in schema:
+        schema = definitions[schema["$ref"].split("/")[-1]]
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "anyOf" in schema:
+        return canned_value(schema["anyOf"][0], definitions, name)
+    schema_type = schema.get("type", "string")
+    if isinstance(schema_type, list):
+        schema_type = schema_type[0]
+    if schema_type == "object":
+        return {property_name: canned_value(property_schema, definitions, property_name) for property_name, property_schema in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [canned_value(schema.get("items", {}), definitions, name)]
+    if schema_type == "integer":
+        return 1
+    if schema_type == "number":
+        return 0.5
+    if schema_type == "boolean":
+        return True
+    return f"mock {name}"
+
+
+class MockLLMState:
+    """ Options and statistics of the mock server (shared by the handler threads). """
+
+    def __init__(self, latency_ms=300.0, latency_sigma=0.5, error_rate=0.0, rate_limit_share=0.7, refusal_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_share = rate_limit_share
+        self.refusal_rate = refusal_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cached_prefixes = set()
+        self.statistics = {"requests": 0, "rate_limited": 0, "server_errors": 0, "refusals": 0}
+
+    def draw(self):
+        """ Draw the latency (log-normal around latency_ms) and the outcome of a request. """
+        with self.lock:
+            self.statistics["requests"] += 1
+            latency = self.latency_ms / 1000 * self.random.lognormvariate(0, self.latency_sigma) if self.latency_ms > 0 else 0.0
+            if self.random.random() < self.error_rate:
+                outcome = "rate_limited" if self.random.random() < self.rate_limit_share else "server_errors"
+            elif self.random.random() < self.refusal_rate:
+                outcome = "refusals"
+            else:
+                outcome = "ok"
+            if outcome != "ok":
+                self.statistics[outcome] += 1
+        return latency, outcome
+
+    def cached_tokens(self, prefix):
+        """ Return the input tokens of the prefix served from the cache (the prefix is cached afterwards). """
+        prefix_tokens = estimate_tokens(prefix)
+        if prefix_tokens < CACHE_MIN_TOKENS:
+            return 0
+        with self.lock:
+            if prefix in self.cached_prefixes:
+                return prefix_tokens - prefix_tokens % CACHE_INCREMENT_TOKENS
+            self.cached_prefixes.add(prefix)
+        return 0
+
+
+def _messages_of(body):
+    """ Return (system prefix, complete input text) of a Responses or Chat Completions request. """
+    messages = body.get("input", body.get("messages", []))
+    if isinstance(messages, str):
+        return "", messages
+    texts = []
+    prefix = ""
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        if message.get("role") in ("system", "developer") and not texts:
+            prefix = content
+        texts.append(content)
+    return prefix, "".join(texts)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """ Request handler of the mock API. """
+    protocol_version = "HTTP/1.1"
+    state = None  # MockLLMState, set by start_mock_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/responses"):
+            response_builder = self._response
+        elif self.path.endswith("/chat/completions"):
+            response_builder = self._chat_completion
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+            return
+
+        latency, outcome = self.state.draw()
+        time.sleep(latency)
+        if outcome == "rate_limited":
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded"}}, {"retry-after-ms": "200"})
+        elif outcome == "server_errors":
+            self._send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+        else:
+            self._send_json(200, response_builder(body, refusal=(outcome == "refusals")))
+
+    def _usage(self, body, output_text):
+        prefix, input_text = _messages_of(body)
+        input_tokens = estimate_tokens(input_text)
+        return input_tokens, self.state.cached_tokens(prefix), estimate_tokens(output_text)
+
+    def _response(self, body, refusal=False):
+        """ Responses API: canned structured output for text.format json_schema, otherwise a canned text. """
+        text_format = body.get("text", {}).get("format", {})
+        if text_format.get("type") == "json_schema":
+            schema = text_format.get("schema", {})
+            output_text = json.dumps(canned_value(schema, schema.get("$defs", {})))
+        else:
+            output_text = "mock answer"
+        content = {"type": "refusal", "refusal": "I cannot help with that (mock)."} if refusal else {"type": "output_text", "text": output_text, "annotations": []}
+        input_tokens, cached_tokens, output_tokens = self._usage(body, output_text)
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "mock"),
+            "status": "completed",
+            "output": [{"type": "message", "id": f"msg_{uuid.uuid4().hex}", "role": "assistant", "status": "completed", "content": [content]}],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": cached_tokens},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    def _chat_completion(self, body, refusal=False):
+        """ Chat Completions API: canned structured output for response_format json_schema, otherwise a canned text. """
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format.get("json_schema", {}).get("schema", {})
+            output_text = json.dumps(canned_value(schema, schema.get("$defs", {})))
+        else:
+            output_text = "mock answer"
+        input_tokens, cached_tokens, output_tokens = self._usage(body, output_text)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": None if refusal else output_text, "refusal": "I cannot help with that (mock)." if refusal else None},
+            }],
+            "usage": {
+                "prompt_tokens": input_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+
+def start_mock_server(host="127.0.0.1", port=0, **options):
+    """
+    Start the mock server in a background thread.
+
+    Args:
+        port (int): Port to listen on (0 = any free port).
+        options: Options of MockLLMState (latency_ms, latency_sigma, error_rate, rate_limit_share, refusal_rate, seed).
+    Returns:
+        (server, state): The running server (server.server_address, server.shutdown()) and its statistics.
+    """
+    state = MockLLMState(**options)
+    handler = type("BoundMockLLMHandler", (MockLLMHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-llm-server", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="median latency of a request")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the log-normal latency distribution (tail)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 429 or 500")
+    parser.add_argument("--refusal-rate", type=float, default=0.0, help="share of requests answered with a refusal")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server, state = start_mock_server(args.host, args.port, latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                                      error_rate=args.error_rate, refusal_rate=args.refusal_rate, seed=args.seed)
+    print(f"Mock LLM server listening on http://{args.host}:{server.server_address[1]}/v1 (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"Statistics: {state.statistics}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+""" Generator for synthetic transcript corpora (same JSON structure as the exported transcripts). """
+import json
+import os
+import random
+
+USER_PHRASES = ["hello", "I want to report my meter reading", "my bill is too high", "change my address",
+                "when is the next payment due", "contract", "I did not get an answer", "agent please",
+                "thank you", "no", "yes", "how do I cancel my contract", "the app does not work"]
+BOT_PHRASES = ["Hello, how can I help you?", "I did not understand you. Could you rephrase your question?",
+               "You can report your meter reading in the customer portal.", "I will forward you to a human agent.",
+               "Is there anything else I can help you with?", "Please enter your customer number."]
+
+
+def generate_transcript(index, rng, mean_utterances=8, max_utterances=80):
+    """ Generate one synthetic transcript with a geometric-like distribution of the conversation length. """
+    utterance_count = min(max_utterances, max(1, int(rng.expovariate(1 / mean_utterances)) + 1))
+    utterances = []
+    for position in range(utterance_count):
+        # conversations start with the bot, users sometimes send several messages in a row
+        role = "bot" if position == 0 or (utterances[-1]["role"] == "user" and rng.random() < 0.8) else "user"
+        phrases = BOT_PHRASES if role == "bot" else USER_PHRASES
+        content = " ".join(rng.choice(phrases) for _ in range(rng.randint(1, 2)))
+        utterances.append({"role": role, "content": content})
+    return {"conversation": {"sessionId": f"synthetic-{index:08d}", "utterances": utterances}}
+
+
+def generate_transcripts(count, mean_utterances=8, max_utterances=80, seed=42):
+    """ Generate a list of synthetic transcripts (reproducible for the same seed). """
+    rng = random.Random(seed)
+    return [generate_transcript(index, rng, mean_utterances, max_utterances) for index in range(count)]
+
+
+def write_corpus(path, count, mean_utterances=8, max_utterances=80, seed=42):
+    """ Write a synthetic corpus as one JSON file per transcript (named after the sessionId). Returns the file paths. """
+    os.makedirs(path, exist_ok=True)
+    rng = random.Random(seed)
+    file_paths = []
+    for index in range(count):
+        transcript = generate_transcript(index, rng, mean_utterances, max_utterances)
+        file_path = os.path.join(path, transcript["conversation"]["sessionId"] + ".json")
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(transcript, file, ensure_ascii=False)
+        file_paths.append(file_path)
+    return file_paths
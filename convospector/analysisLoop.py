@@ -1,59 +1,72 @@
 """ Main Module for Transcript Analysis
 """
 from datetime import datetime
-import json
+import multiprocessing
 import os
+import uuid
 import pandas as pd
 from sqlalchemy import create_engine
 
 import analyzer.conversation.basic
 import analyzer.conversation.basic_llm
+import analyzer.conversation.dedup
+import filter
+import llm_batch
+import llm_cache
 import llm_client
+import local_model
+from pipeline import PipelineStage, run_pipeline
+import progress
+import provenance
+import report
+import result_store
+import run_metrics
+import sharding
+import transcript_sources
 
 # global options (to be paramters for the CLI)
 result_path = "../results"
 transcript_path = "../transcripts"
 batch_size = 5  # Number of transcript files to process in one batch
-
-
-def readTranscriptFile(filePath):
-    """ Reads a transcript file and returns its content as a JSON object. """
-
-    # Read the JSON file
-    with open(filePath, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    
-    # Validate the JSON structure
-    if not isinstance(data, dict) or "conversation" not in data or "utterances" not in data["conversation"] or not isinstance(data["conversation"]["utterances"], list) or "sessionId" not in data["conversation"]:
-        raise ValueError("Invalid JSON structure in the transcript file.")
-
-    return data
-
-
-def read_list_of_transcript_files(transcript_filenames):
-    """ Reads multiple transcript files and returns their content as a list of JSON objects. """
-    transcripts = []
-    for filename in transcript_filenames:
-        try:
-            transcript = readTranscriptFile(filename)
-            transcripts.append(transcript)
-        except Exception as e:
-            print(f"Error reading transcript file {filename}: {e}")
-    
-    return transcripts
+fuse_llm_analyses = False  # Apply all LLM analyses with one combined request per transcript
+deduplicate_transcripts = False  # Apply the LLM analyses only to one representative of (near-)identical conversations
+dedup_max_distance = 3  # Maximum number of differing SimHash bits of near-identical conversations
+incremental_reanalysis = True  # Only recompute the LLM analyses of a transcript whose prompt, template data, schema, request settings, model or transcript changed (see provenance)
+pipeline_queue_size = 2  # Number of batches waiting in front of each stage of the analysis pipeline
+llm_stage_workers = 2  # Number of batches analyzed by the LLM at the same time
+use_batch_api = False  # Submit the LLM analyses as offline jobs to the Batch API instead of calling the LLM per transcript
+batch_api_files_per_job = 10000  # Number of transcript files in one Batch API job
+batch_api_poll_interval = 60  # Seconds between two status checks of a Batch API job
+categories_file = "../category_list-energy dso.json"
+local_first_pass_model = os.getenv("CONVOSPECTOR_FIRST_PASS_MODEL")  # Local zero-shot model pre-classifying the topic over the category list, only uncertain transcripts are sent to the LLM (None = LLM only; separate online analyses only)
+local_first_pass_runtime = os.getenv("CONVOSPECTOR_FIRST_PASS_RUNTIME", "pytorch")  # Runtime of the local model: pytorch or onnx
+local_first_pass_confidence = 0.9  # Minimum confidence of a local prediction used without the LLM
+num_shards = int(os.getenv("CONVOSPECTOR_NUM_SHARDS", "1"))  # Number of shards (worker processes) the transcript files are partitioned into
+shard_index = os.getenv("CONVOSPECTOR_SHARD_INDEX")  # Only process this shard (e.g. one shard per machine), None = all shards with local processes
+report_format = "xlsx"  # Format of the final report: xlsx (split across sheets), parquet or csv
+report_exclude_columns = []  # Columns left out of the final report (e.g. ["transcript"])
+report_analyses = None  # Names of the LLM analyses included in the final report, None = all
+metrics_prometheus_textfile = os.getenv("CONVOSPECTOR_PROMETHEUS_TEXTFILE")  # Write the run metrics also to this Prometheus textfile (None = only the JSON run summary)
+profile_path = os.getenv("CONVOSPECTOR_PROFILE_PATH")  # Profile the stages with cProfile and save the stats in this directory (None = no profiling)
+sqlite_journal_mode = os.getenv("CONVOSPECTOR_SQLITE_JOURNAL_MODE", "WAL")  # Journal mode of the result databases (DELETE for file systems without shared memory support)
 
 
 def compileTranscriptFileListInPath(path):
-    """ Compile a list of transcript files in the given path. """
+    """ 
+    Compile a list of transcript files in the given path: JSON files with one conversation 
+    and JSONL/NDJSON dumps (optionally gzip-compressed). The path may also be a single dump.
+    """
     # Check if the path exists
     if not os.path.exists(path):
         raise FileNotFoundError(f"The path {path} does not exist.")
+    if os.path.isfile(path):
+        return [path]
 
     # Iterate through all files in the directory
     transcript_files = []
     with os.scandir(path) as iterator:
         for entry in iterator:
-            if entry.name.endswith('.json') and entry.is_file():
+            if transcript_sources.is_transcript_file(entry.name) and entry.is_file():
                 transcript_files.append(entry.path)
 
     print(f"Found {len(transcript_files)} transcript files in {path}.")
@@ -68,6 +81,7 @@ def initGlobalResultPersistence(path):
     # Initialize SQLite database in path
     database_file = os.path.join(path, "results.db")
     engine = create_engine(f'sqlite:///{database_file}')
+    result_store.enable_write_ahead_log(engine, journal_mode=sqlite_journal_mode)
     return engine
 
 
@@ -86,99 +100,423 @@ def initResultDataFrameFromTranscripts(transcripts):
     return df
 
 
-def readProcessedFiles(file_path):
-    """ Read the list of already processed files from a log file. """
-    if not os.path.exists(file_path):
-        print(f"Processed files log {file_path} does not exist. Starting fresh.")
-        open(file_path, 'w').close()
-        return []
-    
-    with open(file_path, 'r', encoding='utf-8') as file:
-        processed_files = [line.strip() for line in file.readlines()]
-    
-    return processed_files
-
-
-def create_final_report(database_engine, output_path):
+def persistBatchResults(database_engine, resultDF, progress_records, columns=None, column_groups=None, provenance_records=None):
+    """ 
+    Upsert the results of a batch into the database and record the progress of its files
+    (and the provenance of the LLM results). All are committed in one transaction.
+    Only the given columns (default: all) of existing rows are updated, with column groups
+    (list of row positions and their columns) each group of rows only updates its own columns.
     """
-    Read all results from database and create a final Excel report.
-
-    Args:
-        database_engine: SQLAlchemy database engine
-        output_path: Path where the Excel report should be saved
+    with database_engine.begin() as connection:
+        if column_groups is None:
+            upserted_rows = result_store.upsert_results(connection, resultDF, columns=columns)
+        else:
+            upserted_rows = sum(result_store.upsert_results(connection, resultDF.iloc[positions], columns=group_columns) for positions, group_columns in column_groups)
+        provenance.record_provenance(connection, provenance_records)
+        progress.mark_processed(connection, progress_records)
+    print(f"Upserted {upserted_rows} records in the database.")
+
+
+def read_batch_stage(records, database_engine, provenance_tracker=None):
+    """ 
+    Pipeline stage: Parse and validate the transcript records of a batch (see transcript_sources). 
+    Conversations of dumps which have already been processed are skipped (unless they have failed
+    results to retry). With a provenance tracker, the stale analyses of each transcript are selected
+    as well. When processed transcripts are read again (stale analyses), those without stale
+    analyses are skipped.
     """
-    with database_engine.connect() as connection:
-        complete_resultsDF = pd.read_sql('transcripts', con=connection)
-        complete_resultsDF.to_excel(output_path, index=False)
-        print(f"Final report saved to {output_path}")
+    with run_metrics.stage_timer("read"):
+        reread_processed = provenance_tracker is not None and provenance_tracker.reread_processed
+        retry_sources = provenance_tracker.retry_sources if provenance_tracker is not None else set()
+        pending_records = None
+        if reread_processed:
+            pending_records = {id(record) for record in progress.filter_processed_records(database_engine, records)}
+        else:
+            dump_records = [record for record in records if record["from_dump"]]
+            if dump_records:
+                pending_dump_records = {id(record) for record in progress.filter_processed_records(database_engine, dump_records)}
+                records = [record for record in records if not record["from_dump"] or id(record) in pending_dump_records or record["path"] in retry_sources]
+
+        transcript_records = []
+        transcripts = []
+        invalid_records = []
+        for record in records:
+            try:
+                transcripts.append(transcript_sources.parse_transcript(record["raw"]))
+                transcript_records.append(record)
+            except Exception as e:
+                print(f"Error reading transcript {record['path']}: {e}")
+                invalid_records.append(record)
+
+        batch = {}
+        if provenance_tracker is not None:
+            stale, transcript_hashes = provenance_tracker.stale_analyses(transcripts)
+            if pending_records is not None:
+                # processed transcripts are only analyzed again for their stale analyses
+                keep = [position for position, record in enumerate(transcript_records) if stale[position] or id(record) in pending_records]
+                provenance_tracker.statistics["unchanged_transcripts"] += len(transcripts) - len(keep)
+                transcript_records = [transcript_records[position] for position in keep]
+                transcripts = [transcripts[position] for position in keep]
+                stale = [stale[position] for position in keep]
+                transcript_hashes = [transcript_hashes[position] for position in keep]
+            batch["stale"] = stale
+            batch["transcript_hashes"] = transcript_hashes
+            batch["sources"] = [record["path"] for record in transcript_records]
+
+        progress_records = [progress.progress_record(record, progress.STATUS_DONE) for record in transcript_records]
+        progress_records += [progress.progress_record(record, progress.STATUS_INVALID) for record in invalid_records]
+
+    batch.update({"filenames": [record["path"] for record in transcript_records + invalid_records], "transcripts": transcripts, "progress": progress_records})
+    return batch
+
+
+def basic_analysis_stage(batch, duplicate_index=None, llm_analyses=()):
+    """ 
+    Pipeline stage: Initialize the result DataFrame of a batch with the deterministic metrics.
+    With a duplicate index, the representatives of (near-)identical conversations are assigned as well.
+    """
+    transcripts = batch["transcripts"]
+    with run_metrics.stage_timer("basic"):
+        resultDF = initResultDataFrameFromTranscripts(transcripts)
 
+        # Basic global analysis (turn counts, word counts, utterance ratios) in one pass over the utterances
+        utterancesDF = analyzer.conversation.basic.transcripts_to_utterance_frame(transcripts)
+        analyzer.conversation.basic.computeBasicMetrics(utterancesDF, resultDF, True)
+        run_metrics.add_conversation_lengths(resultDF["userUtteranceCount"] + resultDF["botUtteranceCount"], resultDF["totalWordCount"])
 
-if(__name__ == "__main__"):
-    # 
-    # Main analysis loop
-    #
+    if duplicate_index is not None:
+        with run_metrics.stage_timer("dedup"):
+            analyzer.conversation.dedup.assign_representatives(duplicate_index, transcripts, resultDF, llm_analyses)
+    # analyzer.conversation.basic.addLocalPath(transcripts, resultDF)
 
-    # Compile the list of transcript files in the given path not processed yet 
-    allTranscriptFilesInPath = compileTranscriptFileListInPath(transcript_path)
-    alreadyProcessedFiles = readProcessedFiles(os.path.join(result_path, "processedFiles.log"))
-    transcriptFilesToProcess = list(set(allTranscriptFilesInPath) - set(alreadyProcessedFiles))
-    print(f"{len(transcriptFilesToProcess)} transcript files still to process.")
+    batch["resultDF"] = resultDF
+    return batch
 
-    database_engine = initGlobalResultPersistence(result_path)
 
-    #
-    # Analysis loop: Process batches of transcript files
-    #
-    while (transcriptFilesToProcess):
-        nextBatchOfTranscriptFilenames = transcriptFilesToProcess[:batch_size]  # Adjust the batch size as needed
-        
-        # read transcript files from the given path
-        transcripts = read_list_of_transcript_files(nextBatchOfTranscriptFilenames)
+def apply_llm_analyses(transcripts, resultDF, llm_analyses):
+    """
+    Apply the LLM analyses (separately or fused) to the transcripts.
+    The filters of each analysis are evaluated once for the batch, right before the analysis,
+    so filters on the results of an earlier analysis see these results.
+    """
+    llm_api_client = llm_client.get_llm_client()
+    if fuse_llm_analyses:
+        with run_metrics.stage_timer("llm:fused"):
+            analyzer.conversation.basic_llm.run_fused_llm_analyses(llm_api_client, transcripts, resultDF, llm_analyses)
+    else:
+        for llm_analysis in llm_analyses:
+            with run_metrics.stage_timer(f"llm:{llm_analysis.name}"):
+                relevant = filter.relevance_mask(resultDF, transcripts, llm_analysis.filters)
+                analyzer.conversation.basic_llm.run_llm_analysis(llm_api_client, transcripts, resultDF, llm_analysis, relevant=relevant)
+
+
+def run_llm_analyses(transcripts, resultDF, llm_analyses, apply, duplicate_index=None, stale=None):
+    """
+    Apply the LLM analyses to the transcripts with apply(transcripts, resultDF, analyses): only to
+    the representatives with a duplicate index and only the stale analyses of each transcript
+    (see provenance) if given. Transcripts with the same stale analyses are analyzed together.
+    """
+    if stale is None:
+        groups = {tuple(analysis.name for analysis in llm_analyses): list(range(len(transcripts)))}
+    else:
+        groups = {}
+        for position, stale_names in enumerate(stale):
+            if stale_names:
+                groups.setdefault(stale_names, []).append(position)
+
+    for stale_names, positions in groups.items():
+        group_analyses = [analysis for analysis in llm_analyses if analysis.name in stale_names]
+        group_transcripts = [transcripts[position] for position in positions]
+        groupDF = resultDF if len(positions) == len(transcripts) else resultDF.iloc[positions].reset_index(drop=True)
+
+        if duplicate_index is not None:
+            analyzer.conversation.dedup.run_deduplicated(duplicate_index, group_transcripts, groupDF, group_analyses,
+                                                         lambda analyzed_transcripts, analyzedDF: apply(analyzed_transcripts, analyzedDF, group_analyses))
+        else:
+            apply(group_transcripts, groupDF, group_analyses)
+
+        if groupDF is not resultDF:
+            # copy the results of the group into the result DataFrame of the batch
+            columns = [column for analysis in group_analyses for column in analysis.output_columns()]
+            if duplicate_index is not None:
+                columns.append(analyzer.conversation.dedup.DUPLICATE_OF_COLUMN)
+            for column in columns:
+                if column not in resultDF.columns:
+                    resultDF[column] = None
+                resultDF[column] = resultDF[column].astype(object)
+                resultDF.loc[resultDF.index[positions], column] = groupDF[column].to_numpy(dtype=object)
+
+
+def llm_analysis_stage(batch, llm_analyses, duplicate_index=None):
+    """ 
+    Pipeline stage: Apply the LLM analyses to the transcripts of a batch (only to the representatives 
+    with a duplicate index, only the stale analyses with provenance tracking). 
+    """
+    transcripts = batch["transcripts"]
+    resultDF = batch["resultDF"]
 
-        # initialize result DataFrame
-        resultDF = initResultDataFrameFromTranscripts(transcripts)
+    run_llm_analyses(transcripts, resultDF, llm_analyses, apply_llm_analyses, duplicate_index, batch.get("stale"))
 
-        # Basic global analysis
-        analyzer.conversation.basic.countTurnsInTranscripts(transcripts, resultDF, True)
-        analyzer.conversation.basic.maxWordCountUserUtterances(transcripts, resultDF)
-        # analyzer.conversation.basic.addLocalPath(transcripts, globalResultDF)
-
-        # apply LLM prompt analysis
-        llm_api_client = llm_client.get_llm_client()
-        # LLM : Categorization (closed categories)
-        analyzer.conversation.basic_llm.categorize_transcripts(llm_api_client, transcripts, resultDF, categories_file="../category_list-energy dso.json")
-        # LLM : Categorization (open categories)
-        # analyzer.conversation.basic_llm.categorize_transcripts(llm_api_client, transcripts, globalResultDF)
-        # LLM : Sentiment Analysis
-        analyzer.conversation.basic_llm.assess_sentiment(llm_api_client, transcripts, resultDF)
+    # finally, add the transcript content to the result DataFrame
+    analyzer.conversation.basic.addTranscriptsToResult(transcripts, resultDF)
+    return batch
 
+
+def stale_column_groups(resultDF, llm_analyses, stale):
+    """
+    Return the column groups of a batch with provenance tracking (see persistBatchResults): the
+    deterministic metrics and the transcript for all rows, the result columns (and duplicateOf)
+    only of the analyses recomputed for a row.
+    """
+    duplicate_of = analyzer.conversation.dedup.DUPLICATE_OF_COLUMN
+    base_columns = [column for column in resultDF.columns if column in result_store.BASE_COLUMNS or column in result_store.TRAILING_COLUMNS]
+    groups = {}
+    for position, stale_names in enumerate(stale):
+        groups.setdefault(stale_names, []).append(position)
+
+    column_groups = []
+    for stale_names, positions in groups.items():
+        columns = list(base_columns)
+        if stale_names and duplicate_of in resultDF.columns:
+            columns.append(duplicate_of)
+        columns += [column for analysis in llm_analyses if analysis.name in stale_names for column in analysis.output_columns()]
+        column_groups.append((positions, columns))
+    return column_groups
+
+
+def persist_batch(batch, database_engine, llm_analyses=(), provenance_tracker=None):
+    """ Persist the results of a batch (with provenance tracking only the recomputed result columns). """
+    with run_metrics.stage_timer("persist"):
+        if provenance_tracker is not None:
+            persistBatchResults(database_engine, batch["resultDF"], batch["progress"],
+                                column_groups=stale_column_groups(batch["resultDF"], llm_analyses, batch["stale"]),
+                                provenance_records=provenance_tracker.provenance_records(batch["resultDF"], batch["stale"], batch["transcript_hashes"], batch["sources"]))
+        else:
+            persistBatchResults(database_engine, batch["resultDF"], batch["progress"])
+    run_metrics.add_transcripts(len(batch["transcripts"]))
+
+
+def persistence_stage(batch, database_engine, llm_analyses=(), provenance_tracker=None):
+    """ Pipeline stage: Persist the results of a batch. """
+    persist_batch(batch, database_engine, llm_analyses, provenance_tracker)
+    print(f"Processed {len(batch['filenames'])} transcript files: {batch['filenames']}")
+
+
+def run_analysis_pipeline(transcript_records, database_engine, llm_analyses, duplicate_index=None, provenance_tracker=None):
+    """ 
+    Analyze the transcript records (streamed from a source) in batches with a pipeline of stages 
+    (reading, basic metrics, LLM analyses, persistence) connected by bounded queues. 
+    """
+    batches = transcript_sources.iter_batches(transcript_records, batch_size)
+    run_pipeline(batches, [
+        PipelineStage("read", lambda records: read_batch_stage(records, database_engine, provenance_tracker)),
+        PipelineStage("basic", lambda batch: basic_analysis_stage(batch, duplicate_index, llm_analyses)),
+        PipelineStage("llm", lambda batch: llm_analysis_stage(batch, llm_analyses, duplicate_index), workers=llm_stage_workers),
+        PipelineStage("persist", lambda batch: persistence_stage(batch, database_engine, llm_analyses, provenance_tracker)),
+    ], queue_size=pipeline_queue_size)
+
+
+def process_batch_api_job(database_engine, transcript_records, llm_analyses, batch_backend, worker_result_path, duplicate_index=None, provenance_tracker=None):
+    """ Analyze the transcript records with one Batch API job and persist the results. """
+    batch = basic_analysis_stage(read_batch_stage(transcript_records, database_engine, provenance_tracker), duplicate_index, llm_analyses)
+    transcripts = batch["transcripts"]
+    resultDF = batch["resultDF"]
+
+    # LLM analyses: write the requests of all stale (transcript, analysis) pairs into one batch file,
+    # submit it and wait for the results. The same groups are then analyzed again with the results.
+    job_name = f"batch-{datetime.now().strftime('%Y%m%d_%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    requests_file = os.path.join(worker_result_path, f"{job_name}.jsonl")
+    job_masks = {}
+    request_count = 0
+
+    def job_key(job_transcripts, job_analyses):
+        return (tuple(transcript["conversation"]["sessionId"] for transcript in job_transcripts), tuple(analysis.name for analysis in job_analyses))
+
+    def write_batch_api_requests(job_transcripts, jobDF, job_analyses):
+        nonlocal request_count
+        relevant = llm_batch.relevance_masks(job_transcripts, jobDF, job_analyses)
+        job_masks[job_key(job_transcripts, job_analyses)] = relevant
+        request_count += llm_batch.write_batch_requests(job_transcripts, jobDF, job_analyses, requests_file, relevant=relevant, append=True)
+        # placeholders until the results are available
+        llm_batch.apply_batch_results(job_transcripts, jobDF, job_analyses, {}, relevant=relevant)
+
+    batch_results = {}
+    with run_metrics.stage_timer("llm:batch_api"):
+        open(requests_file, 'w').close()
+        run_llm_analyses(transcripts, resultDF, llm_analyses, write_batch_api_requests, duplicate_index, batch.get("stale"))
+        if request_count > 0:
+            results_file = llm_batch.run_batch(batch_backend, requests_file, os.path.join(worker_result_path, f"{job_name}.results.jsonl"), poll_interval=batch_api_poll_interval)
+            batch_results = llm_batch.parse_batch_results(results_file, llm_analyses)
+        else:
+            os.remove(requests_file)
+
+    def apply_batch_api_results(job_transcripts, jobDF, job_analyses):
+        llm_batch.apply_batch_results(job_transcripts, jobDF, job_analyses, batch_results, relevant=job_masks[job_key(job_transcripts, job_analyses)])
+
+    run_llm_analyses(transcripts, resultDF, llm_analyses, apply_batch_api_results, duplicate_index, batch.get("stale"))
+
+    analyzer.conversation.basic.addTranscriptsToResult(transcripts, resultDF)
+    persist_batch(batch, database_engine, llm_analyses, provenance_tracker)
+
+
+def get_llm_analyses():
+    """ Return the LLM analyses to apply to each transcript. """
+    categorization = analyzer.conversation.basic_llm.get_categorization_analysis(categories_file=categories_file)
+    if local_first_pass_model and categorization.data and categorization.source_column and not fuse_llm_analyses and not use_batch_api:
+        # Local first pass: topics of the category list predicted with confidence are not sent to the LLM
+        # (their intent and breakdown stay "No analysis", the column topicSource records the source of the topic)
+        classifier = local_model.get_local_classifier(local_first_pass_model, local_model.category_labels(categorization.data["category_list"]), runtime=local_first_pass_runtime)
+        categorization.first_pass = local_model.FirstPass(classifier, "topic", confidence_threshold=local_first_pass_confidence)
+    return [
+        # LLM : Categorization (closed categories, open categories without categories_file)
+        categorization,
+        # LLM : Sentiment Analysis
+        analyzer.conversation.basic_llm.get_sentiment_analysis(),
         # experimental LLM prompt analysis
         #analyzer.conversation.basic_llm.apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, "first-utterance-classifier-prompt.txt", resultColumns={"Opening Action": "Opening Action", "Request Category": "Request Category", "Ambiguity": "Ambiguity"}, filters=[filter.filter_no_user_utterance])
+    ]
+
 
-        # finally, add the transcript content to the global result DataFrame
-        analyzer.conversation.basic.addTranscriptsToResult(transcripts, resultDF)
+def analyze_transcript_files(transcript_files, worker_result_path):
+    """ 
+    Analyze the transcript files not processed yet and persist the results in the given result path.
 
-        # Append the batch results to the database
-        with database_engine.connect() as connection:
-            resultDF.to_sql('transcripts', con=connection, if_exists='append', index=False)
-            connection.commit()
-            print(f"Appended {len(resultDF)} records to the database.")
-        
-        # Save the processed files to the log file
-        with open(os.path.join(result_path, "processedFiles.log"), 'a', encoding='utf-8') as file:
-            for filename in nextBatchOfTranscriptFilenames:
-                file.write(f"{filename}\n") 
+    Returns:
+        SQLAlchemy engine of the result database.
+    """
+    run_metrics.reset_run_metrics(profile_path=profile_path)
+    database_engine = initGlobalResultPersistence(worker_result_path)
+    llm_analyses = get_llm_analyses()
+    result_store.init_result_table(database_engine, llm_analyses, deduplicate=deduplicate_transcripts)
+
+    # Select the files not processed yet (or changed since) from the progress table,
+    # the conversations of JSONL dumps are checked batch by batch while streaming
+    progress.init_progress_tracking(database_engine, legacy_log_file=os.path.join(worker_result_path, "processedFiles.log"))
+    dump_files = [transcript_file for transcript_file in transcript_files if transcript_sources.is_jsonl_file(transcript_file)]
+    single_files = [transcript_file for transcript_file in transcript_files if not transcript_sources.is_jsonl_file(transcript_file)]
+    transcriptFilesToProcess = progress.select_pending_files(database_engine, single_files)
+    print(f"{len(transcriptFilesToProcess)} transcript files and {len(dump_files)} transcript dumps still to process.")
+
+    # Incremental re-analysis: stale analyses of processed transcripts are recomputed as well
+    # (the Batch API applies the analyses separately)
+    fused = fuse_llm_analyses and not use_batch_api
+    provenance_tracker = provenance.ProvenanceTracker(database_engine, llm_analyses, llm_client.llm_model, fused=fused) if incremental_reanalysis else None
+    if provenance_tracker is not None and provenance_tracker.reread_processed:
+        print(f"Results of the analyses {provenance_tracker.stale_analysis_names} are not up to date, reading the processed transcripts again.")
+        transcriptFilesToProcess = single_files
+    elif provenance_tracker is not None and provenance_tracker.retry_sources:
+        # only the transcript files with failed results are read again
+        pending_files = set(transcriptFilesToProcess)
+        retry_files = [transcript_file for transcript_file in single_files if transcript_file in provenance_tracker.retry_sources and transcript_file not in pending_files]
+        print(f"Retrying the failed results of {len(retry_files)} processed transcript files.")
+        transcriptFilesToProcess = transcriptFilesToProcess + retry_files
+    transcript_records = transcript_sources.iter_transcript_records(transcriptFilesToProcess + dump_files)
+
+    llm_cache.init_llm_cache(worker_result_path)
+    duplicate_index = analyzer.conversation.dedup.DuplicateIndex(dedup_max_distance) if deduplicate_transcripts else None
+
+    if use_batch_api:
+        # Offline analysis: Submit the LLM analyses as Batch API jobs
+        batch_backend = llm_batch.OpenAIBatchBackend(llm_client.get_llm_client())
+        for job_records in transcript_sources.iter_batches(transcript_records, batch_api_files_per_job):
+            process_batch_api_job(database_engine, job_records, llm_analyses, batch_backend, worker_result_path, duplicate_index, provenance_tracker)
+    else:
+        # Analysis loop: Process batches of transcript files in a pipeline
+        run_analysis_pipeline(transcript_records, database_engine, llm_analyses, duplicate_index, provenance_tracker)
+
+    if provenance_tracker is not None and provenance_tracker.reread_processed:
+        # stale results not found among the transcripts read again do not cause later runs to read them again
+        orphaned = provenance_tracker.mark_orphaned_results()
+        if orphaned:
+            print(f"Marked {orphaned} stale results of transcripts no longer found as orphaned.")
+
+    if duplicate_index is not None:
+        print(f"Deduplication: {duplicate_index.statistics}")
+    if provenance_tracker is not None:
+        print(f"Incremental re-analysis (transcript/analysis pairs): {provenance_tracker.statistics}")
+
+    for llm_analysis in llm_analyses:
+        if llm_analysis.first_pass is not None:
+            print(f"First pass of {llm_analysis.name}: {llm_analysis.first_pass.statistics}")
+    llm_cache.report_cache_statistics()
+    llm_client.report_token_usage()
+    return database_engine
+
+
+def analyze_shard(shard_index, num_shards):
+    """ Analyze the transcript files of one shard, the results are stored in the result directory of the shard. """
+    transcript_files = sharding.select_shard(compileTranscriptFileListInPath(transcript_path), shard_index, num_shards)
+    print(f"Shard {shard_index} of {num_shards}: {len(transcript_files)} transcript files.")
+    shard_result_path = sharding.init_shard_result_path(result_path, shard_index, num_shards)
+    sharding.seed_shard_database(shard_result_path, os.path.join(result_path, "results.db"), transcript_files)
+    database_engine = analyze_transcript_files(transcript_files, shard_result_path)
+    write_run_summary(shard_result_path)
+    database_engine.dispose()
 
-        # Remove processed files from the list
-        transcriptFilesToProcess = transcriptFilesToProcess[batch_size:]
 
-        print(f"Processed {len(nextBatchOfTranscriptFilenames)} transcript files: {nextBatchOfTranscriptFilenames}")
+def write_run_summary(output_path):
+    """ Write the metrics of the run (JSON run summary, optional Prometheus textfile and stage profiles). """
+    token_usage = llm_client.llm_scheduler.usage_statistics() if llm_client.llm_scheduler is not None else None
+    metrics = run_metrics.run_metrics
+    metrics.write_json_summary(os.path.join(output_path, f"run-summary-{metrics.started_at.strftime('%Y%m%d_%H%M%S')}.json"), token_usage)
+    if metrics_prometheus_textfile:
+        metrics.write_prometheus_textfile(metrics_prometheus_textfile, token_usage)
+    metrics.write_profiles()
 
-    # After processing all files, create the final report in Excel format
-    create_final_report(database_engine, output_path=os.path.join(result_path, f"results-{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"))
-    print(f"Completed processing of {len(allTranscriptFilesInPath)} transcript files at {datetime.now().isoformat()}.")
 
-    # Close the database connection
-    database_engine.dispose()
+def create_final_report(database_engine, output_path):
+    """
+    Stream all results from the database in chunks into the final report (see report).
+
+    Args:
+        database_engine: SQLAlchemy database engine
+        output_path: Path where the report should be saved
+    """
+    analyses = None
+    if report_analyses is not None:
+        analyses = [analysis for analysis in get_llm_analyses() if analysis.name in report_analyses]
+    with run_metrics.stage_timer("report"):
+        row_count = report.export_report(database_engine, output_path, analyses=analyses, exclude_columns=report_exclude_columns)
+    print(f"Final report with {row_count} records saved to {output_path}")
+
+
+if(__name__ == "__main__"):
+    # 
+    # Main analysis loop
+    #
 
- 
\ No newline at end of file
+    if num_shards > 1 and shard_index is not None:
+        # Worker for a single shard (e.g. one of several machines sharing the transcript and result paths)
+        analyze_shard(int(shard_index), num_shards)
+        print(f"Completed shard {shard_index} of {num_shards}. Run without CONVOSPECTOR_SHARD_INDEX to merge the shards.")
+
+    elif num_shards > 1:
+        # One worker process per shard, then merge the shard results into the main database
+        workers = [multiprocessing.Process(target=analyze_shard, args=(index, num_shards)) for index in range(num_shards)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed_shards = [index for index, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed_shards:
+            # the results of the completed batches are kept, a restart continues the failed shards
+            raise RuntimeError(f"Analysis of shards {failed_shards} failed, restart to continue them.")
+
+        run_metrics.reset_run_metrics(profile_path=profile_path)
+        database_engine = initGlobalResultPersistence(result_path)
+        result_store.init_result_table(database_engine, get_llm_analyses(), deduplicate=deduplicate_transcripts)
+        with run_metrics.stage_timer("merge"):
+            sharding.merge_shards(database_engine, result_path, num_shards)
+
+    else:
+        # Compile the list of transcript files in the given path and analyze the ones not processed yet
+        database_engine = analyze_transcript_files(compileTranscriptFileListInPath(transcript_path), result_path)
+
+    if num_shards == 1 or shard_index is None:
+        # After processing all files, create the final report (format report_format)
+        create_final_report(database_engine, output_path=os.path.join(result_path, f"results-{datetime.now().strftime('%Y%m%d_%H%M%S')}.{report_format}"))
+        print(f"Completed processing of transcript files in {transcript_path} at {datetime.now().isoformat()}.")
+        write_run_summary(result_path)
+
+        # Close the database connection
+        database_engine.dispose()
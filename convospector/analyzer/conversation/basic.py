@@ -1,16 +1,61 @@
 import os
+import numpy as np
+import pandas as pd
 
+from tokens import estimate_tokens
 
-def transcript_to_pseudo_xml(transcript):
-    """ Helper function: Convert a transcript to a pseudo XML format for LLM processing. """
+
+def transcript_to_pseudo_xml(transcript, max_tokens=None, count_tokens=estimate_tokens):
+    """ 
+    Helper function: Convert a transcript to a pseudo XML format for LLM processing. 
+    With max_tokens, long conversations are windowed to the token budget: the first utterance 
+    and as many of the last utterances as fit are kept, the omitted ones are replaced by a marker.
+    The tokens are counted with count_tokens (a function of the text, e.g. the tokenizer of the model).
+    """
     utterances = transcript["conversation"]["utterances"]
-    xml_content = "<conversation>\n"
+    lines = []
     for utterance in utterances:
         role = utterance["role"]
         content = utterance["content"] # utterance["content"].replace("<", "&lt;").replace(">", "&gt;")
-        xml_content += f"  <{role}>{content}</{role}>\n"
-    xml_content += "</conversation>"
-    return xml_content
+        lines.append(f"  <{role}>{content}</{role}>\n")
+
+    if max_tokens is not None and count_tokens("".join(lines)) > max_tokens:
+        lines = window_utterance_lines(lines, max_tokens, count_tokens=count_tokens)
+    return "<conversation>\n" + "".join(lines) + "</conversation>"
+
+
+def window_utterance_lines(lines, max_tokens, head_utterances=1, count_tokens=estimate_tokens):
+    """ 
+    Reduce the rendered utterance lines to the token budget: keep the first head_utterances and 
+    fill the budget from the end of the conversation. Utterances longer than the budget are cut.
+    """
+    def truncate(line, tokens):
+        # about four characters per token, the closing tag is kept
+        closing_tag_start = line.rfind("</")
+        return line[:min(closing_tag_start, max(0, tokens) * 4)] + " [...]" + line[closing_tag_start:]
+
+    budget = max_tokens
+    head = []
+    for line in lines[:head_utterances]:
+        line_tokens = count_tokens(line)
+        head.append(line if line_tokens <= budget // 2 else truncate(line, budget // 2))
+        budget -= min(line_tokens, budget // 2)
+
+    tail = []
+    for line in reversed(lines[head_utterances:]):
+        line_tokens = count_tokens(line)
+        if line_tokens > budget:
+            if not tail:
+                tail.append(truncate(line, budget))
+            break
+        tail.append(line)
+        budget -= line_tokens
+    tail.reverse()
+
+    omitted = len(lines) - len(head) - len(tail)
+    if omitted > 0:
+        head.append(f"  <omitted utterances=\"{omitted}\"/>\n")
+    return head + tail
 
 
 def countTurnsInTranscripts(transcripts, globalResultDF, isAggregation=False):
@@ -64,4 +109,74 @@ def addTranscriptsToResult(transcripts, globalResultDF):
     for transcript in transcripts:
         transcripts_as_pseudo_xml.append(transcript_to_pseudo_xml(transcript))
 
-    globalResultDF["transcript"] = transcripts_as_pseudo_xml
\ No newline at end of file
+    globalResultDF["transcript"] = transcripts_as_pseudo_xml
+
+
+def transcripts_to_utterance_frame(transcripts):
+    """ 
+    Flatten the utterances of the transcripts into one columnar DataFrame with the columns
+    sessionId, transcript_index (position of the transcript in the list), position, role, content and word_count.
+    """
+    utterance_lists = [transcript["conversation"]["utterances"] for transcript in transcripts]
+    lengths = np.fromiter((len(utterances) for utterances in utterance_lists), dtype=np.int64, count=len(utterance_lists))
+    utterances = [utterance for utterance_list in utterance_lists for utterance in utterance_list]
+    contents = [utterance["content"] for utterance in utterances]
+
+    # position of each utterance within its conversation
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return pd.DataFrame({
+        "sessionId": np.repeat(np.array([transcript["conversation"]["sessionId"] for transcript in transcripts], dtype=object), lengths),
+        "transcript_index": np.repeat(np.arange(len(transcripts), dtype=np.int64), lengths),
+        "position": np.arange(len(utterances), dtype=np.int64) - starts,
+        "role": [utterance["role"] for utterance in utterances],
+        "content": contents,
+        "word_count": np.array([len(content.split()) for content in contents], dtype=np.int64),
+    })
+
+
+def computeBasicMetrics(utterancesDF, globalResultDF, isAggregation=False):
+    """ 
+    Compute the deterministic metrics of all transcripts in one pass over the utterance frame 
+    (see transcripts_to_utterance_frame) and add them to the global result. 
+    turnCount and maxUserWordCount are the same as computed by countTurnsInTranscripts and maxWordCountUserUtterances.
+    The utterances of a conversation must be in order (as created by transcripts_to_utterance_frame).
+    The utterances are grouped by the position of their transcript, which is also the row of the global
+    result (conversations with the same sessionId within a batch keep their own metrics).
+    """
+    group_count = len(globalResultDF)
+    codes = utterancesDF["transcript_index"].to_numpy()
+    if len(codes) and codes.max() >= group_count:
+        raise ValueError("The utterance frame has more transcripts than the global result has rows.")
+
+    roles = utterancesDF["role"].to_numpy()
+    word_counts = utterancesDF["word_count"].to_numpy()
+    is_user = roles == "user"
+
+    # When aggregating: Only if the role is different from the last one, we count it as a new turn
+    new_turn = np.ones(len(roles), dtype=bool)
+    if isAggregation and len(roles) > 1:
+        new_turn[1:] = (roles[1:] != roles[:-1]) | (codes[1:] != codes[:-1])
+
+    userCounts = np.bincount(codes, weights=is_user, minlength=group_count)
+    botCounts = np.bincount(codes, weights=~is_user, minlength=group_count)
+    userWordCounts = np.bincount(codes, weights=np.where(is_user, word_counts, 0), minlength=group_count)
+    maxUserWordCounts = np.zeros(group_count, dtype=np.int64)
+    np.maximum.at(maxUserWordCounts, codes[is_user], word_counts[is_user])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # NaN if there are no user (bot) utterances
+        meanUserWordCounts = np.where(userCounts > 0, userWordCounts / userCounts, np.nan)
+        userBotRatios = np.where(botCounts > 0, userCounts / botCounts, np.nan)
+
+    metrics = {
+        "turnCount": np.bincount(codes, weights=new_turn, minlength=group_count).astype(np.int64),
+        "maxUserWordCount": maxUserWordCounts,
+        "userUtteranceCount": userCounts.astype(np.int64),
+        "botUtteranceCount": botCounts.astype(np.int64),
+        "totalWordCount": np.bincount(codes, weights=word_counts, minlength=group_count).astype(np.int64),
+        "meanUserWordCount": meanUserWordCounts,
+        "userBotUtteranceRatio": userBotRatios,
+    }
+
+    # Add the metrics to the rows of the global result (transcripts without utterances have counts of 0)
+    for column, values in metrics.items():
+        globalResultDF[column] = values
@@ -1,30 +1,49 @@
 import os
-import json
-import pandas as pd
-from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Optional
+from pydantic import BaseModel, create_model
 import chevron
 
 from analyzer.conversation.basic import transcript_to_pseudo_xml
-from llm_client import llm_model
+from llm_client import llm_model, get_llm_scheduler
+from tokens import estimate_tokens
+import llm_cache
 import filter
+import local_model
+import run_metrics
 
 # module variable to cache the prompt definitions
 prompt_cache = {}
 
+# maximum number of LLM requests in flight at the same time (1 = sequential processing)
+max_concurrent_requests = int(os.getenv("LLM_MAX_CONCURRENT_REQUESTS", "8"))
+
+# prompt combining several analyses into one request
+fused_prompt_file = "./analyzer/conversation/llm_prompts/prmt_fused_analysis.md"
+
+# module variable to cache the combined JSON schemas of fused analyses
+fused_schema_cache = {}
+
+# number of response tokens reserved in the token budget for each request
+expected_response_tokens = 200
+
+# maximum number of tokens of a transcript in a prompt, longer conversations are windowed (None = unlimited)
+max_transcript_tokens = int(os.getenv("LLM_MAX_TRANSCRIPT_TOKENS", "0")) or None
+
 
 def load_prompt_template(file_path, data=None):
     """ 
-    Load a prompt from file or cache and return its content. 
+    Load a prompt from file or cache and return its content rendered as mustache template.
     Optionally apply data to the prompt template.
 
     Args:
         file_path (str): Path to the prompt file.
         data (dict, optional): Data to apply to the prompt template.
-                               If provided, the template will be rendered with this data.
+                               Sections of missing keys (e.g. {{^fused}}) are rendered as if false.
     Returns:
-        str: The prompt template content, optionally rendered with data.
+        str: The prompt template content, rendered with the data.
     """
-    global prompt_cache
     prompt_template = ""
 
     if file_path in prompt_cache:
@@ -40,96 +59,316 @@ def load_prompt_template(file_path, data=None):
         # Cache the prompt template
         prompt_cache[file_path] = prompt_template
     
-    # Optionally apply data to the prompt template
-    if data:
-        return chevron.render(prompt_template, data)
-    else:
-        return prompt_template
+    # Apply the (optional) data to the prompt template
+    return chevron.render(prompt_template, data or {})
+
+
+def fused_instructions(analysis):
+    """ Return the instructions of an analysis embedded in a fused prompt (without its response format and conversation sections). """
+    return load_prompt_template(analysis.prompt_file, data=dict(analysis.data or {}, fused=True))
+
+def map_concurrently(func, items, max_workers=None):
+    """
+    Apply a function to all items using a bounded thread pool.
+
+    Args:
+        func (callable): Function to apply to each item.
+        items (list): Items to process.
+        max_workers (int, optional): Maximum number of calls in flight.
+                                     Defaults to the module setting max_concurrent_requests.
+    Returns:
+        list: The results in the order of the given items.
+    """
+    if max_workers is None:
+        max_workers = max_concurrent_requests
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        # executor.map returns the results in the order of the input items
+        return list(executor.map(func, items))
+
+
+def render_transcript(transcript):
+    """ Render a transcript for a prompt (windowed to max_transcript_tokens). """
+    return transcript_to_pseudo_xml(transcript, max_tokens=max_transcript_tokens, count_tokens=estimate_tokens)
+
+
+def prompt_messages(instructions, transcript_text):
+    """
+    Return the messages of a request: the rendered prompt template as system message and the
+    transcript as user message. The static instructions form an identical prefix of all requests
+    of an analysis, which the service can serve from its prompt cache.
+    """
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": transcript_text}
+    ]
+
+
+@lru_cache(maxsize=64)
+def _estimate_template_tokens(instructions):
+    """ Estimate the tokens of a rendered prompt template (once per template). """
+    return estimate_tokens(instructions)
+
+
+def estimate_request_tokens(instructions, transcript_text):
+    """ Estimate the tokens of a request (prompt and expected response) for the token budget. """
+    return _estimate_template_tokens(instructions) + estimate_tokens(transcript_text) + expected_response_tokens
+
 
 def apply_prompt_to_text(llm_api_client, prompt_file_path, transcript_text, data=None):
     """ Apply the prompt to the given prompt file and return the response. """
     classifier_prompt = load_prompt_template(prompt_file_path, data=data)
 
-    # Call the LLM service API with the loaded prompt and transcript text
-    response = llm_api_client.chat.completions.create(
-        model= llm_model,     # "gpt-4.1-mini", # Deployment name!
-        messages=[
-            {"role": "system", "content": classifier_prompt + transcript_text}
-        ]
+    # Already answered in a previous run?
+    cache = llm_cache.llm_cache
+    if cache is not None:
+        key = llm_cache.cache_key(llm_model, classifier_prompt, transcript_text)
+        cached_response = cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    messages = prompt_messages(classifier_prompt, transcript_text)
+
+    # Call the LLM service API with the loaded prompt and transcript text (within the rate limits)
+    response = get_llm_scheduler().call(
+        lambda: llm_api_client.chat.completions.create(
+            model= llm_model,     # "gpt-4.1-mini", # Deployment name!
+            messages=messages
+        ),
+        estimated_tokens=estimate_request_tokens(classifier_prompt, transcript_text)
     )
-    return response.choices[0].message.content.strip()
+    text_response = response.choices[0].message.content.strip()
+
+    if cache is not None:
+        cache.put(key, text_response)
+    return text_response
 
 def apply_prompt_with_json_schema(llm_api_client, prompt_file_path, transcript_text, json_schema, data=None):
     """ Apply the prompt to the given prompt file and return the response as a JSON object. """
     classifier_prompt = load_prompt_template(prompt_file_path, data=data)
 
+    # Already answered in a previous run?
+    cache = llm_cache.llm_cache
+    if cache is not None:
+        key = llm_cache.cache_key(llm_model, classifier_prompt, transcript_text, json_schema)
+        cached_response = cache.get(key)
+        if cached_response is not None:
+            try:
+                return json_schema.model_validate_json(cached_response)
+            except ValueError as e:
+                print(f"Ignoring invalid cached response: {e}")
+
+    messages = prompt_messages(classifier_prompt, transcript_text)
+
     # Handle format errors: On rare occasions the response may not be a valid JSON object 
-    # (LLM error or refusal to answer)
+    # (LLM error or refusal to answer). Rate limits and transient errors are retried by the scheduler.
     try:
-        # Call the LLM service API with the loaded prompt and transcript text
-        response = llm_api_client.responses.parse(
-            model= llm_model, # "gpt-4.1-mini", # Deployment name for Azure! #todo: use the model name from the config
-            input=classifier_prompt + transcript_text,
-            text_format=json_schema
+        # Call the LLM service API with the loaded prompt and transcript text (within the rate limits)
+        response = get_llm_scheduler().call(
+            lambda: llm_api_client.responses.parse(
+                model= llm_model, # "gpt-4.1-mini", # Deployment name for Azure! #todo: use the model name from the config
+                input=messages,
+                text_format=json_schema
+            ),
+            estimated_tokens=estimate_request_tokens(classifier_prompt, transcript_text)
         )
         json_response = response.output_parsed
+        if json_response is None:
+            # refusal of the LLM (or no parsable output)
+            run_metrics.count_error("refusal")
  
     except Exception as e:
         print(f"Error applying prompt with JSON schema: {e}")
         json_response = None
 
+    # Only valid results are cached, failed requests are retried in the next run
+    if cache is not None and json_response is not None:
+        cache.put(key, json_response.model_dump_json())
+
     return json_response
     
 
-def apply_llm_prompt_for_text_result(llm_api_client, transcripts, globalResultDF, promptFilePath, resultColumn="llmPromptAnalysis", filters=[]):
+def apply_llm_prompt_for_text_result(llm_api_client, transcripts, globalResultDF, promptFilePath, resultColumn="llmPromptAnalysis", filters=[], max_concurrent_requests=None):
     """ Analyze the transcripts using a prompt and adding the result to the global result DataFrame. """
 
-    # Analyze each transcript with the prompt
+    # Select the relevant transcripts and convert them for the prompt
+    relevant = filter.relevance_mask(globalResultDF, transcripts, filters)
+    transcript_texts = [render_transcript(transcript) for transcript, is_relevant in zip(transcripts, relevant) if is_relevant]
+
+    # Apply the prompt to the relevant transcripts (concurrently, results keep the transcript order)
+    llm_results = iter(map_concurrently(
+        lambda transcript_text: apply_prompt_to_text(llm_api_client, promptFilePath, transcript_text),
+        transcript_texts, max_concurrent_requests))
+
     analysis_results = []
-    for transcript in transcripts:
-        if not filter.is_relevant_transcript(globalResultDF, transcript, filters):
-            analysis_results.append("No analysis")
-            continue
-        # Apply the prompt to the transcript
-        transcript_as_pseudo_xml = transcript_to_pseudo_xml(transcript)
-        print(transcript_as_pseudo_xml)  # Debugging output
-        llm_result = apply_prompt_to_text(llm_api_client, promptFilePath, transcript_as_pseudo_xml)
-        analysis_results.append(llm_result)
-        # break  # Remove this break to analyze all transcripts
+    for is_relevant in relevant:
+        analysis_results.append(next(llm_results) if is_relevant else "No analysis")
 
     globalResultDF["llmPromptAnalysis"] = analysis_results
 
 
-def apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, promptFilePath, jsonSchema, resultColumns={}, filters=[], data = None):
-    """ Analyze the transcripts using a prompt and add the resulting JSON structure to the global result DataFrame. """
+def apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, promptFilePath, jsonSchema, resultColumns={}, filters=[], data = None, max_concurrent_requests=None, first_pass=None, relevant=None, source_column=None):
+    """ 
+    Analyze the transcripts using a prompt and add the resulting JSON structure to the global result DataFrame. 
+    
+    The LLM requests are dispatched concurrently (at most max_concurrent_requests in flight). 
+    A failing request only affects the result of its own transcript ("No result").
+    With a first pass (see local_model.FirstPass), the transcripts are classified by a local model first
+    and only the transcripts without a confident prediction are sent to the LLM. Locally classified
+    transcripts only get the label field ("No analysis" in the other result columns), the source
+    column (if given) records where each result came from.
+    The relevance mask of the filters can be passed if it has already been evaluated for the batch.
+    """
     # create result columns
     analysis_results = {}
     for key in resultColumns.keys():
         analysis_results[resultColumns[key]] = []
 
-    # Analyze each transcript with the prompt
-    for transcript in transcripts:
-        if not filter.is_relevant_transcript(globalResultDF, transcript, filters):
+    # Select the relevant transcripts
+    if relevant is None:
+        relevant = filter.relevance_mask(globalResultDF, transcripts, filters)
+    relevant_transcripts = [transcript for transcript, is_relevant in zip(transcripts, relevant) if is_relevant]
+
+    # Local first pass: confident predictions are final, the other transcripts are escalated to the LLM
+    first_pass_labels = iter(first_pass.predict(relevant_transcripts) if first_pass is not None else [None] * len(relevant_transcripts))
+    local_labels = [next(first_pass_labels) for _ in relevant_transcripts]
+    transcript_texts = [render_transcript(transcript) for transcript, local_label in zip(relevant_transcripts, local_labels) if local_label is None]
+    if first_pass is not None:
+        print(f"First pass: {len(relevant_transcripts) - len(transcript_texts)} of {len(relevant_transcripts)} transcripts classified locally.")
+
+    # Apply the prompt to the escalated transcripts (concurrently, results keep the transcript order)
+    llm_results = iter(map_concurrently(
+        lambda transcript_text: apply_prompt_with_json_schema(llm_api_client, promptFilePath, transcript_text, jsonSchema, data=data),
+        transcript_texts, max_concurrent_requests))
+    local_labels = iter(local_labels)
+
+    sources = []
+    for is_relevant in relevant:
+        if not is_relevant:
             for key in resultColumns.keys():
                 analysis_results[resultColumns[key]].append("No analysis")
+            sources.append("No analysis")
             continue
-        # Apply the prompt to the transcript
-        transcript_as_pseudo_xml = transcript_to_pseudo_xml(transcript)
-        # print(transcript_as_pseudo_xml)  # Debugging output
 
-        llm_result_json = apply_prompt_with_json_schema(llm_api_client, promptFilePath, transcript_as_pseudo_xml, jsonSchema, data=data)
-        # print(llm_result_json)  # Debugging output
+        local_label = next(local_labels)
+        if local_label is not None:
+            # Locally classified: only the label field
+            for result_key in resultColumns.keys():
+                analysis_results[resultColumns[result_key]].append(local_label if result_key == first_pass.label_field else "No analysis")
+            sources.append(local_model.SOURCE_LOCAL_MODEL)
+            continue
+        llm_result_json = next(llm_results)
 
         # Extract the results from the JSON response
         for result_key in resultColumns.keys():
             analysis_results[resultColumns[result_key]].append(getattr(llm_result_json, result_key, "No result"))
-        # break  # Remove this break to analyze all transcripts
+        sources.append(local_model.SOURCE_LLM)
     
     # Add the results to the global DataFrame
     for key in resultColumns.keys():
         globalResultDF[resultColumns[key]] = analysis_results[resultColumns[key]]
+    if source_column is not None:
+        globalResultDF[source_column] = sources
+
+
+
+
+class LLMAnalysis(BaseModel):
+    """ Definition of an LLM analysis: prompt, structured result and the result columns it fills. """
+    name: str
+    prompt_file: str
+    json_schema: type[BaseModel]
+    result_columns: dict[str, str]      # JSON key -> result column
+    filters: list[Callable] = []
+    data: Optional[dict] = None         # data for rendering the prompt template
+    first_pass: Optional[Any] = None    # local first-pass classification (see local_model.FirstPass)
+    source_column: Optional[str] = None # result column recording the source of the results (local model or LLM)
+
+    def output_columns(self):
+        """ Return the result columns filled by the analysis (with the source column). """
+        columns = list(self.result_columns.values())
+        if self.source_column is not None:
+            columns.append(self.source_column)
+        return columns
+
+
+def llm_sources(relevant):
+    """ Return the values of the source column of results computed by the LLM (for the relevant transcripts). """
+    return [local_model.SOURCE_LLM if is_relevant else "No analysis" for is_relevant in relevant]
+
+
+def run_llm_analysis(llm_api_client, transcripts, globalResultDF, analysis, max_concurrent_requests=None, relevant=None):
+    """ Apply an LLM analysis to the transcripts and add the results to the global DataFrame (relevant: mask of its filters, evaluated if not given). """
+    apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, analysis.prompt_file, analysis.json_schema, resultColumns=analysis.result_columns, filters=analysis.filters, data=analysis.data, max_concurrent_requests=max_concurrent_requests, first_pass=analysis.first_pass, relevant=relevant, source_column=analysis.source_column)
+
+
+def get_fused_json_schema(analyses):
+    """ Return the combined Pydantic model of several analyses (one field per analysis name). """
+    names = tuple(analysis.name for analysis in analyses)
+    if names not in fused_schema_cache:
+        fused_schema_cache[names] = create_model("FusedAnalysisJson", **{analysis.name: (analysis.json_schema, ...) for analysis in analyses})
+    return fused_schema_cache[names]
+
+
+def apply_fused_analyses_to_text(llm_api_client, analyses, transcript_text):
+    """
+    Apply several analyses to a transcript with one combined LLM request.
+    If the combined response cannot be parsed, the analyses are applied with separate requests.
+
+    Returns:
+        dict: The structured result (or None) by analysis name.
+    """
+    if len(analyses) > 1:
+        tasks = [{"name": analysis.name, "instructions": fused_instructions(analysis)} for analysis in analyses]
+        fused_result = apply_prompt_with_json_schema(llm_api_client, fused_prompt_file, transcript_text, get_fused_json_schema(analyses), data={"tasks": tasks})
+        if fused_result is not None:
+            return {analysis.name: getattr(fused_result, analysis.name) for analysis in analyses}
+        print("Combined analysis failed, falling back to separate requests.")
+
+    return {analysis.name: apply_prompt_with_json_schema(llm_api_client, analysis.prompt_file, transcript_text, analysis.json_schema, data=analysis.data) for analysis in analyses}
+
+
+def run_fused_llm_analyses(llm_api_client, transcripts, globalResultDF, analyses, max_concurrent_requests=None):
+    """
+    Apply several LLM analyses with one combined request per transcript and fan the results out to
+    the result columns of each analysis (same columns and values as running them separately).
+    Each transcript is only analyzed by the analyses whose filters it passes.
+    """
+    # Select the relevant analyses for each transcript
+    relevant = {analysis.name: filter.relevance_mask(globalResultDF, transcripts, analysis.filters) for analysis in analyses}
+    jobs = []
+    for index, transcript in enumerate(transcripts):
+        relevant_analyses = [analysis for analysis in analyses if relevant[analysis.name][index]]
+        if relevant_analyses:
+            jobs.append((relevant_analyses, render_transcript(transcript)))
 
+    # Apply the combined prompts (concurrently, results keep the transcript order)
+    llm_results = iter(map_concurrently(
+        lambda job: apply_fused_analyses_to_text(llm_api_client, job[0], job[1]),
+        jobs, max_concurrent_requests))
 
+    analysis_results = {column: [] for analysis in analyses for column in analysis.result_columns.values()}
+    for index in range(len(transcripts)):
+        if not any(relevant[analysis.name][index] for analysis in analyses):
+            transcript_results = {}
+        else:
+            transcript_results = next(llm_results)
+
+        for analysis in analyses:
+            for result_key, column in analysis.result_columns.items():
+                if not relevant[analysis.name][index]:
+                    analysis_results[column].append("No analysis")
+                else:
+                    analysis_results[column].append(getattr(transcript_results.get(analysis.name), result_key, "No result"))
+
+    # Add the results to the global DataFrame
+    for column, values in analysis_results.items():
+        globalResultDF[column] = values
+    for analysis in analyses:
+        if analysis.source_column is not None:
+            globalResultDF[analysis.source_column] = llm_sources(relevant[analysis.name])
 
 
 class CategorizeTranscriptsJson(BaseModel):
@@ -138,8 +377,8 @@ class CategorizeTranscriptsJson(BaseModel):
     intent: str
     breakdown: str
 
-def categorize_transcripts(llm_api_client, transcripts, globalResultDF, categories_file=None):
-    """ Categorize transcripts using LLM and add the results to the global DataFrame. """
+def get_categorization_analysis(categories_file=None):
+    """ Return the definition of the categorization analysis (closed categories if a category list is given). """
     # Load the category list if provided
     categories = None
     if categories_file:
@@ -150,10 +389,14 @@ def categorize_transcripts(llm_api_client, transcripts, globalResultDF, categori
 
     if categories:
         # Closed categorization with predefined categories
-        apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, "./analyzer/conversation/llm_prompts/prmt_topic_and_intent_closed.md", CategorizeTranscriptsJson, resultColumns={"topic": "topic", "intent": "intent", "breakdown": "breakdown"}, filters=[filter.filter_no_user_utterance], data={"category_list": categories})
+        return LLMAnalysis(name="categorization", prompt_file="./analyzer/conversation/llm_prompts/prmt_topic_and_intent_closed.md", json_schema=CategorizeTranscriptsJson, result_columns={"topic": "topic", "intent": "intent", "breakdown": "breakdown"}, filters=[filter.filter_no_user_utterance], data={"category_list": categories}, source_column="topicSource")
     else:
         # Open categorization
-        apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, "./analyzer/conversation/llm_prompts/prmt_topic_and_intent_open.md", CategorizeTranscriptsJson, resultColumns={"topic": "topic", "intent": "intent", "breakdown": "breakdown"}, filters=[filter.filter_no_user_utterance])
+        return LLMAnalysis(name="categorization", prompt_file="./analyzer/conversation/llm_prompts/prmt_topic_and_intent_open.md", json_schema=CategorizeTranscriptsJson, result_columns={"topic": "topic", "intent": "intent", "breakdown": "breakdown"}, filters=[filter.filter_no_user_utterance])
+
+def categorize_transcripts(llm_api_client, transcripts, globalResultDF, categories_file=None):
+    """ Categorize transcripts using LLM and add the results to the global DataFrame. """
+    run_llm_analysis(llm_api_client, transcripts, globalResultDF, get_categorization_analysis(categories_file))
 
 
 class AssessSentimentJson(BaseModel):
@@ -162,6 +405,10 @@ class AssessSentimentJson(BaseModel):
     reason: str
     utterance: str
 
+def get_sentiment_analysis():
+    """ Return the definition of the sentiment analysis. """
+    return LLMAnalysis(name="sentiment", prompt_file="./analyzer/conversation/llm_prompts/prmt_sentiment_analysis.md", json_schema=AssessSentimentJson, result_columns={"sentiment_label": "Sentiment", "reason": "Reason", "utterance": "Characteristic utterance"}, filters=[filter.filter_no_user_utterance])
+
 def assess_sentiment(llm_api_client, transcripts, globalResultDF):
     """ Assess sentiment of transcripts using LLM and add the results to the global DataFrame. """
-    apply_llm_prompt_for_JSON_result(llm_api_client, transcripts, globalResultDF, "./analyzer/conversation/llm_prompts/prmt_sentiment_analysis.md", AssessSentimentJson, resultColumns={"sentiment_label": "Sentiment", "reason": "Reason", "utterance": "Characteristic utterance"}, filters=[filter.filter_no_user_utterance])
+    run_llm_analysis(llm_api_client, transcripts, globalResultDF, get_sentiment_analysis())
@@ -0,0 +1,255 @@
+""" Deduplication of (near-)identical conversations before the LLM analyses.
+
+The utterances are normalized (case, digits, punctuation, whitespace) and each conversation gets
+two fingerprints: a hash of the normalized text for exact duplicates and a 64 bit SimHash of its
+word shingles for near-duplicates. SimHashes are indexed in bands (locality-sensitive hashing),
+so a conversation is only compared with the representatives sharing a band. The first
+conversation of a cluster is its representative: only representatives are analyzed by the LLM,
+the other members get the results of their representative and its sessionId in the column duplicateOf.
+
+The index lives in memory for the whole run, so duplicates are also found across batches.
+"""
+import hashlib
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+import filter
+
+# result column linking a conversation to the representative whose LLM results it received
+DUPLICATE_OF_COLUMN = "duplicateOf"
+
+# number of words in a shingle for the SimHash
+SHINGLE_SIZE = 2
+
+_DIGITS = re.compile(r"\d+")
+_NON_WORD = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_content(text):
+    """ Normalize an utterance for the fingerprints (lower case, digits as 0, without punctuation and extra whitespace). """
+    text = _DIGITS.sub("0", text.lower())
+    text = _NON_WORD.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def normalized_tokens(transcript):
+    """ Return the words of the normalized conversation, each utterance introduced by its role. """
+    tokens = []
+    for utterance in transcript["conversation"]["utterances"]:
+        tokens.append(f"<{utterance['role']}>")
+        tokens.extend(normalize_content(utterance["content"]).split())
+    return tokens or ["<empty>"]
+
+
+def exact_fingerprint(tokens):
+    """ Return the hash of the normalized conversation. """
+    return hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()
+
+
+def _mix64(values):
+    """ splitmix64 finalizer: spreads the bits of 64 bit values (vectorized, wraps around). """
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def simhashes(token_lists, shingle_size=SHINGLE_SIZE):
+    """
+    Return the 64 bit SimHashes of the word shingles of normalized conversations.
+    Each distinct token is hashed once, the shingle hashes are combined from the token hashes
+    and all conversations of a batch are processed in one numpy pass.
+    """
+    if not token_lists:
+        return []
+    token_ids = {}
+    flat_ids = np.fromiter((token_ids.setdefault(token, len(token_ids)) for tokens in token_lists for token in tokens), dtype=np.int64)
+    token_hashes = np.frombuffer(b"".join(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest() for token in token_ids), dtype=np.uint64)
+    hashes = token_hashes[flat_ids]
+
+    # shingles: all windows of shingle_size tokens within a conversation (one shorter window for short conversations)
+    token_counts = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+    token_offsets = np.concatenate(([0], np.cumsum(token_counts)[:-1]))
+    shingle_counts = np.maximum(1, token_counts - shingle_size + 1)
+    conversation_of_shingle = np.repeat(np.arange(len(token_lists)), shingle_counts)
+    shingle_offsets = np.concatenate(([0], np.cumsum(shingle_counts)[:-1]))
+    starts = token_offsets[conversation_of_shingle] + np.arange(shingle_counts.sum()) - shingle_offsets[conversation_of_shingle]
+    last_token = token_offsets[conversation_of_shingle] + np.maximum(token_counts[conversation_of_shingle], 1) - 1
+
+    with np.errstate(over="ignore"):
+        shingle_hashes = np.zeros(len(starts), dtype=np.uint64)
+        for offset in range(shingle_size):
+            shingle_hashes = _mix64(shingle_hashes * np.uint64(0x9E3779B97F4A7C15) + hashes[np.minimum(starts + offset, last_token)])
+
+    # bit votes of the shingles, summed per conversation
+    bits = np.unpackbits(shingle_hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = np.add.reduceat(bits, shingle_offsets, axis=0, dtype=np.int32)
+    majority = votes * 2 > shingle_counts[:, None]
+    packed = np.packbits(majority, axis=1, bitorder="little")
+    return [int.from_bytes(row.tobytes(), "little") for row in packed]
+
+
+def simhash(tokens, shingle_size=SHINGLE_SIZE):
+    """ Return the 64 bit SimHash of the word shingles of a normalized conversation. """
+    return simhashes([tokens], shingle_size)[0]
+
+
+def hamming_distance(hash1, hash2):
+    """ Return the number of differing bits of two SimHashes. """
+    return bin(hash1 ^ hash2).count("1")
+
+
+class DuplicateIndex:
+    """
+    In-memory index of the cluster representatives of a run (thread-safe).
+    Near-duplicates are SimHashes with a Hamming distance of at most max_distance. The SimHash is
+    split into max_distance + 1 bands, so near-duplicates share at least one band (pigeonhole principle).
+    """
+
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.band_count = max_distance + 1
+        self.band_bits = 64 // self.band_count
+        self._lock = threading.Lock()
+        self._exact = {}        # exact fingerprint -> representative sessionId
+        self._bands = [{} for _ in range(self.band_count)]  # band value -> [(representative sessionId, SimHash)]
+        self._results = {}      # representative sessionId -> {result column: value}
+        self._duplicate_kinds = {}  # member sessionId -> statistic counted when the results are copied to it
+        # duplicates are counted when the results of their representative are copied to them,
+        # members analyzed themselves (representative not analyzed yet) are counted as demoted
+        self.statistics = {"representatives": 0, "exact_duplicates": 0, "near_duplicates": 0, "demoted_members": 0}
+
+    def _band_values(self, hash_value):
+        mask = (1 << self.band_bits) - 1
+        return [(hash_value >> (band * self.band_bits)) & mask for band in range(self.band_count)]
+
+    def assign(self, sessionId, tokens, hash_value=None, group=()):
+        """
+        Return the sessionId of the representative of a conversation (None if it becomes a representative itself).
+        Conversations are only clustered within the same group (e.g. the same relevance for the analyses).
+
+        Args:
+            sessionId (str): sessionId of the conversation.
+            tokens (list): Normalized tokens of the conversation (see normalized_tokens).
+            hash_value (int, optional): SimHash of the tokens (computed if not given).
+            group (tuple, optional): Group of the conversation.
+        """
+        exact_hash = (group, exact_fingerprint(tokens))
+        if hash_value is None:
+            hash_value = simhash(tokens)
+        band_values = [(group, band_value) for band_value in self._band_values(hash_value)]
+
+        with self._lock:
+            representative = self._exact.get(exact_hash)
+            if representative is not None and representative != sessionId:
+                self._duplicate_kinds[sessionId] = "exact_duplicates"
+                return representative
+
+            for band, band_value in enumerate(band_values):
+                for candidate, candidate_hash in self._bands[band].get(band_value, ()):
+                    if candidate != sessionId and hamming_distance(hash_value, candidate_hash) <= self.max_distance:
+                        self._duplicate_kinds[sessionId] = "near_duplicates"
+                        self._exact.setdefault(exact_hash, candidate)
+                        return candidate
+
+            # new cluster
+            self._exact[exact_hash] = sessionId
+            for band, band_value in enumerate(band_values):
+                self._bands[band].setdefault(band_value, []).append((sessionId, hash_value))
+            self.statistics["representatives"] += 1
+            return None
+
+    def store_results(self, sessionId, results):
+        """ Store the LLM results (result column -> value) of a representative (added to results stored before). """
+        with self._lock:
+            self._results.setdefault(sessionId, {}).update(results)
+
+    def count_member(self, sessionId, demoted=False):
+        """ Count a member when the results of its representative are copied to it (or when it is demoted). """
+        with self._lock:
+            kind = self._duplicate_kinds.pop(sessionId, None)
+            if kind is not None:
+                self.statistics["demoted_members" if demoted else kind] += 1
+
+    def results_of(self, sessionId):
+        """ Return the LLM results of a representative (None if it has not been analyzed yet). """
+        with self._lock:
+            return self._results.get(sessionId)
+
+
+def assign_representatives(index, transcripts, globalResultDF, analyses):
+    """
+    Add the column duplicateOf (sessionId of the representative, None for representatives) to the result DataFrame.
+    Members have the same relevance for the analyses (filters) as their representative. Filters on LLM
+    result columns cannot be evaluated yet, but they agree within a cluster anyway, because the members
+    receive all results of their representative.
+    """
+    relevant = [filter.relevance_mask(globalResultDF, transcripts, analysis.filters) for analysis in analyses]
+    token_lists = [normalized_tokens(transcript) for transcript in transcripts]
+    representatives = []
+    for position, (transcript, tokens, hash_value) in enumerate(zip(transcripts, token_lists, simhashes(token_lists))):
+        group = tuple(bool(mask[position]) for mask in relevant)
+        representatives.append(index.assign(transcript["conversation"]["sessionId"], tokens, hash_value, group))
+    globalResultDF[DUPLICATE_OF_COLUMN] = pd.Series(representatives, index=globalResultDF.index, dtype=object)
+
+
+def run_deduplicated(index, transcripts, globalResultDF, analyses, analyze):
+    """
+    Apply the LLM analyses only to the representatives (and to members whose representative has not
+    been analyzed yet, e.g. because its batch is still in progress) and copy the results of the
+    representatives to their members.
+
+    Args:
+        index (DuplicateIndex): Index of the run.
+        transcripts (list): Transcripts of the batch.
+        globalResultDF (pd.DataFrame): Result DataFrame of the batch with the column duplicateOf.
+        analyses (list): LLMAnalysis objects (for the result columns).
+        analyze (callable): Function applying the analyses to (transcripts, result DataFrame).
+    """
+    result_columns = [column for analysis in analyses for column in analysis.output_columns()]
+    duplicate_of = globalResultDF[DUPLICATE_OF_COLUMN].tolist()
+
+    # representatives of earlier batches with stored results
+    representative_results = {}
+    for representative in set(sessionId for sessionId in duplicate_of if sessionId is not None):
+        results = index.results_of(representative)
+        if results is not None and all(column in results for column in result_columns):
+            representative_results[representative] = results
+
+    # analyze the representatives (of this batch) and the members without available results
+    batch_sessionIds = set(globalResultDF["sessionId"])
+    positions = []
+    for position, representative in enumerate(duplicate_of):
+        if representative is None:
+            positions.append(position)
+        elif representative not in representative_results and representative not in batch_sessionIds:
+            duplicate_of[position] = None
+            positions.append(position)
+            index.count_member(globalResultDF["sessionId"].iloc[position], demoted=True)
+
+    analyzedDF = globalResultDF.iloc[positions].reset_index(drop=True)
+    if positions:
+        analyze([transcripts[position] for position in positions], analyzedDF)
+        for _, row in analyzedDF.iterrows():
+            results = {column: row[column] for column in result_columns}
+            index.store_results(row["sessionId"], results)
+            representative_results[row["sessionId"]] = results
+
+    # fill the result columns: own results for the analyzed conversations, the representative's for the members
+    values = {column: [] for column in result_columns}
+    for position, sessionId in enumerate(globalResultDF["sessionId"]):
+        representative = duplicate_of[position]
+        if representative is not None:
+            index.count_member(sessionId)
+        results = representative_results[sessionId if representative is None else representative]
+        for column in result_columns:
+            values[column].append(results[column])
+
+    for column in result_columns:
+        globalResultDF[column] = values[column]
+    globalResultDF[DUPLICATE_OF_COLUMN] = pd.Series(duplicate_of, index=globalResultDF.index, dtype=object)
@@ -1,33 +1,119 @@
+import operator
+
+import numpy as np
 import pandas as pd
 
-def is_relevant_transcript(globalResultDF: pd.DataFrame, transcript: dict, filter_functions: list) -> bool:
+# comparison operators for declarative column filters
+COMPARISON_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+
+def vectorized_filter(mask_function):
     """
-    Filters the transcripts based on the provided criteria.
-    
+    Decorator attaching a vectorized predicate to a filter function.
+    The predicate evaluates the filter for all rows of the result DataFrame at once.
+
     Args:
-        df_transcript_row (pd.Series): A row from the DataFrame containing transcript metadata.
-        filter_functions (list): List of filter functions to apply.
+        mask_function (callable): Function returning a boolean Series for the result DataFrame.
+    """
+    def decorate(filter_function):
+        filter_function.mask = mask_function
+        return filter_function
+    return decorate
+
+
+def column_filter(column: str, comparison: str, value):
+    """
+    Create a declarative filter comparing a column of the result DataFrame with a value,
+    e.g. column_filter("turnCount", ">=", 3). Rows without the column are excluded.
 
     Returns:
-        bool: True if the transcript is relevant, False otherwise.
+        callable: Filter function (evaluated vectorized by relevance_mask).
     """
+    if comparison not in COMPARISON_OPERATORS:
+        raise ValueError(f"Unknown comparison {comparison}, use one of {list(COMPARISON_OPERATORS)}.")
+    compare = COMPARISON_OPERATORS[comparison]
+
+    def mask(globalResultDF: pd.DataFrame) -> pd.Series:
+        if column not in globalResultDF:
+            return pd.Series(False, index=globalResultDF.index)
+        return compare(globalResultDF[column], value).fillna(False).astype(bool)
+
+    @vectorized_filter(mask)
+    def filter_column(transcript: dict, df_transcript_row: pd.Series) -> bool:
+        return column in df_transcript_row and bool(compare(df_transcript_row[column], value))
+
+    filter_column.__name__ = f"filter_{column}_{comparison}_{value}"
+    return filter_column
+
+
+def _filter_mask(globalResultDF: pd.DataFrame, transcripts: list, filter_functions: list) -> np.ndarray:
+    """ Evaluate the filter functions for the transcripts (vectorized if possible, otherwise row by row). """
     if not isinstance(filter_functions, list):
         raise ValueError("filter_functions must be a list of functions.")
 
-    df_transcript_row = globalResultDF[globalResultDF["sessionId"] == transcript["conversation"]["sessionId"]].iloc[0]
-    if df_transcript_row.empty:
+    # indexed lookup of the (first) row of each transcript in the DataFrame
+    row_positions = pd.Series(np.arange(len(globalResultDF)), index=globalResultDF["sessionId"].to_numpy())
+    row_positions = row_positions[~row_positions.index.duplicated()]
+    positions = row_positions.reindex([transcript["conversation"]["sessionId"] for transcript in transcripts])
+    if positions.isna().any():
         raise ValueError("No matching transcript found.")
+    positions = positions.to_numpy(dtype=np.int64)
 
+    mask = np.ones(len(transcripts), dtype=bool)
     for func in filter_functions:
-        if not func(transcript, df_transcript_row):
-            return False
-    return True 
+        if hasattr(func, "mask"):
+            mask &= np.asarray(func.mask(globalResultDF), dtype=bool)[positions]
+        else:
+            # custom Python filter: only evaluated for transcripts not excluded yet
+            for index in np.flatnonzero(mask):
+                mask[index] = bool(func(transcripts[index], globalResultDF.iloc[positions[index]]))
+    return mask
 
 
+def relevance_mask(globalResultDF: pd.DataFrame, transcripts: list, filter_functions: list) -> np.ndarray:
+    """
+    Evaluates the filters for all transcripts of a batch into a boolean mask (in the order of the transcripts).
+    The mask reflects the current columns of the DataFrame, so filters on the results of an earlier
+    analysis have to be evaluated after that analysis (see analysisLoop.apply_llm_analyses).
+
+    Args:
+        globalResultDF (pd.DataFrame): The result DataFrame of the batch with the transcript metadata.
+        transcripts (list): The transcripts of the batch.
+        filter_functions (list): List of filter functions to apply.
+
+    Returns:
+        np.ndarray: True for the relevant transcripts.
+    """
+    return _filter_mask(globalResultDF, transcripts, filter_functions)
+
+
+def is_relevant_transcript(globalResultDF: pd.DataFrame, transcript: dict, filter_functions: list) -> bool:
+    """
+    Filters the transcripts based on the provided criteria.
+    For whole batches, relevance_mask is much faster.
+
+    Args:
+        df_transcript_row (pd.Series): A row from the DataFrame containing transcript metadata.
+        filter_functions (list): List of filter functions to apply.
+
+    Returns:
+        bool: True if the transcript is relevant, False otherwise.
+    """
+    return bool(_filter_mask(globalResultDF, [transcript], filter_functions)[0])
+
+
+@vectorized_filter(lambda globalResultDF: globalResultDF["maxUserWordCount"] > 0 if "maxUserWordCount" in globalResultDF else pd.Series(False, index=globalResultDF.index))
 def filter_no_user_utterance(transcript: dict, df_transcript_row: pd.Series) -> bool:
     """
     Filter function to exclude transcripts with no user utterances.
-    
+
     Args:
         df_transcript_row (pd.Series): A row from the DataFrame containing transcript metadata.
 
@@ -0,0 +1,255 @@
+""" Offline analysis with the Batch API.
+
+Instead of one request per transcript and analysis, all requests are written to a JSONL
+batch file, submitted as one batch job and the result file is parsed back through the
+Pydantic models of the analyses. Submitting and polling is done by a pluggable backend:
+OpenAIBatchBackend for the OpenAI/Azure Batch API and CannedResultBatchBackend, which serves
+prepared result files from a local directory (for tests and dry runs).
+"""
+import json
+import os
+import shutil
+import time
+
+from analyzer.conversation.basic_llm import llm_sources, load_prompt_template, prompt_messages, render_transcript
+from llm_client import llm_model
+import filter
+import run_metrics
+
+# separator between analysis name and sessionId in the custom_id of a batch request
+CUSTOM_ID_SEPARATOR = "::"
+
+# batch job states
+FINAL_BATCH_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def strict_json_schema(json_schema):
+    """ Convert a (flat) Pydantic model into a JSON schema for strict structured outputs. """
+    schema = json_schema.model_json_schema()
+    schema["additionalProperties"] = False
+    schema["required"] = list(schema.get("properties", {}).keys())
+    return schema
+
+
+def build_batch_request(custom_id, instructions, transcript_text, json_schema, endpoint="/v1/responses"):
+    """ 
+    Build one line of a batch file: a Responses API request with structured output.
+    The rendered prompt template and the transcript are separate messages (cacheable prompt prefix).
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": endpoint,
+        "body": {
+            "model": llm_model,
+            "input": prompt_messages(instructions, transcript_text),
+            "text": {
+                "format": {
+                    "type": "json_schema",
+                    "name": json_schema.__name__,
+                    "schema": strict_json_schema(json_schema),
+                    "strict": True
+                }
+            }
+        }
+    }
+
+
+def relevance_masks(transcripts, globalResultDF, analyses):
+    """
+    Return the relevance masks of the analyses by name. All requests of a batch are submitted
+    together, so the filters are evaluated once before any result exists.
+    """
+    return {analysis.name: filter.relevance_mask(globalResultDF, transcripts, analysis.filters) for analysis in analyses}
+
+
+def write_batch_requests(transcripts, globalResultDF, analyses, requests_file, endpoint="/v1/responses", relevant=None, append=False):
+    """
+    Write the requests of all (transcript, analysis) pairs into a JSONL batch file (or append them,
+    to collect several groups of transcripts and analyses in one batch job).
+    Transcripts excluded by the filters of an analysis are skipped (relevant: masks by analysis name, see relevance_masks).
+
+    Returns:
+        int: Number of requests written.
+    """
+    if relevant is None:
+        relevant = relevance_masks(transcripts, globalResultDF, analyses)
+    transcript_texts = {}
+    request_count = 0
+    with open(requests_file, 'a' if append else 'w', encoding='utf-8') as file:
+        for analysis in analyses:
+            prompt_template = load_prompt_template(analysis.prompt_file, data=analysis.data)
+            for transcript, is_relevant in zip(transcripts, relevant[analysis.name]):
+                if not is_relevant:
+                    continue
+                sessionId = transcript["conversation"]["sessionId"]
+                if sessionId not in transcript_texts:
+                    transcript_texts[sessionId] = render_transcript(transcript)
+                custom_id = f"{analysis.name}{CUSTOM_ID_SEPARATOR}{sessionId}"
+                request = build_batch_request(custom_id, prompt_template, transcript_texts[sessionId], analysis.json_schema, endpoint)
+                file.write(json.dumps(request, ensure_ascii=False) + "\n")
+                request_count += 1
+
+    print(f"Wrote {request_count} batch requests to {requests_file}.")
+    return request_count
+
+
+def output_text_of_response(response_body):
+    """ Return the text output of a Responses API response body (None for refusals or missing output). """
+    for item in response_body.get("output", []):
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content", []):
+            if content.get("type") == "output_text":
+                return content.get("text")
+    return None
+
+
+def parse_batch_results(results_file, analyses):
+    """
+    Parse a batch result file through the Pydantic models of the analyses.
+
+    Returns:
+        dict: Parsed results by (analysis name, sessionId). Failed requests are missing.
+    """
+    schemas = {analysis.name: analysis.json_schema for analysis in analyses}
+    results = {}
+    with open(results_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            analysis_name, _, sessionId = result.get("custom_id", "").partition(CUSTOM_ID_SEPARATOR)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200 or analysis_name not in schemas:
+                print(f"Batch request {result.get('custom_id')} failed: {result.get('error') or response.get('status_code')}")
+                run_metrics.count_error("batch_request_failed")
+                continue
+            output_text = output_text_of_response(response.get("body", {}))
+            try:
+                results[(analysis_name, sessionId)] = schemas[analysis_name].model_validate_json(output_text)
+            except (TypeError, ValueError) as e:
+                print(f"Error parsing batch result {result.get('custom_id')}: {e}")
+                run_metrics.count_error("batch_parse_error" if output_text is not None else "refusal")
+
+    return results
+
+
+def apply_batch_results(transcripts, globalResultDF, analyses, results, relevant=None):
+    """
+    Add the parsed batch results to the global result DataFrame (same columns as the online analysis).
+    Pass the relevance masks the requests were written with (see relevance_masks).
+    """
+    if relevant is None:
+        relevant = relevance_masks(transcripts, globalResultDF, analyses)
+    for analysis in analyses:
+        analysis_results = {column: [] for column in analysis.result_columns.values()}
+        for transcript, is_relevant in zip(transcripts, relevant[analysis.name]):
+            if not is_relevant:
+                for column in analysis.result_columns.values():
+                    analysis_results[column].append("No analysis")
+                continue
+            llm_result_json = results.get((analysis.name, transcript["conversation"]["sessionId"]))
+            for result_key, column in analysis.result_columns.items():
+                analysis_results[column].append(getattr(llm_result_json, result_key, "No result"))
+
+        for column, values in analysis_results.items():
+            globalResultDF[column] = values
+        if analysis.source_column is not None:
+            globalResultDF[analysis.source_column] = llm_sources(relevant[analysis.name])
+
+
+class OpenAIBatchBackend:
+    """ Submits batch files to the OpenAI (or Azure OpenAI) Batch API. """
+
+    def __init__(self, llm_api_client, endpoint="/v1/responses", completion_window="24h"):
+        self.llm_api_client = llm_api_client
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+
+    def submit(self, requests_file):
+        """ Upload the batch file and create the batch job. Returns the batch id. """
+        with open(requests_file, 'rb') as file:
+            batch_input_file = self.llm_api_client.files.create(file=file, purpose="batch")
+        batch = self.llm_api_client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint=self.endpoint,
+            completion_window=self.completion_window
+        )
+        return batch.id
+
+    def poll(self, batch_id):
+        """ Return the state of the batch job (e.g. "in_progress", "completed", "failed"). """
+        return self.llm_api_client.batches.retrieve(batch_id).status
+
+    def download_results(self, batch_id, results_file):
+        """ Download the results (and errors) of a completed batch job into one JSONL file. """
+        batch = self.llm_api_client.batches.retrieve(batch_id)
+        with open(results_file, 'w', encoding='utf-8') as file:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    content = self.llm_api_client.files.content(file_id).text
+                    file.write(content if content.endswith("\n") or not content else content + "\n")
+
+
+class CannedResultBatchBackend:
+    """
+    Local stand-in for the Batch API serving prepared result files.
+    A batch submitted from "<name>.jsonl" is completed once "<name>.results.jsonl" exists in the results directory.
+    The results directory may be the directory of the batch files, the canned result file then
+    already is the results file of run_batch.
+    """
+
+    def __init__(self, results_directory):
+        self.results_directory = results_directory
+
+    def submit(self, requests_file):
+        """ Return the name of the requests file as batch id. """
+        return os.path.splitext(os.path.basename(requests_file))[0]
+
+    def poll(self, batch_id):
+        """ Return "completed" if the canned result file exists, otherwise "in_progress". """
+        if os.path.exists(self._canned_results_file(batch_id)):
+            return "completed"
+        return "in_progress"
+
+    def download_results(self, batch_id, results_file):
+        """ Copy the canned result file (unless it already is the results file). """
+        canned_results_file = self._canned_results_file(batch_id)
+        if os.path.abspath(canned_results_file) != os.path.abspath(results_file):
+            shutil.copyfile(canned_results_file, results_file)
+
+    def _canned_results_file(self, batch_id):
+        return os.path.join(self.results_directory, f"{batch_id}.results.jsonl")
+
+
+def run_batch(backend, requests_file, results_file, poll_interval=60, timeout=None):
+    """
+    Submit a batch file, wait for the completion of the batch job and download its results.
+
+    Args:
+        backend: Batch backend (submit, poll and download_results).
+        requests_file (str): Path of the JSONL batch file.
+        results_file (str): Path where the results should be saved.
+        poll_interval (float): Seconds between two status checks.
+        timeout (float, optional): Maximum number of seconds to wait for the batch job.
+    Returns:
+        str: Path of the results file.
+    """
+    batch_id = backend.submit(requests_file)
+    print(f"Submitted batch job {batch_id} from {requests_file}.")
+
+    start_time = time.monotonic()
+    status = backend.poll(batch_id)
+    while status not in FINAL_BATCH_STATES:
+        if timeout is not None and time.monotonic() - start_time > timeout:
+            raise TimeoutError(f"Batch job {batch_id} not completed after {timeout} seconds (status {status}).")
+        time.sleep(poll_interval)
+        status = backend.poll(batch_id)
+
+    if status != "completed":
+        raise RuntimeError(f"Batch job {batch_id} ended with status {status}.")
+
+    backend.download_results(batch_id, results_file)
+    print(f"Batch job {batch_id} completed, results saved to {results_file}.")
+    return results_file
@@ -0,0 +1,140 @@
+""" Persistent, content-addressed cache for LLM responses.
+
+The responses are stored in a SQLite file, keyed by a hash of the model name, the rendered
+prompt, the transcript text and the JSON schema of the expected result. When the cache
+exceeds its maximum size, the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# module variable for the cache of the process (None = caching disabled)
+llm_cache = None
+
+
+def cache_key(model, prompt, transcript_text, json_schema=None):
+    """
+    Compute the content-addressed key of an LLM request.
+
+    Args:
+        model (str): Name of the LLM model (deployment).
+        prompt (str): The fully rendered prompt.
+        transcript_text (str): The transcript text appended to the prompt.
+        json_schema (type[BaseModel], optional): Pydantic model of the structured result.
+    Returns:
+        str: Hex digest identifying the request.
+    """
+    schema_json = json.dumps(json_schema.model_json_schema(), sort_keys=True) if json_schema is not None else ""
+    key_hash = hashlib.sha256()
+    for part in (model, prompt, transcript_text, schema_json):
+        # length-prefix the parts so that different splits cannot produce the same key
+        encoded = part.encode("utf-8")
+        key_hash.update(len(encoded).to_bytes(8, "big"))
+        key_hash.update(encoded)
+    return key_hash.hexdigest()
+
+
+class LLMResponseCache:
+    """ SQLite-based LLM response cache with size-based LRU eviction. Thread-safe. """
+
+    def __init__(self, database_file, max_size_bytes=1024 ** 3):
+        """
+        Args:
+            database_file (str): Path of the SQLite cache file (created if missing).
+            max_size_bytes (int): Maximum total size of the cached responses.
+        """
+        self.database_file = database_file
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        # running total of the sizes (the cache file is used by one process)
+        self._total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """ Return the cached response for the key or None (and count the hit or miss). """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """ Store a response in the cache and evict the least recently used entries if necessary. """
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            replaced = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()))
+            self._total_size += size - (replaced[0] if replaced is not None else 0)
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """ Delete the least recently used entries until the cache fits its maximum size. """
+        if self._total_size <= self.max_size_bytes:
+            return
+        evicted_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._total_size <= self.max_size_bytes:
+                break
+            evicted_keys.append((key,))
+            self._total_size -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+    def statistics(self):
+        """ Return the hit and miss counters and the size of the cache. """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            size = self._total_size
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "size_bytes": size}
+
+    def close(self):
+        """ Close the cache file. """
+        with self._lock:
+            self._connection.close()
+
+
+def init_llm_cache(path, max_size_bytes=None):
+    """
+    Initialize the LLM response cache of the process in the given path.
+    The maximum size can also be configured with the environment variable LLM_CACHE_MAX_BYTES.
+    """
+    global llm_cache
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Cannot create/access LLM cache in path {path}.")
+    if max_size_bytes is None:
+        max_size_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(1024 ** 3)))
+    llm_cache = LLMResponseCache(os.path.join(path, "llm_cache.db"), max_size_bytes)
+    return llm_cache
+
+
+def report_cache_statistics():
+    """ Print the hit and miss counters of the LLM response cache. """
+    if llm_cache is None:
+        return
+    stats = llm_cache.statistics()
+    requests = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / requests if requests else 0.0
+    print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {hit_rate:.1%}), "
+          f"{stats['entries']} entries with {stats['size_bytes'] / 1024 ** 2:.1f} MB in {llm_cache.database_file}")
@@ -1,34 +1,128 @@
 import os
+import threading
+
+from llm_scheduler import LLMScheduler
 
 llm_client = None
 llm_model = os.getenv("OPENAI_MODEL_NAME", "gpt-4.1-mini")
 
-def get_llm_client():
-    """ Returns the LLM connection object. """    
-    global llm_client
-    # connection already established?
-    if llm_client is not None:
-        return llm_client
-    print(f"Creating new LLM client based on model {llm_model}...") # debug
+# clients of explicitly selected backends (one per backend and process)
+llm_clients = {}
+_llm_client_lock = threading.Lock()
+
+llm_scheduler = None
+_llm_scheduler_lock = threading.Lock()
+
+
+def _http_client():
+    """ Return a pooled HTTP client sized with LLM_MAX_CONNECTIONS (None = default pool of the openai package). """
+    max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "0"))
+    if not max_connections:
+        return None
+    import httpx
+    from openai import DefaultHttpxClient
+    return DefaultHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+
+def create_azure_client():
+    """ Create a client for the Azure OpenAI Responses API. """
+    # We now using the new Azure OpenAI Responses API (July 2025 in preview)
+    # This API allows us to parse the response directly into a JSON object.
+    # See https://learn.microsoft.com/en-us/azure/ai-foundry/openai/how-to/responses?tabs=python-secure
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        base_url=os.getenv("AZURE_OPENAI_ENDPOINT", "") + "/openai/v1/",
+        default_query={"api-version": "preview"},
+        max_retries=0,  # retries are handled by the LLM scheduler
+        http_client=_http_client()
+    )
+
+
+def create_openai_client():
+    """ Create a client for the OpenAI API (or a compatible server with OPENAI_BASE_URL). """
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0, http_client=_http_client())  # retries are handled by the LLM scheduler
+
+
+# registry of the LLM backends: name -> function creating the client
+llm_backends = {
+    "azure": create_azure_client,
+    "openai": create_openai_client,
+}
 
-    # Azure connection? 
-    if (os.getenv("AZURE_OPENAI_API_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT")):
 
-        # We now using the new Azure OpenAI Responses API (July 2025 in preview)
-        # This API allows us to parse the response directly into a JSON object.
-        # See https://learn.microsoft.com/en-us/azure/ai-foundry/openai/how-to/responses?tabs=python-secure 
-        from openai import OpenAI
-        return OpenAI( 
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            base_url=os.getenv("AZURE_OPENAI_ENDPOINT", "") + "/openai/v1/",
-            default_query={"api-version": "preview"}
-        )
+def register_llm_backend(name, create_client):
+    """ Register an LLM backend (a function creating an OpenAI-compatible client). """
+    llm_backends[name] = create_client
 
+
+def default_llm_backend():
+    """ Return the backend selected with LLM_BACKEND or detected from the API keys in the environment. """
+    if os.getenv("LLM_BACKEND"):
+        return os.getenv("LLM_BACKEND")
+    # Azure connection?
+    if (os.getenv("AZURE_OPENAI_API_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT")):
+        return "azure"
     # OpenAI connection?
     elif (os.getenv("OPENAI_API_KEY")):
-        from openai import OpenAI
-        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return "openai"
     else:
         raise ValueError("No valid OpenAI API key or Azure OpenAI API key found in environment variables.")
 
 
+def get_llm_client(backend=None):
+    """
+    Returns the LLM connection object. The client (and its connection pool) is created once per
+    process and shared by all threads.
+
+    Args:
+        backend (str, optional): Name of a registered backend (default: see default_llm_backend).
+    """
+    global llm_client
+    with _llm_client_lock:
+        if backend is None:
+            # connection already established?
+            if llm_client is None:
+                backend = default_llm_backend()
+                print(f"Creating new LLM client for backend {backend} based on model {llm_model}...") # debug
+                llm_client = _create_client(backend)
+            return llm_client
+
+        if backend not in llm_clients:
+            print(f"Creating new LLM client for backend {backend} based on model {llm_model}...") # debug
+            llm_clients[backend] = _create_client(backend)
+        return llm_clients[backend]
+
+
+def _create_client(backend):
+    if backend not in llm_backends:
+        raise ValueError(f"Unknown LLM backend {backend}, registered backends: {list(llm_backends)}.")
+    return llm_backends[backend]()
+
+
+def get_llm_scheduler():
+    """
+    Returns the rate-limit-aware scheduler for all LLM requests of the process.
+    The budgets are configured with the environment variables LLM_REQUESTS_PER_MINUTE and
+    LLM_TOKENS_PER_MINUTE (unlimited if not set), the retries with LLM_MAX_RETRIES.
+    """
+    global llm_scheduler
+    with _llm_scheduler_lock:
+        if llm_scheduler is None:
+            llm_scheduler = LLMScheduler(
+                requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0")) or None,
+                tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "0")) or None,
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "6"))
+            )
+    return llm_scheduler
+
+
+def report_token_usage():
+    """ Print the token usage of the LLM requests, with the input tokens served from the prompt cache of the service. """
+    if llm_scheduler is None:
+        return
+    statistics = llm_scheduler.usage_statistics()
+    print(f"LLM token usage: {statistics['requests']} requests, {statistics['input_tokens']} input tokens "
+          f"({statistics['cached_input_tokens']} cached, {statistics['cached_input_ratio']:.1%}; {statistics['uncached_input_tokens']} uncached), "
+          f"{statistics['output_tokens']} output tokens")
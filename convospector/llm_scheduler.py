@@ -0,0 +1,241 @@
+""" Rate-limit-aware scheduling of LLM requests.
+
+The scheduler keeps the requests within a requests-per-minute and a tokens-per-minute budget
+and retries retryable errors (429, transient 5xx, connection problems) with jittered
+exponential backoff. A Retry-After header sent by the service is honoured and pauses all
+requests of the process, not only the one that was throttled.
+"""
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+import run_metrics
+
+# HTTP status codes worth another attempt
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Names of client exceptions without status code which are worth another attempt (openai package)
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError"}
+
+# Length of the sliding window for the budgets in seconds
+WINDOW_SECONDS = 60.0
+
+def is_retryable_error(error):
+    """ Check whether the error of an LLM request is transient and the request should be retried. """
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def retry_after_seconds(error):
+    """ Return the delay requested by the service with a Retry-After header (in seconds) or None. """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After may also be given as HTTP date
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+def used_tokens(response):
+    """ Return the total number of tokens reported in the usage of an LLM response or None. """
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def token_usage(response):
+    """
+    Return the input, cached input and output tokens reported in the usage of an LLM response
+    (Responses API: input_tokens_details, Chat Completions API: prompt_tokens_details) or None.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    input_tokens = getattr(usage, "input_tokens", None)
+    if input_tokens is not None:
+        details = getattr(usage, "input_tokens_details", None)
+        output_tokens = getattr(usage, "output_tokens", None)
+    else:
+        input_tokens = getattr(usage, "prompt_tokens", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        output_tokens = getattr(usage, "completion_tokens", None)
+    return {
+        "input_tokens": input_tokens or 0,
+        "cached_input_tokens": getattr(details, "cached_tokens", None) or 0,
+        "output_tokens": output_tokens or 0,
+    }
+
+
+class LLMScheduler:
+    """
+    Schedules LLM requests within a requests-per-minute and tokens-per-minute budget.
+    The scheduler is thread-safe and can be shared by all concurrent requests of a process.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+        """
+        Args:
+            requests_per_minute (int, optional): Maximum number of requests per minute (None = unlimited).
+            tokens_per_minute (int, optional): Maximum number of tokens per minute (None = unlimited).
+            max_retries (int): Maximum number of retries of a request with a retryable error.
+            base_delay (float): Base delay of the exponential backoff in seconds.
+            max_delay (float): Maximum delay between two attempts in seconds.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._condition = threading.Condition()
+        self._requests = deque()    # start times of the requests in the window
+        self._tokens = deque()      # [start time, tokens] of the requests in the window
+        self._token_sum = 0
+        self._paused_until = 0.0
+        self._usage = {"requests": 0, "input_tokens": 0, "cached_input_tokens": 0, "output_tokens": 0}
+
+    def _expire(self, now):
+        """ Remove the requests which are no longer in the sliding window. """
+        while self._requests and self._requests[0] <= now - WINDOW_SECONDS:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= now - WINDOW_SECONDS:
+            self._token_sum -= self._tokens.popleft()[1]
+
+    def _wait_time(self, now, tokens):
+        """ Return the time to wait until a request with the given number of tokens fits the budgets. """
+        wait = self._paused_until - now
+
+        if self.requests_per_minute and len(self._requests) >= self.requests_per_minute:
+            wait = max(wait, self._requests[0] + WINDOW_SECONDS - now)
+
+        if self.tokens_per_minute and self._tokens and self._token_sum + tokens > self.tokens_per_minute:
+            # wait until enough tokens have left the window (a single oversized request runs alone)
+            remaining = self._token_sum
+            for start, window_tokens in self._tokens:
+                remaining -= window_tokens
+                if remaining + tokens <= self.tokens_per_minute:
+                    break
+            wait = max(wait, start + WINDOW_SECONDS - now)
+
+        return wait
+
+    def _acquire(self, tokens):
+        """ Block until the request fits the budgets and record it in the window. """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    break
+                self._condition.wait(wait)
+
+            self._requests.append(now)
+            entry = [now, tokens]
+            self._tokens.append(entry)
+            self._token_sum += tokens
+            return entry
+
+    def _correct_tokens(self, entry, tokens):
+        """ Replace the estimated tokens of a recorded request with the tokens actually used. """
+        with self._condition:
+            # the entries are recorded in time order, so the entry is still in the window
+            # unless it is older than the oldest entry (no scan of the window)
+            if self._tokens and self._tokens[0][0] <= entry[0]:
+                self._token_sum += tokens - entry[1]
+            entry[1] = tokens
+            self._condition.notify_all()
+
+    def _pause(self, seconds):
+        """ Pause all requests for the given number of seconds. """
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _record_usage(self, response):
+        """ Add the token usage of a response to the statistics. """
+        usage = token_usage(response)
+        with self._condition:
+            self._usage["requests"] += 1
+            if usage is not None:
+                for name, tokens in usage.items():
+                    self._usage[name] += tokens
+
+    def usage_statistics(self):
+        """
+        Return the token usage of all requests: input tokens, of which cached (prompt prefix caching
+        of the service, billed at a discount), uncached input tokens and output tokens.
+        """
+        with self._condition:
+            statistics = dict(self._usage)
+        statistics["uncached_input_tokens"] = statistics["input_tokens"] - statistics["cached_input_tokens"]
+        statistics["cached_input_ratio"] = statistics["cached_input_tokens"] / statistics["input_tokens"] if statistics["input_tokens"] else 0.0
+        return statistics
+
+    def backoff_delay(self, attempt):
+        """ Return the jittered exponential backoff delay for the given retry attempt (full jitter). """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, request_func, estimated_tokens=0):
+        """
+        Execute an LLM request within the budgets and retry it on retryable errors.
+
+        Args:
+            request_func (callable): Function without arguments performing the request.
+            estimated_tokens (int): Estimated number of tokens (prompt and response) of the request.
+        Returns:
+            The response of the request.
+        Raises:
+            The error of the last attempt if the request is not retryable or the retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            entry = self._acquire(estimated_tokens)
+            start_time = time.perf_counter()
+            try:
+                response = request_func()
+            except Exception as error:
+                run_metrics.observe_llm_call(time.perf_counter() - start_time)
+                run_metrics.count_error(type(error).__name__)
+                if attempt >= self.max_retries or not is_retryable_error(error):
+                    raise
+                delay = retry_after_seconds(error)
+                if delay is not None:
+                    # honour the delay requested by the service for all requests
+                    delay = min(delay, self.max_delay) + random.uniform(0, self.base_delay)
+                    self._pause(delay)
+                else:
+                    delay = self.backoff_delay(attempt)
+                attempt += 1
+                print(f"Retryable LLM error ({type(error).__name__}), attempt {attempt} of {self.max_retries} in {delay:.1f}s: {error}")
+                time.sleep(delay)
+                continue
+
+            run_metrics.observe_llm_call(time.perf_counter() - start_time)
+            tokens = used_tokens(response)
+            if tokens is not None:
+                self._correct_tokens(entry, tokens)
+            self._record_usage(response)
+            return response
@@ -0,0 +1,203 @@
+""" Local models for a cheap first-pass classification on the CPU.
+
+A local classifier (a zero-shot NLI model over candidate labels, e.g. the category list, or a
+fine-tuned text classifier) labels the transcripts of a batch with batched inference. Predictions
+with a confidence of at least the threshold are used as result of the analysis, the other
+transcripts are escalated to the remote LLM (see FirstPass and apply_llm_prompt_for_JSON_result).
+
+The models run with the transformers package (runtime "pytorch") or with ONNX Runtime via the
+optimum package (runtime "onnx"). Both are optional dependencies and only imported when a local
+classifier is used:  pip install transformers torch  (or  pip install optimum[onnxruntime])
+"""
+import json
+import os
+import threading
+
+# registry of the local model runtimes: name -> function loading the model for a transformers pipeline
+local_model_runtimes = {}
+
+# loaded classifiers (one per model, labels and runtime in a process)
+local_classifiers = {}
+_local_classifiers_lock = threading.Lock()
+
+# hypothesis of the zero-shot classification (NLI), {} is replaced by the candidate label
+default_hypothesis_template = "The topic of this conversation is {}."
+
+
+def register_local_model_runtime(name, load_model):
+    """ Register a runtime (a function returning the model object or name for transformers.pipeline). """
+    local_model_runtimes[name] = load_model
+
+
+def _load_pytorch_model(model_name, task):
+    return model_name
+
+
+def _load_onnx_model(model_name, task):
+    try:
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+    except ImportError as e:
+        raise ImportError("The onnx runtime of local models requires the optimum package: pip install optimum[onnxruntime]") from e
+    # models without ONNX weights (e.g. from the hub) are exported on the fly
+    return ORTModelForSequenceClassification.from_pretrained(model_name, export=not os.path.exists(os.path.join(model_name, "model.onnx")))
+
+
+register_local_model_runtime("pytorch", _load_pytorch_model)
+register_local_model_runtime("onnx", _load_onnx_model)
+
+
+class LocalClassifier:
+    """ Text classifier running locally on the CPU with batched inference (thread-safe). """
+
+    def __init__(self, model_name, candidate_labels=None, runtime="pytorch", batch_size=16, hypothesis_template=default_hypothesis_template):
+        """
+        Args:
+            model_name (str): Name (Hugging Face hub) or path of the model.
+            candidate_labels (list, optional): Labels for a zero-shot classification (NLI model).
+                                               Without labels, the model is a fine-tuned text classifier with its own labels.
+            runtime (str): Registered runtime of the model ("pytorch" or "onnx").
+            batch_size (int): Number of texts per forward pass.
+            hypothesis_template (str): Hypothesis of the zero-shot classification.
+        """
+        if runtime not in local_model_runtimes:
+            raise ValueError(f"Unknown local model runtime {runtime}, registered runtimes: {list(local_model_runtimes)}.")
+        self.model_name = model_name
+        self.candidate_labels = list(candidate_labels) if candidate_labels else None
+        self.runtime = runtime
+        self.batch_size = batch_size
+        self.hypothesis_template = hypothesis_template
+        self._pipeline = None
+        self._lock = threading.Lock()
+
+    def _get_pipeline(self):
+        if self._pipeline is None:
+            try:
+                from transformers import AutoTokenizer, pipeline
+            except ImportError as e:
+                raise ImportError("Local models require the transformers package: pip install transformers torch") from e
+            task = "zero-shot-classification" if self.candidate_labels else "text-classification"
+            print(f"Loading local model {self.model_name} ({task}, runtime {self.runtime})...")
+            model = local_model_runtimes[self.runtime](self.model_name, task)
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self._pipeline = pipeline(task, model=model, tokenizer=tokenizer, device=-1)  # device -1 = CPU
+        return self._pipeline
+
+    def classify(self, texts):
+        """
+        Classify the texts in batches.
+
+        Returns:
+            list: (label, confidence) of each text.
+        """
+        if not texts:
+            return []
+        # the batches of the pipeline already use all cores, concurrent LLM stage workers wait for each other
+        with self._lock:
+            classifier = self._get_pipeline()
+            if self.candidate_labels:
+                predictions = classifier(texts, candidate_labels=self.candidate_labels, hypothesis_template=self.hypothesis_template,
+                                         batch_size=self.batch_size, truncation=True)
+                return [(prediction["labels"][0], prediction["scores"][0]) for prediction in predictions]
+
+            predictions = classifier(texts, batch_size=self.batch_size, truncation=True, top_k=1)
+            # top_k returns a list of predictions per text
+            predictions = [prediction[0] if isinstance(prediction, list) else prediction for prediction in predictions]
+            return [(prediction["label"], prediction["score"]) for prediction in predictions]
+
+
+def get_local_classifier(model_name, candidate_labels=None, runtime="pytorch", batch_size=16):
+    """ Return the local classifier for the model and labels (loaded once per process). """
+    key = (model_name, tuple(candidate_labels or ()), runtime, batch_size)
+    with _local_classifiers_lock:
+        if key not in local_classifiers:
+            local_classifiers[key] = LocalClassifier(model_name, candidate_labels, runtime, batch_size)
+        return local_classifiers[key]
+
+
+def category_labels(category_list):
+    """
+    Return the category names of a category list (content of the categories file): a JSON list of
+    names or of objects with a name, a JSON object with the categories as keys, or one category per line.
+    """
+    try:
+        categories = json.loads(category_list)
+    except ValueError:
+        return [line.strip(" -*\t") for line in category_list.splitlines() if line.strip(" -*\t")]
+
+    if isinstance(categories, dict):
+        # e.g. {"categories": [...]} or {category: description}
+        if len(categories) == 1 and isinstance(next(iter(categories.values())), list):
+            categories = next(iter(categories.values()))
+        else:
+            return [str(name) for name in categories]
+    labels = []
+    for category in categories:
+        if isinstance(category, dict):
+            name = category.get("name", category.get("category", category.get("topic")))
+            if name is not None:
+                labels.append(str(name))
+        else:
+            labels.append(str(category))
+    return labels
+
+
+def user_text(transcript):
+    """ Return the user utterances of a transcript (the input of the local classifiers). """
+    return "\n".join(utterance["content"] for utterance in transcript["conversation"]["utterances"] if utterance["role"] == "user")
+
+
+# values of the source column of an analysis with a first pass
+SOURCE_LOCAL_MODEL = "local model"
+SOURCE_LLM = "LLM"
+
+
+class FirstPass:
+    """
+    First-pass classification of an LLM analysis with a local classifier. Confident predictions
+    fill the label field of the analysis, the other transcripts are escalated to the LLM.
+    The source column of the analysis records whether the local model or the LLM produced the result.
+    """
+
+    def __init__(self, classifier, label_field, confidence_threshold=0.9, label_map=None):
+        """
+        Args:
+            classifier (LocalClassifier): Local classifier (or any object with classify(texts)).
+            label_field (str): Field of the JSON schema of the analysis filled with the predicted label.
+                               The other fields of locally classified transcripts are "No analysis".
+            confidence_threshold (float): Minimum confidence of a prediction used without the LLM.
+            label_map (dict, optional): Label of the classifier -> value of the label field.
+        """
+        self.classifier = classifier
+        self.label_field = label_field
+        self.confidence_threshold = confidence_threshold
+        self.label_map = label_map or {}
+        self._lock = threading.Lock()
+        self.statistics = {"classified": 0, "escalated": 0}
+
+    def identity(self):
+        """ Return the settings determining the local results (for the provenance of the results). """
+        return {
+            "model": getattr(self.classifier, "model_name", type(self.classifier).__name__),
+            "runtime": getattr(self.classifier, "runtime", None),
+            "candidate_labels": getattr(self.classifier, "candidate_labels", None),
+            "label_field": self.label_field,
+            "confidence_threshold": self.confidence_threshold,
+            "label_map": self.label_map,
+        }
+
+    def predict(self, transcripts):
+        """
+        Classify the transcripts locally.
+
+        Returns:
+            list: Value of the label field for confident predictions, None for transcripts to escalate.
+        """
+        labels = []
+        for label, confidence in self.classifier.classify([user_text(transcript) for transcript in transcripts]):
+            labels.append(self.label_map.get(label, label) if confidence >= self.confidence_threshold else None)
+
+        classified = sum(label is not None for label in labels)
+        with self._lock:
+            self.statistics["classified"] += classified
+            self.statistics["escalated"] += len(labels) - classified
+        return labels
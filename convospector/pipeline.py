@@ -0,0 +1,120 @@
+""" Staged producer/consumer pipeline.
+
+Work items (e.g. batches of transcripts) flow through a sequence of stages which run in their
+own threads and are connected by bounded queues. While one stage waits (e.g. for the LLM),
+the other stages keep working on the next items. The bounded queues limit the number of items
+in flight, so the memory usage does not depend on the number of items produced by the source.
+"""
+import queue
+import threading
+
+# marker for the end of the work items
+_END_OF_ITEMS = object()
+
+# seconds between two checks of the stop flag while waiting for a queue
+_QUEUE_TIMEOUT = 0.5
+
+
+class PipelineStage:
+    """ A stage of the pipeline: a function applied to each work item by one or more worker threads. """
+
+    def __init__(self, name, function, workers=1):
+        """
+        Args:
+            name (str): Name of the stage (for messages).
+            function (callable): Function applied to each item, returns the item for the next stage.
+            workers (int): Number of worker threads (items may change their order if > 1).
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+def _put(target_queue, item, stop_event):
+    """ Put an item into a bounded queue unless the pipeline has been stopped. """
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=_QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(source_queue, stop_event):
+    """ Get the next item from a queue, returns _END_OF_ITEMS if the pipeline has been stopped. """
+    while not stop_event.is_set():
+        try:
+            return source_queue.get(timeout=_QUEUE_TIMEOUT)
+        except queue.Empty:
+            continue
+    return _END_OF_ITEMS
+
+
+def run_pipeline(source, stages, queue_size=2):
+    """
+    Run the work items of the source through the stages.
+
+    Args:
+        source (iterable): Produces the work items (consumed lazily).
+        stages (list[PipelineStage]): The stages in processing order. The result of the last stage is discarded.
+        queue_size (int): Maximum number of items waiting in front of each stage.
+    Raises:
+        The first error raised by the source or a stage (the pipeline is stopped).
+    """
+    stop_event = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def fail(stage_name, error):
+        print(f"Pipeline stage {stage_name} failed: {error}")
+        errors.append(error)
+        stop_event.set()
+
+    def produce():
+        try:
+            for item in source:
+                if not _put(queues[0], item, stop_event):
+                    return
+        except Exception as error:
+            fail("source", error)
+        finally:
+            _put(queues[0], _END_OF_ITEMS, stop_event)
+
+    def work(index, stage, active_workers):
+        input_queue = queues[index]
+        output_queue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = _get(input_queue, stop_event)
+            if item is _END_OF_ITEMS:
+                with active_workers["lock"]:
+                    active_workers["count"] -= 1
+                    last_worker = active_workers["count"] == 0
+                if last_worker:
+                    if output_queue is not None:
+                        _put(output_queue, _END_OF_ITEMS, stop_event)
+                else:
+                    # let the other workers of the stage see the end as well
+                    _put(input_queue, _END_OF_ITEMS, stop_event)
+                return
+            try:
+                result = stage.function(item)
+            except Exception as error:
+                fail(stage.name, error)
+                continue
+            if output_queue is not None:
+                _put(output_queue, result, stop_event)
+
+    threads = [threading.Thread(target=produce, name="pipeline-source", daemon=True)]
+    for index, stage in enumerate(stages):
+        active_workers = {"count": stage.workers, "lock": threading.Lock()}
+        for worker in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(index, stage, active_workers), name=f"pipeline-{stage.name}-{worker}", daemon=True))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,152 @@
+""" Transactional progress tracking of the processed transcript files.
+
+The progress is tracked in the table processed_files of the result database (path, mtime, size,
+content hash and status). The result rows of a batch and its progress records are written in
+one transaction, so a crash can neither lose a batch nor produce duplicate rows. Pending files
+are selected with an indexed join instead of comparing lists in Python.
+"""
+from datetime import datetime
+import hashlib
+import os
+
+from sqlalchemy import bindparam, text
+
+# status of a transcript file that has been analyzed
+STATUS_DONE = "done"
+# status of a transcript file that could not be read (retried only after the file has changed)
+STATUS_INVALID = "invalid"
+
+# number of rows per executemany when loading the current file list
+_INSERT_CHUNK_SIZE = 10000
+
+
+def file_fingerprint(file_path, status=STATUS_DONE):
+    """ Return the progress record of a transcript file (path, mtime, size, SHA-256 content hash, status). """
+    stat = os.stat(file_path)
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            content_hash.update(chunk)
+    return {"path": file_path, "mtime": stat.st_mtime, "size": stat.st_size, "content_hash": content_hash.hexdigest(), "status": status}
+
+
+def init_progress_tracking(database_engine, legacy_log_file=None):
+    """
+    Create the progress table (if necessary). The files of a processedFiles.log from earlier
+    runs are imported once as processed.
+    """
+    with database_engine.begin() as connection:
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS processed_files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                content_hash TEXT,
+                status TEXT NOT NULL,
+                processed_at TEXT
+            )"""))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_processed_files_status ON processed_files (status)"))
+
+        if legacy_log_file and os.path.exists(legacy_log_file):
+            if connection.execute(text("SELECT COUNT(*) FROM processed_files")).scalar() == 0:
+                with open(legacy_log_file, 'r', encoding='utf-8') as file:
+                    legacy_files = {line.strip() for line in file if line.strip()}
+                records = []
+                for file_path in legacy_files:
+                    if os.path.exists(file_path):
+                        stat = os.stat(file_path)
+                        records.append({"path": file_path, "mtime": stat.st_mtime, "size": stat.st_size, "content_hash": None, "status": STATUS_DONE})
+                if records:
+                    mark_processed(connection, records)
+                print(f"Imported {len(records)} processed files from {legacy_log_file}.")
+
+
+def select_pending_files(database_engine, transcript_files):
+    """
+    Return the transcript files which have not been processed yet or have changed since.
+    Files with a changed mtime but unchanged content are not processed again. Files which
+    cannot be accessed (e.g. deleted since the file list was compiled) are skipped.
+    """
+    pending_files = []
+    with database_engine.begin() as connection:
+        connection.execute(text("CREATE TEMP TABLE IF NOT EXISTS current_files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)"))
+        connection.execute(text("DELETE FROM current_files"))
+        for start in range(0, len(transcript_files), _INSERT_CHUNK_SIZE):
+            rows = []
+            for file_path in transcript_files[start:start + _INSERT_CHUNK_SIZE]:
+                try:
+                    stat = os.stat(file_path)
+                except OSError as e:
+                    print(f"Skipping transcript file {file_path}: {e}")
+                    continue
+                rows.append({"path": file_path, "mtime": stat.st_mtime, "size": stat.st_size})
+            if rows:
+                connection.execute(text("INSERT OR REPLACE INTO current_files (path, mtime, size) VALUES (:path, :mtime, :size)"), rows)
+
+        candidates = connection.execute(text("""
+            SELECT c.path, c.mtime, p.content_hash
+            FROM current_files c LEFT JOIN processed_files p ON p.path = c.path
+            WHERE p.path IS NULL OR p.mtime != c.mtime OR p.size != c.size
+            ORDER BY c.path""")).fetchall()
+
+        for file_path, mtime, previous_hash in candidates:
+            try:
+                unchanged = previous_hash is not None and file_fingerprint(file_path)["content_hash"] == previous_hash
+            except OSError as e:
+                print(f"Skipping transcript file {file_path}: {e}")
+                continue
+            if unchanged:
+                # only touched, the content is unchanged
+                connection.execute(text("UPDATE processed_files SET mtime = :mtime WHERE path = :path"), {"mtime": mtime, "path": file_path})
+            else:
+                pending_files.append(file_path)
+
+        connection.execute(text("DROP TABLE current_files"))
+
+    return pending_files
+
+
+def progress_record(record, status=STATUS_DONE):
+    """ Return the progress record of a transcript record of a source (see transcript_sources). """
+    return {"path": record["path"], "mtime": record["mtime"], "size": record["size"], "content_hash": record["content_hash"], "status": status}
+
+
+def filter_processed_records(database_engine, records):
+    """
+    Return the records which have not been processed yet or whose content has changed
+    (indexed lookup of the records of a batch, e.g. the conversations of a JSONL dump).
+    """
+    if not records:
+        return records
+    with database_engine.connect() as connection:
+        processed_hashes = dict(connection.execute(
+            text("SELECT path, content_hash FROM processed_files WHERE path IN :paths").bindparams(bindparam("paths", expanding=True)),
+            {"paths": [record["path"] for record in records]}).fetchall())
+    return [record for record in records if processed_hashes.get(record["path"], None) != record["content_hash"]]
+
+
+def merge_progress(connection, schema):
+    """ Upsert the progress records of an attached database (e.g. a shard) into the main database. """
+    if not connection.exec_driver_sql(f"PRAGMA {schema}.table_info(processed_files)").fetchall():
+        return 0
+    result = connection.exec_driver_sql(f"""
+        INSERT INTO main.processed_files (path, mtime, size, content_hash, status, processed_at)
+        SELECT path, mtime, size, content_hash, status, processed_at FROM {schema}.processed_files WHERE true
+        ON CONFLICT(path) DO UPDATE SET
+            mtime = excluded.mtime, size = excluded.size, content_hash = excluded.content_hash,
+            status = excluded.status, processed_at = excluded.processed_at""")
+    return result.rowcount
+
+
+def mark_processed(connection, progress_records):
+    """ Insert or update the progress records of transcript files (within the transaction of the result rows). """
+    if not progress_records:
+        return
+    processed_at = datetime.now().isoformat()
+    connection.execute(text("""
+        INSERT INTO processed_files (path, mtime, size, content_hash, status, processed_at)
+        VALUES (:path, :mtime, :size, :content_hash, :status, :processed_at)
+        ON CONFLICT(path) DO UPDATE SET
+            mtime = excluded.mtime, size = excluded.size, content_hash = excluded.content_hash,
+            status = excluded.status, processed_at = excluded.processed_at"""),
+        [dict(record, processed_at=processed_at) for record in progress_records])
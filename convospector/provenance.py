@@ -0,0 +1,348 @@
+""" Provenance of the LLM results for incremental re-analysis.
+
+For each (sessionId, analysis) the table analysis_provenance records the inputs the stored results
+were computed from: hashes of the effective prompt (the rendered prompt template, with the combined
+prompt of fused analyses), of the template data (e.g. the category list), of the JSON schema and
+result columns, of the settings changing the requests (fused analyses, transcript window), the model
+name and the hash of the transcript content. A run compares them with the current inputs and only
+recomputes the stale pairs, e.g. after editing one prompt only that analysis is applied again and
+only its result columns are updated.
+
+Results of a local first pass are recorded with the name of the local model ("local:<model>") and
+the settings of the first pass (e.g. its confidence threshold). They are current while the first
+pass is used with the same settings, otherwise they are escalated to the LLM again.
+
+Failed results ("No result") are recorded with the status "failed" and the source of the transcript
+(file path or dump line), so the next run reads only these transcripts again to retry them.
+Stale results whose transcript was not found when all processed transcripts were read again (e.g. a
+deleted transcript file) are marked "orphaned", so they do not cause every later run to read the
+processed transcripts again. They are recomputed when their transcript is analyzed again.
+Results stored before the provenance was tracked are adopted once as computed from the current inputs.
+"""
+from datetime import datetime
+import hashlib
+import json
+
+from sqlalchemy import bindparam, text
+
+from analyzer.conversation.basic import transcript_to_pseudo_xml
+from analyzer.conversation import basic_llm
+import local_model
+from result_store import RESULT_TABLE, quote_identifier
+
+# Name of the provenance table
+PROVENANCE_TABLE = "analysis_provenance"
+
+# Inputs of an analysis compared with the provenance records
+FINGERPRINT_FIELDS = ("prompt_hash", "data_hash", "schema_hash", "model", "settings_hash")
+
+# Columns of the provenance table (columns added later are at the end)
+PROVENANCE_COLUMNS = ("sessionId", "analysis", "prompt_hash", "data_hash", "schema_hash", "model", "transcript_hash", "updated_at",
+                      "settings_hash", "status", "source")
+
+# Status of the provenance records (records of earlier versions without status are done)
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_ORPHANED = "orphaned"
+
+# Result value of a failed LLM request
+FAILED_RESULT = "No result"
+
+# number of rows per read when adopting the results of earlier runs
+_ADOPT_CHUNK_SIZE = 10000
+
+
+def _table_columns(connection, table):
+    return [row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({quote_identifier(table)})").fetchall()]
+
+
+def _sha256(text_value):
+    return hashlib.sha256(text_value.encode("utf-8")).hexdigest()
+
+
+def effective_prompt(analysis, fused=False):
+    """ Return the prompt the LLM receives for an analysis (with the combined prompt template of fused analyses). """
+    if fused:
+        return basic_llm.load_prompt_template(basic_llm.fused_prompt_file) + "\n" + basic_llm.fused_instructions(analysis)
+    return basic_llm.load_prompt_template(analysis.prompt_file, data=analysis.data)
+
+
+def analysis_fingerprint(analysis, model, fused=False):
+    """
+    Return the hashes of the inputs of an LLM analysis (effective prompt, template data, schema,
+    request settings) and the model name.
+    """
+    settings = {"fused": fused, "max_transcript_tokens": basic_llm.max_transcript_tokens}
+    return {
+        "prompt_hash": _sha256(effective_prompt(analysis, fused)),
+        "data_hash": _sha256(json.dumps(analysis.data, sort_keys=True, default=str)),
+        "schema_hash": _sha256(json.dumps({"schema": analysis.json_schema.model_json_schema(), "result_columns": analysis.result_columns}, sort_keys=True)),
+        "model": model,
+        "settings_hash": _sha256(json.dumps(settings, sort_keys=True)),
+    }
+
+
+def first_pass_fingerprint(analysis, fingerprint):
+    """ Return the fingerprint of the results of the local first pass of an analysis (see analysis_fingerprint). """
+    identity = analysis.first_pass.identity()
+    return dict(fingerprint,
+                model=f"local:{identity['model']}",
+                settings_hash=_sha256(json.dumps({"llm_settings_hash": fingerprint["settings_hash"], "first_pass": identity}, sort_keys=True, default=str)))
+
+
+def transcript_hash(transcript_text):
+    """ Return the hash of the transcript content (pseudo XML, as stored in the column transcript). """
+    return _sha256(transcript_text)
+
+
+class ProvenanceTracker:
+    """ Tracks the provenance of the LLM results of a run and selects the stale (transcript, analysis) pairs. """
+
+    def __init__(self, database_engine, llm_analyses, model, fused=False):
+        """
+        Create the provenance table (adopting the results of earlier runs) and compare the
+        stored provenance with the current inputs of the analyses.
+
+        Args:
+            database_engine: SQLAlchemy engine of the result database (with the result table).
+            llm_analyses (list): LLMAnalysis objects of the run.
+            model (str): Name of the LLM.
+            fused (bool): Whether the analyses are applied with combined requests.
+        """
+        self.database_engine = database_engine
+        self.llm_analyses = llm_analyses
+        self.fingerprints = {analysis.name: analysis_fingerprint(analysis, model, fused) for analysis in llm_analyses}
+        # fingerprints of the results of local first passes
+        self.first_pass_fingerprints = {analysis.name: first_pass_fingerprint(analysis, self.fingerprints[analysis.name])
+                                        for analysis in llm_analyses if analysis.first_pass is not None}
+        self.statistics = {"stale": 0, "current": 0, "unchanged_transcripts": 0}
+        init_provenance_table(database_engine, llm_analyses, self.fingerprints, self.first_pass_fingerprints)
+        self.stale_analysis_names = self._find_stale_analyses()
+        # stored results of analyses with stale inputs are only found by reading the processed transcripts again
+        self.reread_processed = bool(self.stale_analysis_names)
+        # sources of the transcripts with failed results (read again to retry them)
+        self.retry_sources = self._find_retry_sources()
+
+    def current_fingerprints(self, analysis_name):
+        """ Return the fingerprints of the current results of an analysis (LLM and local first pass). """
+        if analysis_name in self.first_pass_fingerprints:
+            return [self.fingerprints[analysis_name], self.first_pass_fingerprints[analysis_name]]
+        return [self.fingerprints[analysis_name]]
+
+    def _stale_results_query(self, analysis_name, columns):
+        """
+        Return the query selecting the stored results of an analysis which are not up to date (or
+        not recorded) and its parameters. Failed and orphaned results are not selected.
+        """
+        parameters = {"analysis": analysis_name}
+        matches = []
+        for index, fingerprint in enumerate(self.current_fingerprints(analysis_name)):
+            matches.append("(" + " AND ".join(f"p.{field} IS :{field}_{index}" for field in FINGERPRINT_FIELDS) + ")")
+            parameters.update({f"{field}_{index}": fingerprint[field] for field in FINGERPRINT_FIELDS})
+        query = (f"SELECT {columns} FROM {quote_identifier(RESULT_TABLE)} t "
+                 f"LEFT JOIN {PROVENANCE_TABLE} p ON p.sessionId = t.sessionId AND p.analysis = :analysis "
+                 f"WHERE p.sessionId IS NULL OR (p.status IS NOT '{STATUS_FAILED}' AND p.status IS NOT '{STATUS_ORPHANED}' AND NOT ({' OR '.join(matches)}))")
+        return query, parameters
+
+    def _find_stale_analyses(self):
+        """
+        Return the names of the analyses with stored results which are not up to date (or not recorded).
+        Failed results are retried by source (see retry_sources).
+        """
+        stale_analysis_names = []
+        with self.database_engine.connect() as connection:
+            for analysis in self.llm_analyses:
+                query, parameters = self._stale_results_query(analysis.name, "1")
+                if connection.execute(text(query + " LIMIT 1"), parameters).first() is not None:
+                    stale_analysis_names.append(analysis.name)
+        return stale_analysis_names
+
+    def mark_orphaned_results(self):
+        """
+        Mark the results which are still stale after all processed transcripts have been read again
+        as orphaned: their transcript is no longer among the transcript files of the run.
+
+        Returns:
+            int: Number of (transcript, analysis) pairs marked as orphaned.
+        """
+        orphaned = 0
+        with self.database_engine.begin() as connection:
+            for name in self.stale_analysis_names:
+                query, parameters = self._stale_results_query(name, f"t.sessionId, :analysis, '{STATUS_ORPHANED}', :updated_at")
+                result = connection.execute(text(
+                    f"INSERT INTO {PROVENANCE_TABLE} (sessionId, analysis, status, updated_at) {query} "
+                    f"ON CONFLICT(sessionId, analysis) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at"),
+                    dict(parameters, updated_at=datetime.now().isoformat()))
+                orphaned += result.rowcount
+        return orphaned
+
+    def _find_retry_sources(self):
+        """ Return the sources of the transcripts with failed results. """
+        with self.database_engine.connect() as connection:
+            rows = connection.execute(text(
+                f"SELECT DISTINCT source FROM {PROVENANCE_TABLE} WHERE status = :status AND source IS NOT NULL"), {"status": STATUS_FAILED}).fetchall()
+        return {row[0] for row in rows}
+
+    def stale_analyses(self, transcripts):
+        """
+        Return the names of the analyses to (re)compute for each transcript: analyses without
+        provenance record and analyses whose inputs or transcript content have changed.
+
+        Returns:
+            (list, list): Tuple of stale analysis names and the transcript hash of each transcript.
+        """
+        transcript_hashes = [transcript_hash(transcript_to_pseudo_xml(transcript)) for transcript in transcripts]
+        sessionIds = [transcript["conversation"]["sessionId"] for transcript in transcripts]
+        stored = {}
+        if sessionIds:
+            with self.database_engine.connect() as connection:
+                rows = connection.execute(text(
+                    f"SELECT sessionId, analysis, status, {', '.join(FINGERPRINT_FIELDS)}, transcript_hash FROM {PROVENANCE_TABLE} WHERE sessionId IN :sessionIds"
+                    ).bindparams(bindparam("sessionIds", expanding=True)), {"sessionIds": sessionIds}).fetchall()
+            for row in rows:
+                # failed and orphaned results are always recomputed
+                if row[2] not in (STATUS_FAILED, STATUS_ORPHANED):
+                    stored[(row[0], row[1])] = row[3:]
+
+        current = {analysis.name: [tuple(fingerprint[field] for field in FINGERPRINT_FIELDS) for fingerprint in self.current_fingerprints(analysis.name)]
+                   for analysis in self.llm_analyses}
+        stale = []
+        for sessionId, current_transcript_hash in zip(sessionIds, transcript_hashes):
+            stale_names = []
+            for analysis in self.llm_analyses:
+                stored_inputs = stored.get((sessionId, analysis.name))
+                if stored_inputs is None or stored_inputs[-1] != current_transcript_hash or tuple(stored_inputs[:-1]) not in current[analysis.name]:
+                    stale_names.append(analysis.name)
+            stale.append(tuple(stale_names))
+            self.statistics["stale"] += len(stale_names)
+            self.statistics["current"] += len(self.llm_analyses) - len(stale_names)
+        return stale, transcript_hashes
+
+    def provenance_records(self, resultDF, stale, transcript_hashes, sources=None):
+        """
+        Return the provenance records of the recomputed results of a batch with the sources of the
+        transcripts. Failed results are recorded with the status "failed", results of a local first
+        pass with its fingerprint.
+        """
+        analyses = {analysis.name: analysis for analysis in self.llm_analyses}
+        sources = sources if sources is not None else [None] * len(stale)
+        records = []
+        for position, (sessionId, stale_names) in enumerate(zip(resultDF["sessionId"], stale)):
+            for name in stale_names:
+                analysis = analyses[name]
+                failed = any(resultDF[column].iloc[position] == FAILED_RESULT for column in analysis.result_columns.values())
+                fingerprint = self.fingerprints[name]
+                if name in self.first_pass_fingerprints and resultDF[analysis.source_column].iloc[position] == local_model.SOURCE_LOCAL_MODEL:
+                    fingerprint = self.first_pass_fingerprints[name]
+                records.append(dict(fingerprint, sessionId=sessionId, analysis=name, transcript_hash=transcript_hashes[position],
+                                    status=STATUS_FAILED if failed else STATUS_DONE, source=sources[position]))
+        return records
+
+
+def init_provenance_table(database_engine, llm_analyses, fingerprints, first_pass_fingerprints=None):
+    """
+    Create the provenance table. When it is created for a result table with results of earlier
+    runs, these results are adopted as computed from the current inputs (the transcript hash is
+    computed from the stored transcript).
+    """
+    with database_engine.begin() as connection:
+        created = not _table_columns(connection, PROVENANCE_TABLE)
+        create_provenance_table(connection)
+        if created:
+            adopt_existing_results(connection, llm_analyses, fingerprints, first_pass_fingerprints)
+
+
+def create_provenance_table(connection, schema="main"):
+    """
+    Create the provenance table (if necessary) and add the columns missing in tables of earlier
+    versions. Records without these columns do not match the current inputs and are recomputed.
+    """
+    connection.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.{PROVENANCE_TABLE} (
+            sessionId TEXT NOT NULL,
+            analysis TEXT NOT NULL,
+            prompt_hash TEXT,
+            data_hash TEXT,
+            schema_hash TEXT,
+            model TEXT,
+            transcript_hash TEXT,
+            updated_at TEXT,
+            settings_hash TEXT,
+            PRIMARY KEY (sessionId, analysis)
+        )""")
+    existing_columns = [row[1] for row in connection.exec_driver_sql(f"PRAGMA {schema}.table_info({PROVENANCE_TABLE})").fetchall()]
+    for column in PROVENANCE_COLUMNS:
+        if column not in existing_columns:
+            connection.exec_driver_sql(f"ALTER TABLE {schema}.{PROVENANCE_TABLE} ADD COLUMN {column} TEXT")
+
+
+def adopt_existing_results(connection, llm_analyses, fingerprints, first_pass_fingerprints=None):
+    """
+    Record the provenance of the results in the result table (written without provenance tracking).
+    Results with the source column of a first pass set to the local model are adopted as local results.
+    """
+    first_pass_fingerprints = first_pass_fingerprints or {}
+    result_columns = _table_columns(connection, RESULT_TABLE)
+    if "transcript" not in result_columns:
+        return
+    adoptable_analyses = [analysis for analysis in llm_analyses if all(column in result_columns for column in analysis.result_columns.values())]
+    if not adoptable_analyses:
+        return
+
+    source_columns = {analysis.name: analysis.source_column for analysis in adoptable_analyses
+                      if analysis.name in first_pass_fingerprints and analysis.source_column in result_columns}
+    columns = ["sessionId", "transcript"] + [column for analysis in adoptable_analyses for column in analysis.result_columns.values()]
+    columns += [column for column in source_columns.values() if column not in columns]
+    cursor = connection.exec_driver_sql(f"SELECT {', '.join(quote_identifier(column) for column in columns)} FROM {quote_identifier(RESULT_TABLE)}")
+    adopted_records = 0
+    while True:
+        rows = cursor.fetchmany(_ADOPT_CHUNK_SIZE)
+        if not rows:
+            break
+        records = []
+        for row in rows:
+            values = dict(zip(columns, row))
+            if values["transcript"] is None:
+                continue
+            current_transcript_hash = transcript_hash(values["transcript"])
+            for analysis in adoptable_analyses:
+                if any(values[column] is None or values[column] == FAILED_RESULT for column in analysis.result_columns.values()):
+                    continue
+                fingerprint = fingerprints[analysis.name]
+                if analysis.name in source_columns and values[source_columns[analysis.name]] == local_model.SOURCE_LOCAL_MODEL:
+                    fingerprint = first_pass_fingerprints[analysis.name]
+                records.append(dict(fingerprint, sessionId=values["sessionId"], analysis=analysis.name, transcript_hash=current_transcript_hash,
+                                    status=STATUS_DONE, source=None))
+        record_provenance(connection, records)
+        adopted_records += len(records)
+    if adopted_records:
+        print(f"Adopted the provenance of {adopted_records} stored analysis results.")
+
+
+def merge_provenance(connection, schema):
+    """ Copy the provenance records of an attached database (e.g. a shard) into the main database. """
+    if not connection.exec_driver_sql(f"PRAGMA {schema}.table_info({PROVENANCE_TABLE})").fetchall():
+        return 0
+    create_provenance_table(connection)
+    create_provenance_table(connection, schema)
+    result = connection.exec_driver_sql(f"""
+        INSERT INTO main.{PROVENANCE_TABLE} ({', '.join(PROVENANCE_COLUMNS)})
+        SELECT {', '.join(PROVENANCE_COLUMNS)} FROM {schema}.{PROVENANCE_TABLE} WHERE true
+        ON CONFLICT(sessionId, analysis) DO UPDATE SET {_update_assignments()}""")
+    return result.rowcount
+
+
+def _update_assignments():
+    return ", ".join(f"{column} = excluded.{column}" for column in PROVENANCE_COLUMNS if column not in ("sessionId", "analysis"))
+
+
+def record_provenance(connection, provenance_records):
+    """ Insert or update provenance records (within the transaction of the result rows). """
+    if not provenance_records:
+        return
+    updated_at = datetime.now().isoformat()
+    connection.execute(text(f"""
+        INSERT INTO {PROVENANCE_TABLE} ({', '.join(PROVENANCE_COLUMNS)})
+        VALUES ({', '.join(':' + column for column in PROVENANCE_COLUMNS)})
+        ON CONFLICT(sessionId, analysis) DO UPDATE SET {_update_assignments()}"""),
+        [dict(record, updated_at=updated_at) for record in provenance_records])
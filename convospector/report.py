@@ -0,0 +1,196 @@
+""" Export of the final report from the result database.
+
+The rows of the transcripts table are streamed in chunks (ordered by the primary key sessionId)
+and written chunk by chunk, so the memory usage does not depend on the number of transcripts.
+Supported formats:
+- Parquet (compressed, requires pyarrow),
+- CSV (gzip-compressed if the file name ends with .gz),
+- Excel, split across several sheets if the rows exceed the sheet limit
+  (streamed by xlsxwriter in constant memory mode or by openpyxl in write-only mode).
+Heavy columns like the transcript can be excluded, and the columns can be restricted to selected analyses.
+"""
+import gzip
+
+import pandas as pd
+
+from result_store import BASE_COLUMNS, DEDUP_COLUMNS, RESULT_TABLE, quote_identifier
+
+# maximum number of rows of an Excel sheet (including the header row)
+EXCEL_MAX_ROWS = 1048576
+
+# report formats by file name suffix
+REPORT_FORMATS = {
+    ".parquet": "parquet",
+    ".csv": "csv",
+    ".csv.gz": "csv",
+    ".xlsx": "xlsx",
+}
+
+
+def report_format_of(output_path):
+    """ Return the report format for the suffix of the output path. """
+    for suffix, report_format in REPORT_FORMATS.items():
+        if output_path.endswith(suffix):
+            return report_format
+    raise ValueError(f"Unknown report format of {output_path}, use one of {list(REPORT_FORMATS)}.")
+
+
+def column_types(database_engine, table=RESULT_TABLE):
+    """ Return the columns of the result table with their declared SQL types. """
+    with database_engine.connect() as connection:
+        return {row[1]: row[2].upper() for row in connection.exec_driver_sql(f"PRAGMA table_info({quote_identifier(table)})").fetchall()}
+
+
+def select_report_columns(database_engine, analyses=None, exclude_columns=(), table=RESULT_TABLE):
+    """
+    Return the columns of the result table to include in the report.
+
+    Args:
+        analyses (list, optional): LLMAnalysis objects whose result columns are included (default: all columns).
+        exclude_columns (iterable): Columns to leave out (e.g. "transcript").
+    """
+    table_columns = list(column_types(database_engine, table))
+    if analyses is not None:
+        selected_columns = set(BASE_COLUMNS) | set(DEDUP_COLUMNS) | {column for analysis in analyses for column in analysis.output_columns()}
+        table_columns = [column for column in table_columns if column in selected_columns]
+    return [column for column in table_columns if column not in set(exclude_columns)]
+
+
+def iter_result_chunks(database_engine, columns, chunk_size=50000, table=RESULT_TABLE):
+    """ Yield the selected columns of the result table as DataFrames of at most chunk_size rows. """
+    column_list = ", ".join(quote_identifier(column) for column in columns)
+    query = f"SELECT {column_list} FROM {quote_identifier(table)} ORDER BY sessionId"
+    with database_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        yield from pd.read_sql_query(query, con=connection, chunksize=chunk_size)
+
+
+def write_parquet_report(chunks, output_path, sql_types, compression="zstd"):
+    """
+    Write the chunks into one Parquet file (one row group per chunk).
+    The schema is derived from the declared SQL types (column -> type), so all chunks share one schema.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("The Parquet report requires pyarrow (pip install pyarrow).")
+
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+    schema = pa.schema([(column, arrow_types.get(sql_type, pa.string())) for column, sql_type in sql_types.items()])
+
+    row_count = 0
+    with pq.ParquetWriter(output_path, schema, compression=compression) as writer:
+        for chunk in chunks:
+            # TEXT columns may hold numbers (e.g. columns added by older versions)
+            for field in schema:
+                if pa.types.is_string(field.type):
+                    chunk[field.name] = chunk[field.name].map(lambda value: value if value is None or isinstance(value, str) or pd.isna(value) else str(value))
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            row_count += len(chunk)
+    return row_count
+
+
+def write_csv_report(chunks, output_path):
+    """ Write the chunks into one CSV file (gzip-compressed for the suffix .gz). """
+    row_count = 0
+    opener = gzip.open if output_path.endswith(".gz") else open
+    with opener(output_path, 'wt', encoding='utf-8', newline='') as file:
+        for chunk in chunks:
+            chunk.to_csv(file, index=False, header=(row_count == 0))
+            row_count += len(chunk)
+    return row_count
+
+
+class _ExcelRowWriter:
+    """
+    Writes rows into the sheets of an Excel file in streaming mode: xlsxwriter in constant memory mode
+    if installed, otherwise openpyxl in write-only mode. (pandas.to_excel writes column by column,
+    which loses cells in constant memory mode.)
+    """
+
+    def __init__(self, output_path):
+        try:
+            import xlsxwriter
+            self.workbook = xlsxwriter.Workbook(output_path, {"constant_memory": True})
+            self.uses_xlsxwriter = True
+        except ImportError:
+            import openpyxl
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.uses_xlsxwriter = False
+        self.output_path = output_path
+        self.worksheet = None
+        self.row_index = 0
+
+    def add_sheet(self, sheet_name):
+        self.worksheet = self.workbook.add_worksheet(sheet_name) if self.uses_xlsxwriter else self.workbook.create_sheet(sheet_name)
+        self.row_index = 0
+
+    def write_row(self, values):
+        if self.uses_xlsxwriter:
+            self.worksheet.write_row(self.row_index, 0, values)
+        else:
+            self.worksheet.append(values)
+        self.row_index += 1
+
+    def close(self):
+        if self.uses_xlsxwriter:
+            self.workbook.close()
+        else:
+            self.workbook.save(self.output_path)
+
+
+def write_excel_report(chunks, output_path, max_rows_per_sheet=EXCEL_MAX_ROWS):
+    """
+    Write the chunks into an Excel file. When a sheet is full, the rows continue on the next sheet
+    ("results", "results 2", ...), each with its own header row.
+    """
+    excel_writer = _ExcelRowWriter(output_path)
+    row_count = 0
+    sheet_number = 0
+    try:
+        for chunk in chunks:
+            # plain Python values, empty cells for NULL/NaN
+            values = chunk.astype(object).where(chunk.notna(), None)
+            for row in values.itertuples(index=False, name=None):
+                if sheet_number == 0 or excel_writer.row_index >= max_rows_per_sheet:
+                    sheet_number += 1
+                    excel_writer.add_sheet("results" if sheet_number == 1 else f"results {sheet_number}")
+                    excel_writer.write_row(list(chunk.columns))
+                excel_writer.write_row(row)
+                row_count += 1
+        if sheet_number == 0:
+            excel_writer.add_sheet("results")
+    finally:
+        excel_writer.close()
+    return row_count
+
+
+def export_report(database_engine, output_path, report_format=None, analyses=None, exclude_columns=(), chunk_size=50000, parquet_compression="zstd"):
+    """
+    Stream the results from the database into a report file.
+
+    Args:
+        database_engine: SQLAlchemy database engine
+        output_path (str): Path of the report file.
+        report_format (str, optional): "parquet", "csv" or "xlsx" (default: by the suffix of output_path).
+        analyses (list, optional): LLMAnalysis objects whose result columns are included (default: all columns).
+        exclude_columns (iterable): Columns to leave out (e.g. "transcript").
+        chunk_size (int): Number of rows read from the database at once.
+    Returns:
+        int: Number of rows written.
+    """
+    report_format = report_format or report_format_of(output_path)
+    columns = select_report_columns(database_engine, analyses, exclude_columns)
+    chunks = iter_result_chunks(database_engine, columns, chunk_size)
+
+    if report_format == "parquet":
+        sql_types = column_types(database_engine)
+        row_count = write_parquet_report(chunks, output_path, {column: sql_types[column] for column in columns}, compression=parquet_compression)
+    elif report_format == "csv":
+        row_count = write_csv_report(chunks, output_path)
+    elif report_format == "xlsx":
+        row_count = write_excel_report(chunks, output_path)
+    else:
+        raise ValueError(f"Unknown report format {report_format}, use parquet, csv or xlsx.")
+    return row_count
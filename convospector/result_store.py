@@ -0,0 +1,150 @@
+""" Persistence of the analysis results in the transcripts table.
+
+The table has an explicitly declared schema keyed on sessionId: the deterministic metrics, one
+TEXT column per result column of the LLM analyses and the transcript itself. Columns of analyses
+added later are added to the table, and rows are upserted with bulk executemany statements, so
+re-running a single analysis only updates its own columns. Tables written by earlier versions
+(pandas to_sql without primary key) are migrated once.
+"""
+from sqlalchemy import event
+
+# Name of the result table
+RESULT_TABLE = "transcripts"
+
+# Declared columns of the result table (besides the result columns of the LLM analyses)
+BASE_COLUMNS = {
+    "sessionId": "TEXT PRIMARY KEY",
+    "turnCount": "INTEGER",
+    "maxUserWordCount": "INTEGER",
+    "userUtteranceCount": "INTEGER",
+    "botUtteranceCount": "INTEGER",
+    "totalWordCount": "INTEGER",
+    "meanUserWordCount": "REAL",
+    "userBotUtteranceRatio": "REAL",
+}
+
+# Columns declared when the transcripts are deduplicated (see analyzer.conversation.dedup)
+DEDUP_COLUMNS = {
+    "duplicateOf": "TEXT",
+}
+
+# Columns stored after the analysis columns
+TRAILING_COLUMNS = {
+    "transcript": "TEXT",
+}
+
+
+def quote_identifier(identifier):
+    """ Quote a column or table name for SQLite (result columns may contain blanks). """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def enable_write_ahead_log(database_engine, journal_mode="WAL"):
+    """ Use the write-ahead log for all connections of the engine (concurrent readers do not block the writer). """
+    @event.listens_for(database_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+def declared_columns(llm_analyses, deduplicate=False):
+    """ Return the declared columns (name -> SQL type) of the result table for the given LLM analyses (and deduplication). """
+    columns = dict(BASE_COLUMNS)
+    if deduplicate:
+        columns.update(DEDUP_COLUMNS)
+    for analysis in llm_analyses:
+        for column in analysis.output_columns():
+            columns.setdefault(column, "TEXT")
+    columns.update(TRAILING_COLUMNS)
+    return columns
+
+
+def _table_info(connection, table=RESULT_TABLE, schema="main"):
+    """ Return the columns of a table as {name: is primary key}. """
+    rows = connection.exec_driver_sql(f"PRAGMA {schema}.table_info({quote_identifier(table)})").fetchall()
+    return {row[1]: bool(row[5]) for row in rows}
+
+
+def _sql_type_of(values):
+    """ Return the SQL type for the values of a DataFrame column. """
+    if values.dtype.kind in "iub":
+        return "INTEGER"
+    if values.dtype.kind == "f":
+        return "REAL"
+    return "TEXT"
+
+
+def ensure_columns(connection, columns, table=RESULT_TABLE):
+    """ Add the missing columns (name -> SQL type) to the result table. """
+    existing_columns = _table_info(connection, table)
+    for column, sql_type in columns.items():
+        if column not in existing_columns:
+            connection.exec_driver_sql(f"ALTER TABLE {quote_identifier(table)} ADD COLUMN {quote_identifier(column)} {sql_type.replace('PRIMARY KEY', '').strip()}")
+
+
+def init_result_table(database_engine, llm_analyses, table=RESULT_TABLE, deduplicate=False):
+    """
+    Create the result table with the declared schema, add the columns of new analyses and
+    migrate a table written by earlier versions (without primary key, duplicate rows reduced to the last one).
+    The column duplicateOf is only declared with deduplication.
+    """
+    columns = declared_columns(llm_analyses, deduplicate)
+    with database_engine.begin() as connection:
+        existing_columns = _table_info(connection, table)
+        legacy_table = bool(existing_columns) and not existing_columns.get("sessionId", False)
+        if legacy_table:
+            connection.exec_driver_sql(f"ALTER TABLE {quote_identifier(table)} RENAME TO {quote_identifier(table + '_legacy')}")
+
+        column_definitions = ", ".join(f"{quote_identifier(column)} {sql_type}" for column, sql_type in columns.items())
+        connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({column_definitions})")
+        ensure_columns(connection, columns, table)
+
+        if legacy_table:
+            legacy_columns = list(_table_info(connection, table + "_legacy"))
+            ensure_columns(connection, {column: "TEXT" for column in legacy_columns}, table)
+            column_list = ", ".join(quote_identifier(column) for column in legacy_columns)
+            connection.exec_driver_sql(
+                f"INSERT OR REPLACE INTO {quote_identifier(table)} ({column_list}) "
+                f"SELECT {column_list} FROM {quote_identifier(table + '_legacy')} "
+                f"WHERE rowid IN (SELECT MAX(rowid) FROM {quote_identifier(table + '_legacy')} GROUP BY sessionId)")
+            connection.exec_driver_sql(f"DROP TABLE {quote_identifier(table + '_legacy')}")
+            print(f"Migrated the result table {table} to the declared schema with primary key sessionId.")
+
+
+def upsert_statement(columns, table=RESULT_TABLE):
+    """ Return the SQL statement inserting or updating the given columns of rows keyed on sessionId. """
+    column_list = ", ".join(quote_identifier(column) for column in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    updates = ", ".join(f"{quote_identifier(column)} = excluded.{quote_identifier(column)}" for column in columns if column != "sessionId")
+    conflict_action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    return f"INSERT INTO {quote_identifier(table)} ({column_list}) VALUES ({placeholders}) ON CONFLICT(sessionId) {conflict_action}"
+
+
+def upsert_results(connection, resultDF, columns=None, table=RESULT_TABLE):
+    """
+    Insert or update the rows of the result DataFrame with one executemany statement.
+    Only the given columns (default: all columns of the DataFrame) are written, other columns
+    of existing rows keep their values. Columns unknown to the table are added.
+
+    Args:
+        connection: SQLAlchemy connection (the caller controls the transaction).
+        resultDF (pd.DataFrame): Results with the column sessionId.
+        columns (list, optional): Columns to write.
+    Returns:
+        int: Number of upserted rows.
+    """
+    if len(resultDF) == 0:
+        return 0
+    columns = list(resultDF.columns) if columns is None else list(columns)
+    if "sessionId" not in columns:
+        columns.insert(0, "sessionId")
+    ensure_columns(connection, {column: _sql_type_of(resultDF[column]) for column in columns}, table)
+
+    # plain Python values for the database driver (NaN -> NULL)
+    valuesDF = resultDF[columns].astype(object)
+    valuesDF = valuesDF.where(valuesDF.notna(), None)
+    rows = [tuple(value.item() if hasattr(value, "item") else value for value in row) for row in valuesDF.itertuples(index=False, name=None)]
+    connection.exec_driver_sql(upsert_statement(columns, table), rows)
+    return len(rows)
@@ -0,0 +1,266 @@
+""" Instrumentation of analysis runs.
+
+Collects per-stage timers (read, basic metrics, each LLM analysis, persistence, report), the
+latency histogram of the LLM calls, errors and refusals by type, the number of analyzed
+transcripts and the percentiles of their length (utterances and words). At the end of a run the metrics are written as a JSON run summary and optionally
+as a Prometheus textfile (for the textfile collector of the node exporter).
+
+Stages can also be profiled with cProfile (one stats file per stage, e.g. for snakeviz). Python
+3.12+ allows only one active profiler per process, so only one stage is profiled at a time:
+stages starting while another stage is profiled run without profiler. The pipeline threads are
+named after their stages, so py-spy dumps can be attributed as well.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import json
+import math
+import os
+import pstats
+import threading
+import time
+
+import numpy as np
+
+# upper bounds (seconds) of the buckets of the LLM latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+# percentiles of the conversation lengths in the run summary
+CONVERSATION_LENGTH_PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+class RunMetrics:
+    """ Thread-safe collection of the metrics of one analysis run. """
+
+    def __init__(self, profile_path=None):
+        """
+        Args:
+            profile_path (str, optional): Directory for the cProfile stats of the stages (None = no profiling).
+        """
+        self.profile_path = profile_path
+        self.started_at = datetime.now()
+        self._start_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages = {}           # name -> {"seconds", "calls"}
+        self._latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self._latency_sum = 0.0
+        self._latency_count = 0
+        self._errors = {}           # type -> count
+        self._transcripts = 0
+        self._conversation_lengths = {"utterances": [], "words": []}  # arrays of the lengths per batch
+        self._profiles = {}         # (stage, thread id) -> cProfile.Profile
+        self._profile_lock = threading.Lock()   # held while a stage is profiled
+        self.skipped_profiles = 0   # stage calls not profiled (another stage was profiled)
+
+    @contextmanager
+    def stage_timer(self, name):
+        """
+        Measure the time spent in a stage (profiled with cProfile if a profile path is set and
+        no other stage is profiled at the moment).
+        """
+        profile = self._start_profile(name) if self.profile_path else None
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profile_lock.release()
+            seconds = time.perf_counter() - start_time
+            with self._lock:
+                stage = self._stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                stage["seconds"] += seconds
+                stage["calls"] += 1
+
+    def _start_profile(self, name):
+        """ Enable the profile of the stage, return None if another stage is profiled (or the profiler is not available). """
+        if not self._profile_lock.acquire(blocking=False):
+            with self._lock:
+                self.skipped_profiles += 1
+            return None
+        profile = self._stage_profile(name)
+        try:
+            profile.enable()
+        except ValueError as e:
+            # e.g. another profiling tool is active (Python 3.12+)
+            print(f"Warning: Stage {name} is not profiled: {e}")
+            self._profile_lock.release()
+            with self._lock:
+                self.skipped_profiles += 1
+            return None
+        return profile
+
+    def _stage_profile(self, name):
+        # cProfile only profiles the thread it is enabled in, so each worker thread gets its own profile
+        key = (name, threading.get_ident())
+        with self._lock:
+            if key not in self._profiles:
+                self._profiles[key] = cProfile.Profile()
+            return self._profiles[key]
+
+    def observe_llm_call(self, seconds):
+        """ Add the latency of an LLM call to the histogram. """
+        with self._lock:
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    self._latency_buckets[index] += 1
+                    break
+            self._latency_sum += seconds
+            self._latency_count += 1
+
+    def count_error(self, error_type):
+        """ Count an error (exception class name) or a refusal of the LLM. """
+        with self._lock:
+            self._errors[error_type] = self._errors.get(error_type, 0) + 1
+
+    def add_transcripts(self, count):
+        """ Count analyzed transcripts (for the throughput). """
+        with self._lock:
+            self._transcripts += count
+
+    def add_conversation_lengths(self, utterance_counts, word_counts):
+        """ Add the lengths (number of utterances and words) of the conversations of a batch. """
+        with self._lock:
+            self._conversation_lengths["utterances"].append(np.asarray(utterance_counts))
+            self._conversation_lengths["words"].append(np.asarray(word_counts))
+
+    def conversation_length_percentiles(self):
+        """ Return the percentiles of the conversation lengths by kind (utterances, words), {} without conversations. """
+        with self._lock:
+            lengths = {kind: np.concatenate(arrays) for kind, arrays in self._conversation_lengths.items() if arrays}
+        return {kind: {f"p{int(percentile * 100)}": float(np.quantile(values, percentile)) for percentile in CONVERSATION_LENGTH_PERCENTILES}
+                for kind, values in lengths.items() if len(values)}
+
+    def latency_quantile(self, quantile):
+        """ Estimate a quantile of the LLM latency from the histogram (upper bound of the bucket). """
+        with self._lock:
+            target = quantile * self._latency_count
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, self._latency_buckets):
+                cumulative += count
+                if count and cumulative >= target:
+                    return upper_bound
+        return None
+
+    def summary(self, token_usage=None):
+        """
+        Return the metrics of the run as dictionary.
+
+        Args:
+            token_usage (dict, optional): Token usage of the LLM requests (see LLMScheduler.usage_statistics).
+        """
+        wall_seconds = time.monotonic() - self._start_time
+        quantiles = {f"p{int(quantile * 100)}": self.latency_quantile(quantile) for quantile in (0.5, 0.9, 0.99)}
+        conversation_lengths = self.conversation_length_percentiles()
+        with self._lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "wall_seconds": wall_seconds,
+                "transcripts": self._transcripts,
+                "transcripts_per_second": self._transcripts / wall_seconds if wall_seconds > 0 else 0.0,
+                "conversation_length_percentiles": conversation_lengths,
+                "stages": {name: dict(stage, mean_seconds=stage["seconds"] / stage["calls"]) for name, stage in self._stages.items()},
+                "llm_calls": {
+                    "count": self._latency_count,
+                    "latency_seconds_sum": self._latency_sum,
+                    "latency_buckets": {("+Inf" if math.isinf(upper_bound) else str(upper_bound)): count for upper_bound, count in zip(LATENCY_BUCKETS, self._latency_buckets)},
+                    "latency_quantiles": {name: (None if value is None or math.isinf(value) else value) for name, value in quantiles.items()},
+                },
+                "errors": dict(self._errors),
+                "tokens": token_usage or {},
+            }
+
+    def write_json_summary(self, output_file, token_usage=None):
+        """ Write the run summary as JSON file. """
+        with open(output_file, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(token_usage), file, indent=2)
+        print(f"Run summary saved to {output_file}")
+
+    def write_prometheus_textfile(self, output_file, token_usage=None):
+        """ Write the metrics in the Prometheus text format (atomically, for the textfile collector). """
+        summary = self.summary(token_usage)
+        lines = [
+            "# TYPE convospector_transcripts_total counter",
+            f"convospector_transcripts_total {summary['transcripts']}",
+            "# TYPE convospector_transcripts_per_second gauge",
+            f"convospector_transcripts_per_second {summary['transcripts_per_second']}",
+            "# TYPE convospector_conversation_length gauge",
+        ]
+        lines += [f'convospector_conversation_length{{kind="{kind}",quantile="{int(name[1:]) / 100}"}} {value}'
+                  for kind, percentiles in summary["conversation_length_percentiles"].items() for name, value in percentiles.items()]
+        lines.append("# TYPE convospector_stage_seconds_total counter")
+        lines += [f'convospector_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}' for name, stage in summary["stages"].items()]
+        lines.append("# TYPE convospector_stage_calls_total counter")
+        lines += [f'convospector_stage_calls_total{{stage="{name}"}} {stage["calls"]}' for name, stage in summary["stages"].items()]
+
+        lines.append("# TYPE convospector_llm_latency_seconds histogram")
+        cumulative = 0
+        for upper_bound, count in summary["llm_calls"]["latency_buckets"].items():
+            cumulative += count
+            lines.append(f'convospector_llm_latency_seconds_bucket{{le="{upper_bound}"}} {cumulative}')
+        lines.append(f"convospector_llm_latency_seconds_sum {summary['llm_calls']['latency_seconds_sum']}")
+        lines.append(f"convospector_llm_latency_seconds_count {summary['llm_calls']['count']}")
+
+        lines.append("# TYPE convospector_llm_errors_total counter")
+        lines += [f'convospector_llm_errors_total{{type="{error_type}"}} {count}' for error_type, count in summary["errors"].items()]
+        lines.append("# TYPE convospector_llm_tokens_total counter")
+        lines += [f'convospector_llm_tokens_total{{kind="{kind}"}} {tokens}' for kind, tokens in summary["tokens"].items() if kind.endswith("_tokens")]
+
+        temporary_file = output_file + ".tmp"
+        with open(temporary_file, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_file, output_file)
+
+    def write_profiles(self):
+        """ Write the cProfile stats of each stage into <profile_path>/<stage>.prof. """
+        if not self.profile_path or not self._profiles:
+            return
+        os.makedirs(self.profile_path, exist_ok=True)
+        stage_names = {name for name, _ in self._profiles}
+        for stage_name in stage_names:
+            stats = None
+            for (name, _), profile in self._profiles.items():
+                if name != stage_name:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            stats.dump_stats(os.path.join(self.profile_path, f"{stage_name.replace(':', '-')}.prof"))
+        print(f"Stage profiles saved to {self.profile_path} ({self.skipped_profiles} stage calls not profiled while another stage was profiled)")
+
+
+# metrics of the current run (per process)
+run_metrics = RunMetrics()
+
+
+def reset_run_metrics(profile_path=None):
+    """ Start collecting the metrics of a new run. """
+    global run_metrics
+    run_metrics = RunMetrics(profile_path=profile_path)
+    return run_metrics
+
+
+def stage_timer(name):
+    """ Measure the time spent in a stage of the current run. """
+    return run_metrics.stage_timer(name)
+
+
+def observe_llm_call(seconds):
+    """ Add the latency of an LLM call to the current run. """
+    run_metrics.observe_llm_call(seconds)
+
+
+def count_error(error_type):
+    """ Count an error or refusal in the current run. """
+    run_metrics.count_error(error_type)
+
+
+def add_conversation_lengths(utterance_counts, word_counts):
+    """ Add the lengths of the conversations of a batch to the current run. """
+    run_metrics.add_conversation_lengths(utterance_counts, word_counts)
+
+
+def add_transcripts(count):
+    """ Count analyzed transcripts of the current run. """
+    run_metrics.add_transcripts(count)
@@ -0,0 +1,178 @@
+""" Sharded execution of the analysis over several processes or machines.
+
+The transcript files are partitioned deterministically by a hash of the sessionId (the
+transcript files are named after the sessionId). Each worker writes into its own shard
+directory below the result path (own results.db with its progress table), so there is never
+more than one writer per SQLite file, even on a shared NFS directory. The merge step copies
+the rows of all shards into the transcripts table of the main database, exactly one row per
+sessionId (upserted on the primary key) together with the provenance of the LLM results and the
+progress of the transcript files, and can be repeated safely after a crashed worker has been
+restarted. Only the shard directories of the current number of shards are merged; directories
+of earlier runs with another number of shards are ignored (their results were merged into the
+main database by those runs).
+
+When the number of shards changes, a new shard database is seeded from the main database with
+the progress of its transcript files and the results (and their provenance) of the transcript
+files named after their sessionId, so processed transcripts are not analyzed again. An unsharded
+run after a sharded one continues with the merged progress of the main database. The LLM
+response cache is kept per shard directory and starts empty for a new number of shards.
+"""
+import glob
+import hashlib
+import os
+import re
+
+from sqlalchemy import create_engine
+
+import progress
+from provenance import PROVENANCE_COLUMNS, PROVENANCE_TABLE, create_provenance_table, merge_provenance
+from result_store import RESULT_TABLE, ensure_columns, init_result_table, quote_identifier
+
+# name pattern of the shard directories below the result path
+SHARD_DIRECTORY_PATTERN = re.compile(r"^shard-(\d+)-of-(\d+)$")
+
+
+def shard_key(transcript_file):
+    """ 
+    Return the key used for sharding a transcript file (its sessionId, i.e. the file name without extension).
+    JSONL dumps are assigned to a shard as a whole.
+    """
+    return os.path.splitext(os.path.basename(transcript_file))[0]
+
+
+def shard_of(key, num_shards):
+    """ Return the shard of a key (stable across processes and machines, unlike hash()). """
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def select_shard(transcript_files, shard_index, num_shards):
+    """ Return the transcript files belonging to the given shard. """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is not in the range of {num_shards} shards.")
+    return [transcript_file for transcript_file in transcript_files if shard_of(shard_key(transcript_file), num_shards) == shard_index]
+
+
+def init_shard_result_path(result_path, shard_index, num_shards):
+    """ Create (if necessary) and return the result directory of a shard. """
+    shard_path = os.path.join(result_path, f"shard-{shard_index:03d}-of-{num_shards:03d}")
+    os.makedirs(shard_path, exist_ok=True)
+    return shard_path
+
+
+def find_shard_databases(result_path, num_shards):
+    """ Return the result databases of the shard directories of the given number of shards below the result path. """
+    shard_databases = []
+    for shard_path in sorted(glob.glob(os.path.join(result_path, "shard-*-of-*"))):
+        database_file = os.path.join(shard_path, "results.db")
+        match = SHARD_DIRECTORY_PATTERN.match(os.path.basename(shard_path))
+        if match and int(match.group(2)) == num_shards and os.path.exists(database_file):
+            shard_databases.append(database_file)
+    return shard_databases
+
+
+def seed_shard_database(shard_result_path, main_database_file, transcript_files):
+    """
+    Seed a new shard database from the main database: the progress of the transcript files of the
+    shard (also the conversations of its JSONL dumps) and the results with their provenance of the
+    transcript files named after their sessionId. Conversations of dumps without seeded results
+    are only analyzed again if the incremental re-analysis finds stale analyses.
+    Existing shard databases are left unchanged.
+
+    Returns:
+        int: Number of seeded progress records.
+    """
+    shard_database_file = os.path.join(shard_result_path, "results.db")
+    if os.path.exists(shard_database_file) or not os.path.exists(main_database_file):
+        return 0
+
+    database_engine = create_engine(f"sqlite:///{shard_database_file}")
+    init_result_table(database_engine, [])
+    progress.init_progress_tracking(database_engine)
+    seeded_records = 0
+    with database_engine.connect() as connection:
+        create_provenance_table(connection)
+        connection.exec_driver_sql("ATTACH DATABASE ? AS seed", (main_database_file,))
+        try:
+            connection.exec_driver_sql("CREATE TEMP TABLE shard_files (path TEXT PRIMARY KEY)")
+            connection.exec_driver_sql("CREATE TEMP TABLE shard_sessions (sessionId TEXT PRIMARY KEY)")
+            connection.exec_driver_sql("INSERT OR IGNORE INTO shard_files (path) VALUES (?)", [(transcript_file,) for transcript_file in transcript_files])
+            connection.exec_driver_sql("INSERT OR IGNORE INTO shard_sessions (sessionId) VALUES (?)", [(shard_key(transcript_file),) for transcript_file in transcript_files])
+
+            if _table_columns(connection, "seed", "processed_files"):
+                # progress records of the files and of the conversations of the dumps (path#L<line>)
+                result = connection.exec_driver_sql(
+                    "INSERT OR IGNORE INTO main.processed_files SELECT * FROM seed.processed_files "
+                    "WHERE path IN (SELECT path FROM shard_files) "
+                    "OR (instr(path, '#L') > 0 AND substr(path, 1, instr(path, '#L') - 1) IN (SELECT path FROM shard_files))")
+                seeded_records = result.rowcount
+
+            seed_columns = _table_columns(connection, "seed", RESULT_TABLE)
+            if "sessionId" in seed_columns:
+                ensure_columns(connection, {column: "" for column in seed_columns}, RESULT_TABLE)
+                column_list = ", ".join(quote_identifier(column) for column in seed_columns)
+                connection.exec_driver_sql(
+                    f"INSERT OR IGNORE INTO main.{quote_identifier(RESULT_TABLE)} ({column_list}) "
+                    f"SELECT {column_list} FROM seed.{quote_identifier(RESULT_TABLE)} WHERE sessionId IN (SELECT sessionId FROM shard_sessions)")
+            if _table_columns(connection, "seed", PROVENANCE_TABLE):
+                create_provenance_table(connection, "seed")
+                column_list = ", ".join(PROVENANCE_COLUMNS)
+                connection.exec_driver_sql(
+                    f"INSERT OR IGNORE INTO main.{PROVENANCE_TABLE} ({column_list}) "
+                    f"SELECT {column_list} FROM seed.{PROVENANCE_TABLE} WHERE sessionId IN (SELECT sessionId FROM shard_sessions)")
+            connection.commit()
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql("DETACH DATABASE seed")
+    database_engine.dispose()
+    print(f"Seeded the shard database {shard_database_file} with {seeded_records} progress records from {main_database_file}.")
+    return seeded_records
+
+
+def _table_columns(connection, schema, table):
+    return [row[1] for row in connection.exec_driver_sql(f"PRAGMA {schema}.table_info({quote_identifier(table)})").fetchall()]
+
+
+def merge_shards(database_engine, result_path, num_shards, table=RESULT_TABLE):
+    """
+    Merge the result tables of the shards into the main database (see result_store.init_result_table).
+    The rows are upserted by sessionId, so transcripts re-analyzed in a shard replace their
+    previous results. Duplicates within a shard (e.g. from databases written before the
+    declared schema) are reduced to the last row. The progress of the transcript files is
+    merged in the same transaction.
+
+    Returns:
+        int: Number of merged rows.
+    """
+    merged_rows = 0
+    init_result_table(database_engine, [], table)
+    progress.init_progress_tracking(database_engine)
+    with database_engine.connect() as connection:
+        for database_file in find_shard_databases(result_path, num_shards):
+            connection.exec_driver_sql("ATTACH DATABASE ? AS shard", (database_file,))
+            try:
+                shard_columns = _table_columns(connection, "shard", table)
+                if not shard_columns:
+                    continue
+                # add columns of analyses which are missing in the main table
+                ensure_columns(connection, {column: "" for column in shard_columns}, table)
+
+                column_list = ", ".join(quote_identifier(column) for column in shard_columns)
+                updates = ", ".join(f"{quote_identifier(column)} = excluded.{quote_identifier(column)}" for column in shard_columns if column != "sessionId")
+                result = connection.exec_driver_sql(
+                    f"INSERT INTO main.{quote_identifier(table)} ({column_list}) "
+                    f"SELECT {column_list} FROM shard.{quote_identifier(table)} "
+                    f"WHERE rowid IN (SELECT MAX(rowid) FROM shard.{quote_identifier(table)} GROUP BY sessionId) "
+                    f"ON CONFLICT(sessionId) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"))
+                # provenance of the LLM results for the incremental re-analysis of the merged results
+                merge_provenance(connection, "shard")
+                # progress of the transcript files (seeds shard databases of another number of shards)
+                progress.merge_progress(connection, "shard")
+                connection.commit()
+                merged_rows += result.rowcount
+                print(f"Merged {result.rowcount} records from {database_file}.")
+            finally:
+                connection.rollback()
+                connection.exec_driver_sql("DETACH DATABASE shard")
+
+    return merged_rows
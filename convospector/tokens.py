@@ -0,0 +1,22 @@
+""" Token estimation for the token budgets of the LLM requests and the transcript windows. """
+
+# module variable for the (optional) tiktoken encoding, False if not available
+_token_encoding = None
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens of the given text.
+    Uses tiktoken if installed, otherwise a heuristic of about four characters per token.
+    """
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _token_encoding = False
+
+    if _token_encoding:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
@@ -0,0 +1,117 @@
+""" Streaming sources of transcripts.
+
+Transcripts are read lazily, one record at a time, from
+- directories with one JSON file per conversation,
+- JSONL/NDJSON dumps with one conversation per line (optionally gzip-compressed),
+  plain dumps are memory-mapped instead of being read into memory.
+
+A record holds the raw bytes of one conversation and its identity for the progress tracking.
+Records are only parsed (with orjson, if installed) and validated when their batch is processed,
+so the memory usage is bounded by the batches in the analysis pipeline, not by the size of the files.
+"""
+import gzip
+import hashlib
+import json
+import mmap
+import os
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# file name suffixes of the supported transcript files
+JSON_SUFFIXES = (".json",)
+JSONL_SUFFIXES = (".jsonl", ".ndjson", ".jsonl.gz", ".ndjson.gz")
+
+
+def is_transcript_file(file_name):
+    """ Check whether the file is a transcript file (single conversation JSON or JSONL dump). """
+    return file_name.endswith(JSON_SUFFIXES) or file_name.endswith(JSONL_SUFFIXES)
+
+
+def is_jsonl_file(file_name):
+    """ Check whether the file is a JSONL/NDJSON dump (optionally gzip-compressed). """
+    return file_name.endswith(JSONL_SUFFIXES)
+
+
+def validate_transcript(data):
+    """ Validate the structure of a transcript (conversation.utterances and conversation.sessionId). """
+    if not isinstance(data, dict) or "conversation" not in data or not isinstance(data["conversation"], dict) or "utterances" not in data["conversation"] or not isinstance(data["conversation"]["utterances"], list) or "sessionId" not in data["conversation"]:
+        raise ValueError("Invalid JSON structure in the transcript file.")
+    return data
+
+
+def parse_transcript(raw):
+    """ Parse and validate the raw JSON (bytes or str) of a transcript. """
+    return validate_transcript(_json_loads(raw))
+
+
+def _record(source_id, raw, mtime, from_dump):
+    """ Create a record with the progress information of a raw transcript. """
+    return {
+        "path": source_id,
+        "raw": raw,
+        "mtime": mtime,
+        "size": len(raw),
+        "content_hash": hashlib.sha256(raw).hexdigest(),
+        "from_dump": from_dump,
+    }
+
+
+def iter_file_records(file_paths):
+    """ Yield one record per transcript JSON file. """
+    for file_path in file_paths:
+        try:
+            with open(file_path, 'rb') as file:
+                raw = file.read()
+            mtime = os.stat(file_path).st_mtime
+        except OSError as e:
+            print(f"Error reading transcript file {file_path}: {e}")
+            continue
+        yield _record(file_path, raw, mtime, from_dump=False)
+
+
+def _iter_lines(file_path):
+    """ Yield the lines of a (gzip-compressed or memory-mapped) file. """
+    if file_path.endswith(".gz"):
+        with gzip.open(file_path, 'rb') as file:
+            yield from file
+        return
+
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            yield from iter(mapped_file.readline, b"")
+
+
+def iter_jsonl_records(file_path):
+    """ Yield one record per non-empty line of a JSONL dump. The record is identified by file and line number. """
+    mtime = os.stat(file_path).st_mtime
+    for line_number, line in enumerate(_iter_lines(file_path), start=1):
+        line = line.strip()
+        if line:
+            yield _record(f"{file_path}#L{line_number}", line, mtime, from_dump=True)
+
+
+def iter_transcript_records(file_paths):
+    """ Yield the records of all transcript files (JSON files and JSONL dumps) lazily. """
+    for file_path in file_paths:
+        if is_jsonl_file(file_path):
+            yield from iter_jsonl_records(file_path)
+        else:
+            yield from iter_file_records([file_path])
+
+
+def iter_batches(records, batch_size):
+    """ Group the records into lists of at most batch_size records (lazily). """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# the modules of convospector import each other relative to the convospector directory
+CONVOSPECTOR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "convospector")
+sys.path.insert(0, CONVOSPECTOR_PATH)
+# tools of the benchmarks (e.g. the mock LLM server)
+BENCHMARKS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+sys.path.append(BENCHMARKS_PATH)
+
+
+@pytest.fixture(autouse=True)
+def convospector_cwd(monkeypatch):
+    """ Run the tests in the convospector directory (prompt files are relative to it). """
+    monkeypatch.chdir(CONVOSPECTOR_PATH)
+
+
+def transcript(sessionId, user_text=None):
+    """ Return a transcript with a bot greeting and (optionally) one user utterance. """
+    utterances = [{"role": "bot", "content": "Hello, how can I help?"}]
+    if user_text:
+        utterances.append({"role": "user", "content": user_text})
+    return {"conversation": {"sessionId": sessionId, "utterances": utterances}}
+
+
+class CountingResponses:
+    """ Fake LLM client answering every structured request with a placeholder value per field. """
+
+    def __init__(self):
+        self.calls = 0
+        self.inputs = []
+
+    def parse(self, model, input, text_format, **kwargs):
+        self.calls += 1
+        self.inputs.append(input)
+        fields = {}
+        for name, field in text_format.model_fields.items():
+            if isinstance(field.annotation, type) and hasattr(field.annotation, "model_fields"):
+                fields[name] = {key: f"{name}.{key}" for key in field.annotation.model_fields}
+            else:
+                fields[name] = f"value {name}"
+        usage = types.SimpleNamespace(total_tokens=100, input_tokens=90, output_tokens=10, input_tokens_details=None)
+        return types.SimpleNamespace(output_parsed=text_format.model_validate(fields), usage=usage, output=[])
+
+
+@pytest.fixture
+def llm_responses():
+    """ Fake structured responses API of an LLM client counting the requests. """
+    return CountingResponses()
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch, llm_responses):
+    """ Transcript directory with 12 transcripts, an empty result directory and a fake LLM client for analysisLoop. """
+    import analysisLoop
+    import llm_cache
+    import llm_client
+    import transcript_sources
+
+    transcript_path = tmp_path / "transcripts"
+    result_path = tmp_path / "results"
+    transcript_path.mkdir()
+    result_path.mkdir()
+    for i in range(12):
+        utterances = [{"role": "bot", "content": "Hello, how can I help?"}, {"role": "user", "content": f"My meter reading number {i}"}]
+        (transcript_path / f"s{i:03d}.json").write_text(json.dumps({"conversation": {"sessionId": f"s{i:03d}", "utterances": utterances}}), encoding="utf-8")
+
+    monkeypatch.setattr(llm_client, "llm_client", types.SimpleNamespace(responses=llm_responses))
+    monkeypatch.setattr(llm_cache, "llm_cache", None)
+    monkeypatch.setattr(analysisLoop, "transcript_path", str(transcript_path))
+    monkeypatch.setattr(analysisLoop, "result_path", str(result_path))
+    monkeypatch.setattr(analysisLoop, "categories_file", None)
+    monkeypatch.setattr(analysisLoop, "local_first_pass_model", None)
+
+    # every transcript read by the read stage is parsed once
+    parse_transcript = transcript_sources.parse_transcript
+    reads = []
+    monkeypatch.setattr(transcript_sources, "parse_transcript", lambda raw: reads.append(raw) or parse_transcript(raw))
+    return types.SimpleNamespace(transcript_path=str(transcript_path), result_path=str(result_path), responses=llm_responses, reads=reads)
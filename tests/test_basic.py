@@ -0,0 +1,35 @@
+import math
+
+import pandas as pd
+
+import analyzer.conversation.basic as basic
+
+
+def conversation(sessionId, *utterances):
+    return {"conversation": {"sessionId": sessionId, "utterances": [{"role": role, "content": content} for role, content in utterances]}}
+
+
+def test_metrics_are_grouped_by_row():
+    transcripts = [
+        conversation("s1", ("bot", "Hello"), ("user", "my meter reading"), ("user", "please"), ("bot", "ok")),
+        conversation("empty"),
+        # same sessionId as the first transcript (e.g. a conversation exported twice with other content)
+        conversation("s1", ("user", "hi")),
+    ]
+    resultDF = pd.DataFrame({"sessionId": [t["conversation"]["sessionId"] for t in transcripts]})
+    basic.computeBasicMetrics(basic.transcripts_to_utterance_frame(transcripts), resultDF, True)
+
+    assert resultDF["turnCount"].tolist() == [3, 0, 1]
+    assert resultDF["userUtteranceCount"].tolist() == [2, 0, 1]
+    assert resultDF["botUtteranceCount"].tolist() == [2, 0, 0]
+    assert resultDF["totalWordCount"].tolist() == [6, 0, 1]
+    assert resultDF["maxUserWordCount"].tolist() == [3, 0, 1]
+    assert resultDF["meanUserWordCount"].iloc[0] == 2.0 and math.isnan(resultDF["meanUserWordCount"].iloc[1])
+    assert resultDF["userBotUtteranceRatio"].iloc[0] == 1.0 and math.isnan(resultDF["userBotUtteranceRatio"].iloc[2])
+
+    # the same turn counts as the loop over the transcripts
+    loopDF = pd.DataFrame({"sessionId": resultDF["sessionId"]})
+    basic.countTurnsInTranscripts(transcripts, loopDF, True)
+    basic.maxWordCountUserUtterances(transcripts, loopDF)
+    assert loopDF["turnCount"].tolist() == resultDF["turnCount"].tolist()
+    assert loopDF["maxUserWordCount"].tolist() == resultDF["maxUserWordCount"].tolist()
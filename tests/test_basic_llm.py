@@ -0,0 +1,18 @@
+import analyzer.conversation.basic_llm as basic_llm
+
+
+def test_separate_prompt_keeps_response_format():
+    prompt = basic_llm.load_prompt_template(basic_llm.get_sentiment_analysis().prompt_file)
+    assert "Respond in JSON format like so" in prompt
+    assert "## Conversation to be analyzed" in prompt
+    assert "{{" not in prompt
+
+
+def test_fused_prompt_embeds_only_the_instructions():
+    analyses = [basic_llm.get_categorization_analysis(), basic_llm.get_sentiment_analysis()]
+    tasks = [{"name": analysis.name, "instructions": basic_llm.fused_instructions(analysis)} for analysis in analyses]
+    prompt = basic_llm.load_prompt_template(basic_llm.fused_prompt_file, data={"tasks": tasks})
+    assert 'Task "categorization"' in prompt and 'Task "sentiment"' in prompt
+    assert "Respond in JSON format like so" not in prompt
+    # only the conversation section of the fused prompt
+    assert prompt.count("Conversation to be analyzed") == 1
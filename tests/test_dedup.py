@@ -0,0 +1,35 @@
+import pandas as pd
+
+import analyzer.conversation.basic_llm as basic_llm
+from analyzer.conversation import dedup
+from conftest import transcript
+
+
+def batch(index, transcripts, analyses):
+    resultDF = pd.DataFrame({"sessionId": [t["conversation"]["sessionId"] for t in transcripts], "maxUserWordCount": [3] * len(transcripts)})
+    dedup.assign_representatives(index, transcripts, resultDF, analyses)
+    return resultDF
+
+
+def analyze(analyzed_transcripts, analyzedDF):
+    analyzedDF["Sentiment"] = [f"sentiment of {t['conversation']['sessionId']}" for t in analyzed_transcripts]
+    analyzedDF["Reason"] = "reason"
+    analyzedDF["Characteristic utterance"] = "utterance"
+
+
+def test_duplicates_counted_when_results_are_copied():
+    analyses = [basic_llm.get_sentiment_analysis()]
+    index = dedup.DuplicateIndex()
+
+    # the representative of the second batch is assigned but not analyzed yet (e.g. concurrent batch)
+    pending = batch(index, [transcript("r1", "my meter reading please")], analyses)
+    transcripts = [transcript("r2", "cancel my contract now"), transcript("d2", "cancel my contract now"),
+                   transcript("d1", "my meter reading please")]
+    resultDF = batch(index, transcripts, analyses)
+    dedup.run_deduplicated(index, transcripts, resultDF, analyses, analyze)
+
+    assert resultDF[dedup.DUPLICATE_OF_COLUMN].tolist() == [None, "r2", None]
+    assert resultDF["Sentiment"].tolist() == ["sentiment of r2", "sentiment of r2", "sentiment of d1"]
+    assert index.statistics["exact_duplicates"] == 1
+    assert index.statistics["demoted_members"] == 1
+    assert pending[dedup.DUPLICATE_OF_COLUMN].tolist() == [None]
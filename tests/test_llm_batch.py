@@ -0,0 +1,62 @@
+import json
+
+import pandas as pd
+import pytest
+
+import analyzer.conversation.basic_llm as basic_llm
+import llm_batch
+from conftest import transcript
+
+
+def result_line(custom_id, status_code=200, output=None, error=None):
+    body = {"output": [{"type": "message", "content": output or []}]}
+    return {"custom_id": custom_id, "response": {"status_code": status_code, "body": body}, "error": error}
+
+
+def canned_result(request):
+    """ Result line of a batch request: success, failed request or refusal depending on the sessionId. """
+    custom_id = request["custom_id"]
+    sessionId = custom_id.partition(llm_batch.CUSTOM_ID_SEPARATOR)[2]
+    if sessionId == "failed":
+        return result_line(custom_id, status_code=500, error={"code": "server_error", "message": "Internal error"})
+    if sessionId == "refused":
+        return result_line(custom_id, output=[{"type": "refusal", "refusal": "I can't help with that."}])
+    properties = request["body"]["text"]["format"]["schema"]["properties"]
+    return result_line(custom_id, output=[{"type": "output_text", "text": json.dumps({name: f"batch {name}" for name in properties})}])
+
+
+@pytest.mark.parametrize("separate_results_directory", [False, True])
+def test_batch_round_trip_with_canned_results(tmp_path, separate_results_directory):
+    analyses = [basic_llm.get_categorization_analysis(), basic_llm.get_sentiment_analysis()]
+    transcripts = [transcript("ok", "My meter reading"), transcript("failed", "Billing question"),
+                   transcript("refused", "Something else"), transcript("bot-only")]
+    # the filters of the analyses use the basic metrics
+    resultDF = pd.DataFrame({"sessionId": [t["conversation"]["sessionId"] for t in transcripts], "maxUserWordCount": [3, 2, 2, 0]})
+
+    requests_file = tmp_path / "job.jsonl"
+    relevant = llm_batch.relevance_masks(transcripts, resultDF, analyses)
+    assert llm_batch.write_batch_requests(transcripts, resultDF, analyses, str(requests_file), relevant=relevant) == 6
+
+    # canned results next to the batch file (the results file itself) or in their own directory
+    results_directory = tmp_path / "canned" if separate_results_directory else tmp_path
+    results_directory.mkdir(exist_ok=True)
+    with open(requests_file, encoding="utf-8") as requests, open(results_directory / "job.results.jsonl", "w", encoding="utf-8") as results:
+        for line in requests:
+            results.write(json.dumps(canned_result(json.loads(line))) + "\n")
+
+    results_file = llm_batch.run_batch(llm_batch.CannedResultBatchBackend(str(results_directory)), str(requests_file),
+                                       str(tmp_path / "job.results.jsonl"), poll_interval=0)
+    batch_results = llm_batch.parse_batch_results(results_file, analyses)
+    assert set(batch_results) == {("categorization", "ok"), ("sentiment", "ok")}
+
+    llm_batch.apply_batch_results(transcripts, resultDF, analyses, batch_results, relevant=relevant)
+    assert resultDF["topic"].tolist() == ["batch topic", "No result", "No result", "No analysis"]
+    assert resultDF["Sentiment"].tolist() == ["batch sentiment_label", "No result", "No result", "No analysis"]
+
+
+def test_canned_batch_in_progress_until_results_exist(tmp_path):
+    backend = llm_batch.CannedResultBatchBackend(str(tmp_path))
+    batch_id = backend.submit(str(tmp_path / "job.jsonl"))
+    assert backend.poll(batch_id) == "in_progress"
+    (tmp_path / "job.results.jsonl").write_text("", encoding="utf-8")
+    assert backend.poll(batch_id) == "completed"
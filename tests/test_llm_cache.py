@@ -0,0 +1,42 @@
+import itertools
+
+import pytest
+
+import llm_cache
+from llm_cache import LLMResponseCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # strictly increasing access times (time.time() may repeat within a test)
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(llm_cache.time, "time", lambda: float(next(ticks)))
+
+
+def cached_keys(cache):
+    return sorted(row[0] for row in cache._connection.execute("SELECT key FROM responses"))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    database_file = str(tmp_path / "llm_cache.db")
+    cache = LLMResponseCache(database_file, max_size_bytes=100)
+    cache.put("a", "x" * 40)
+    cache.put("b", "x" * 40)
+    assert cache.get("a") == "x" * 40
+    # over the limit: b is the least recently used entry
+    cache.put("c", "x" * 40)
+    assert cached_keys(cache) == ["a", "c"]
+    assert cache.statistics()["size_bytes"] == 80
+
+    # replacing an entry only counts the difference
+    cache.put("a", "x" * 10)
+    assert cache.statistics()["size_bytes"] == 50
+    cache.close()
+
+    # the running total is restored from the cache file
+    cache = LLMResponseCache(database_file, max_size_bytes=100)
+    assert cache.statistics() == {"hits": 0, "misses": 0, "entries": 2, "size_bytes": 50}
+    cache.put("d", "x" * 60)
+    assert cached_keys(cache) == ["a", "d"]
+    assert cache.statistics()["size_bytes"] == 70
+    cache.close()
@@ -0,0 +1,147 @@
+import types
+
+import pandas as pd
+import pytest
+
+import analyzer.conversation.basic_llm as basic_llm
+import llm_cache
+import llm_scheduler
+from llm_scheduler import LLMScheduler
+
+
+class FakeClock:
+    """ Monotonic clock of the scheduler, advanced by the waits and sleeps instead of real time. """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_scheduler.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(llm_scheduler.time, "sleep", clock.sleep)
+    return clock
+
+
+def make_scheduler(clock, **kwargs):
+    scheduler = LLMScheduler(**kwargs)
+    # waiting for the budget advances the fake clock
+    scheduler._condition.wait = lambda timeout=None: clock.sleep(timeout)
+    return scheduler
+
+
+def response(total_tokens):
+    return types.SimpleNamespace(usage=types.SimpleNamespace(total_tokens=total_tokens, input_tokens=total_tokens, output_tokens=0, input_tokens_details=None))
+
+
+class RateLimitError(Exception):
+    """ Error of the client with status code and headers (like openai.RateLimitError). """
+
+    def __init__(self, headers=None):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.response = types.SimpleNamespace(headers=headers or {})
+
+
+def test_requests_per_minute_wait(clock):
+    scheduler = make_scheduler(clock, requests_per_minute=2)
+    start = clock.now
+    for _ in range(3):
+        scheduler.call(lambda: response(10))
+    # the third request waits until the first one has left the window
+    assert clock.now - start == pytest.approx(llm_scheduler.WINDOW_SECONDS)
+
+
+def test_tokens_per_minute_wait(clock):
+    scheduler = make_scheduler(clock, tokens_per_minute=100)
+    start = clock.now
+    scheduler.call(lambda: response(60), estimated_tokens=60)
+    scheduler.call(lambda: response(60), estimated_tokens=60)
+    assert clock.now - start == pytest.approx(llm_scheduler.WINDOW_SECONDS)
+
+
+def test_tokens_per_minute_uses_reported_tokens(clock):
+    scheduler = make_scheduler(clock, tokens_per_minute=100)
+    start = clock.now
+    # overestimated request: the tokens actually used make room for the next one
+    scheduler.call(lambda: response(10), estimated_tokens=90)
+    scheduler.call(lambda: response(60), estimated_tokens=60)
+    assert clock.now == start
+    assert scheduler._token_sum == 70
+
+
+def test_correct_tokens_of_expired_request(clock):
+    scheduler = make_scheduler(clock, tokens_per_minute=100)
+    entry = scheduler._acquire(50)
+    clock.now += llm_scheduler.WINDOW_SECONDS + 1
+    scheduler._acquire(20)
+    # the first request has left the window, its correction must not change the budget
+    scheduler._correct_tokens(entry, 80)
+    assert scheduler._token_sum == 20
+
+
+def test_retry_after_pauses_and_retries(clock):
+    scheduler = make_scheduler(clock, max_retries=3, base_delay=0.5)
+    attempts = []
+
+    def request():
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            raise RateLimitError({"retry-after": "2"})
+        return response(10)
+
+    scheduler.call(request)
+    assert len(attempts) == 2
+    assert 2.0 <= clock.sleeps[0] <= 2.5
+    assert scheduler._paused_until >= attempts[0] + 2.0
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "3"}, 3.0),
+    ({}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert llm_scheduler.retry_after_seconds(RateLimitError(headers)) == expected
+
+
+def test_retries_exhausted(clock):
+    scheduler = make_scheduler(clock, max_retries=2)
+    attempts = []
+
+    def request():
+        attempts.append(clock.now)
+        raise RateLimitError()
+
+    with pytest.raises(RateLimitError):
+        scheduler.call(request)
+    assert len(attempts) == 3
+
+
+def test_retries_exhausted_gives_no_result(clock, monkeypatch, tmp_path):
+    scheduler = make_scheduler(clock, max_retries=2)
+    monkeypatch.setattr(basic_llm, "get_llm_scheduler", lambda: scheduler)
+    monkeypatch.setattr(llm_cache, "llm_cache", None)
+
+    def parse(**kwargs):
+        raise RateLimitError()
+
+    client = types.SimpleNamespace(responses=types.SimpleNamespace(parse=parse))
+    prompt_file = tmp_path / "prompt.md"
+    prompt_file.write_text("Categorize the conversation.", encoding="utf-8")
+    transcripts = [{"conversation": {"sessionId": "s1", "utterances": [{"role": "user", "content": "my meter reading"}]}}]
+    resultDF = pd.DataFrame({"sessionId": ["s1"]})
+
+    basic_llm.apply_llm_prompt_for_JSON_result(client, transcripts, resultDF, str(prompt_file), basic_llm.CategorizeTranscriptsJson,
+                                               resultColumns={"topic": "topic"}, max_concurrent_requests=1)
+    assert resultDF["topic"].tolist() == ["No result"]
+    assert len(clock.sleeps) == 2
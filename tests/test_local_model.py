@@ -0,0 +1,88 @@
+import threading
+import types
+
+import pandas as pd
+import pytest
+
+import analyzer.conversation.basic_llm as basic_llm
+import llm_cache
+import llm_client
+import local_model
+from conftest import transcript
+
+
+class StubClassifier:
+    """ Local classifier with fixed (label, confidence) predictions by user text (no transformers needed). """
+
+    model_name = "stub-model"
+
+    def __init__(self, predictions):
+        self.predictions = predictions
+        self.texts = []
+
+    def classify(self, texts):
+        self.texts.extend(texts)
+        return [self.predictions.get(text, ("Other", 0.1)) for text in texts]
+
+
+def test_predictions_below_the_threshold_are_escalated():
+    classifier = StubClassifier({"meter reading": ("meter", 0.95), "invoice": ("billing", 0.9), "hm": ("billing", 0.89)})
+    first_pass = local_model.FirstPass(classifier, "topic", confidence_threshold=0.9, label_map={"meter": "Meter reading"})
+    labels = first_pass.predict([transcript("s1", "meter reading"), transcript("s2", "invoice"), transcript("s3", "hm")])
+    assert labels == ["Meter reading", "billing", None]
+    assert first_pass.statistics == {"classified": 2, "escalated": 1}
+
+
+def test_only_uncertain_transcripts_reach_the_llm(monkeypatch, tmp_path, llm_responses):
+    monkeypatch.setattr(llm_cache, "llm_cache", None)
+    categories_file = tmp_path / "categories.json"
+    categories_file.write_text('["Meter reading", "Billing"]', encoding="utf-8")
+    client = types.SimpleNamespace(responses=llm_responses)
+    classifier = StubClassifier({"My meter reading": ("Meter reading", 0.97)})
+    analysis = basic_llm.get_categorization_analysis(categories_file=str(categories_file))
+    analysis.first_pass = local_model.FirstPass(classifier, "topic")
+
+    transcripts = [transcript("local", "My meter reading"), transcript("escalated", "Something unclear"), transcript("bot-only")]
+    resultDF = pd.DataFrame({"sessionId": ["local", "escalated", "bot-only"], "maxUserWordCount": [3, 2, 0]})
+    basic_llm.run_llm_analysis(client, transcripts, resultDF, analysis, max_concurrent_requests=1)
+
+    # the filtered transcript is not classified at all, the confident one is not sent to the LLM
+    assert classifier.texts == ["My meter reading", "Something unclear"]
+    assert llm_responses.calls == 1
+    assert "Something unclear" in str(llm_responses.inputs[0]) and "My meter reading" not in str(llm_responses.inputs[0])
+
+    assert resultDF["topic"].tolist() == ["Meter reading", "value topic", "No analysis"]
+    # locally classified rows only get the label field
+    assert resultDF["intent"].tolist() == ["No analysis", "value intent", "No analysis"]
+    assert resultDF["breakdown"].tolist() == ["No analysis", "value breakdown", "No analysis"]
+    assert resultDF["topicSource"].tolist() == [local_model.SOURCE_LOCAL_MODEL, local_model.SOURCE_LLM, "No analysis"]
+
+
+@pytest.fixture
+def stub_backend(monkeypatch):
+    created = []
+
+    def create_client():
+        created.append(types.SimpleNamespace())
+        return created[-1]
+
+    monkeypatch.setattr(llm_client, "llm_backends", dict(llm_client.llm_backends, stub=create_client))
+    monkeypatch.setattr(llm_client, "llm_clients", {})
+    monkeypatch.setattr(llm_client, "llm_client", None)
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    return created
+
+
+def test_llm_client_is_created_once_per_process(stub_backend):
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(llm_client.get_llm_client())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(stub_backend) == 1
+    assert all(client is stub_backend[0] for client in clients)
+
+    # named backends have their own cached client
+    assert llm_client.get_llm_client("stub") is llm_client.get_llm_client("stub")
+    assert len(stub_backend) == 2
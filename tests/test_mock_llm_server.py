@@ -0,0 +1,79 @@
+import json
+import time
+import types
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+
+import analyzer.conversation.basic_llm as basic_llm
+import llm_cache
+import llm_scheduler
+from conftest import transcript
+from llm_scheduler import LLMScheduler
+from mock_llm_server import start_mock_server
+
+
+class HTTPStatusError(Exception):
+    """ Error of a failed request with status code and response headers (like the errors of the openai package). """
+
+    def __init__(self, error):
+        super().__init__(f"{error.code} {error.reason}")
+        self.status_code = error.code
+        self.response = types.SimpleNamespace(headers=error.headers)
+
+
+class UrllibResponses:
+    """ Minimal client of the Responses API with structured outputs (without the openai package). """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def parse(self, model, input, text_format, **kwargs):
+        body = {"model": model, "input": input,
+                "text": {"format": {"type": "json_schema", "name": text_format.__name__, "schema": text_format.model_json_schema(), "strict": True}}}
+        request = urllib.request.Request(f"{self.base_url}/responses", data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                payload = json.load(response)
+        except urllib.error.HTTPError as error:
+            raise HTTPStatusError(error) from error
+        content = payload["output"][0]["content"][0]
+        output_parsed = text_format.model_validate_json(content["text"]) if content["type"] == "output_text" else None
+        usage = types.SimpleNamespace(total_tokens=payload["usage"]["total_tokens"], input_tokens=payload["usage"]["input_tokens"],
+                                      output_tokens=payload["usage"]["output_tokens"], input_tokens_details=None)
+        return types.SimpleNamespace(output_parsed=output_parsed, usage=usage, output=payload["output"])
+
+
+@pytest.fixture
+def mock_server():
+    # every second request is rate limited with a Retry-After of 200 ms
+    server, state = start_mock_server(latency_ms=0, error_rate=0.5, rate_limit_share=1.0, seed=7)
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", state
+    server.shutdown()
+    server.server_close()
+
+
+def test_rate_limits_of_the_mock_server_are_retried(mock_server, monkeypatch):
+    base_url, state = mock_server
+    scheduler = LLMScheduler(max_retries=8, base_delay=0.01)
+    monkeypatch.setattr(basic_llm, "get_llm_scheduler", lambda: scheduler)
+    monkeypatch.setattr(llm_cache, "llm_cache", None)
+    # delays of the retries of the scheduler (the time module itself is shared with the server threads)
+    delays = []
+    monkeypatch.setattr(llm_scheduler, "time", types.SimpleNamespace(monotonic=time.monotonic, perf_counter=time.perf_counter,
+                                                                     sleep=lambda seconds: delays.append(seconds) or time.sleep(seconds)))
+
+    analysis = basic_llm.get_sentiment_analysis()
+    transcripts = [transcript(f"s{i}", f"My meter reading {i} is wrong") for i in range(6)]
+    resultDF = pd.DataFrame({"sessionId": [t["conversation"]["sessionId"] for t in transcripts], "maxUserWordCount": [5] * 6})
+    client = types.SimpleNamespace(responses=UrllibResponses(base_url))
+    basic_llm.run_llm_analysis(client, transcripts, resultDF, analysis, max_concurrent_requests=2)
+
+    assert state.statistics["rate_limited"] > 0
+    assert state.statistics["requests"] == 6 + state.statistics["rate_limited"]
+    assert resultDF["Sentiment"].tolist() == ["mock sentiment_label"] * 6
+    # the Retry-After of the 429 responses is honoured
+    assert len(delays) == state.statistics["rate_limited"]
+    assert all(delay >= 0.2 for delay in delays)
@@ -0,0 +1,72 @@
+import itertools
+import threading
+import time
+
+from pipeline import PipelineStage, run_pipeline
+
+
+def run_with_timeout(source, stages, timeout=10):
+    """ Run the pipeline in a thread, fails if it does not finish in time. Returns the error raised by the pipeline (or None). """
+    outcome = {}
+
+    def run():
+        try:
+            run_pipeline(source, stages, queue_size=2)
+        except Exception as error:
+            outcome["error"] = error
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline hangs"
+    return outcome.get("error")
+
+
+def test_all_items_reach_the_sink():
+    sink = []
+    stages = [PipelineStage("double", lambda item: item * 2),
+              PipelineStage("slow", lambda item: time.sleep(0.001) or item + 1, workers=3),
+              PipelineStage("sink", sink.append)]
+    assert run_with_timeout(range(100), stages) is None
+    assert sorted(sink) == [item * 2 + 1 for item in range(100)]
+
+
+def test_stage_error_while_sibling_is_busy():
+    raising = threading.Event()
+
+    def analyze(item):
+        if item == 0:
+            raising.set()
+            raise ValueError("first error")
+        # the sibling worker is in the middle of an item when the error is raised
+        raising.wait(5)
+        time.sleep(0.2)
+        raise RuntimeError("later error")
+
+    sink = []
+    error = run_with_timeout(itertools.count(), [PipelineStage("llm", analyze, workers=2), PipelineStage("sink", sink.append)])
+    assert isinstance(error, ValueError) and str(error) == "first error"
+    assert sink == []
+
+
+def test_stage_error_stops_an_endless_source():
+    def fail_on_third(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    sink = []
+    error = run_with_timeout(itertools.count(), [PipelineStage("read", fail_on_third), PipelineStage("sink", sink.append)])
+    assert isinstance(error, ValueError)
+    # items after the failed one are not passed on (the pipeline is stopped)
+    assert set(sink) <= {0, 1, 2}
+
+
+def test_source_error_is_raised():
+    def source():
+        yield from range(5)
+        raise OSError("transcript directory gone")
+
+    sink = []
+    error = run_with_timeout(source(), [PipelineStage("read", lambda item: item, workers=2), PipelineStage("sink", sink.append)])
+    assert isinstance(error, OSError)
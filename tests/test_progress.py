@@ -0,0 +1,120 @@
+import json
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import analysisLoop
+import progress
+import transcript_sources
+
+
+@pytest.fixture
+def database_engine(tmp_path):
+    database_engine = create_engine(f"sqlite:///{tmp_path / 'results.db'}")
+    progress.init_progress_tracking(database_engine)
+    yield database_engine
+    database_engine.dispose()
+
+
+def write_transcript(file_path, user_text):
+    file_path.write_text(json.dumps({"conversation": {"sessionId": file_path.stem, "utterances": [{"role": "user", "content": user_text}]}}), encoding="utf-8")
+    return str(file_path)
+
+
+def mark_files_processed(database_engine, transcript_files):
+    with database_engine.begin() as connection:
+        progress.mark_processed(connection, [progress.file_fingerprint(transcript_file) for transcript_file in transcript_files])
+
+
+def test_new_files_are_pending(database_engine, tmp_path):
+    transcript_files = [write_transcript(tmp_path / f"s{i}.json", "My meter reading") for i in range(3)]
+    assert progress.select_pending_files(database_engine, transcript_files) == sorted(transcript_files)
+    mark_files_processed(database_engine, transcript_files)
+    assert progress.select_pending_files(database_engine, transcript_files) == []
+
+
+def test_touched_file_with_unchanged_content_is_not_pending(database_engine, tmp_path):
+    transcript_file = write_transcript(tmp_path / "s1.json", "My meter reading")
+    mark_files_processed(database_engine, [transcript_file])
+    mtime = os.stat(transcript_file).st_mtime + 10
+    os.utime(transcript_file, (mtime, mtime))
+
+    assert progress.select_pending_files(database_engine, [transcript_file]) == []
+    # the new mtime is recorded, the content is not hashed again by the next run
+    with database_engine.connect() as connection:
+        assert connection.execute(text("SELECT mtime FROM processed_files")).scalar() == mtime
+
+
+def test_changed_size_is_pending(database_engine, tmp_path):
+    transcript_file = write_transcript(tmp_path / "s1.json", "My meter reading")
+    mark_files_processed(database_engine, [transcript_file])
+    write_transcript(tmp_path / "s1.json", "My meter reading is wrong")
+    assert progress.select_pending_files(database_engine, [transcript_file]) == [transcript_file]
+
+
+def test_changed_content_with_same_size_is_pending(database_engine, tmp_path):
+    transcript_file = write_transcript(tmp_path / "s1.json", "My meter reading")
+    mark_files_processed(database_engine, [transcript_file])
+    mtime = os.stat(transcript_file).st_mtime
+    write_transcript(tmp_path / "s1.json", "My meter READING")
+    os.utime(transcript_file, (mtime + 10, mtime + 10))
+    assert progress.select_pending_files(database_engine, [transcript_file]) == [transcript_file]
+
+
+def test_inaccessible_files_are_skipped(database_engine, tmp_path):
+    transcript_files = [write_transcript(tmp_path / f"s{i}.json", "My meter reading") for i in range(2)]
+    os.remove(transcript_files[0])
+    assert progress.select_pending_files(database_engine, transcript_files + [str(tmp_path / "missing.json")]) == [transcript_files[1]]
+
+
+def test_dump_lines_are_tracked_per_line(database_engine, tmp_path):
+    dump_file = tmp_path / "dump.jsonl"
+    lines = [json.dumps({"conversation": {"sessionId": f"d{i}", "utterances": []}}) for i in range(3)]
+    dump_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    records = list(transcript_sources.iter_jsonl_records(str(dump_file)))
+    assert [record["path"] for record in records] == [f"{dump_file}#L{i}" for i in (1, 2, 3)]
+    with database_engine.begin() as connection:
+        progress.mark_processed(connection, [progress.progress_record(record) for record in records[:2]])
+    assert progress.filter_processed_records(database_engine, records) == records[2:]
+
+    # a changed line is processed again
+    lines[0] = json.dumps({"conversation": {"sessionId": "d0", "utterances": [{"role": "user", "content": "changed"}]}})
+    dump_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    records = list(transcript_sources.iter_jsonl_records(str(dump_file)))
+    assert [record["path"] for record in progress.filter_processed_records(database_engine, records)] == [f"{dump_file}#L1", f"{dump_file}#L3"]
+
+
+def test_crash_between_result_and_progress_write(corpus, monkeypatch):
+    """ A batch whose progress cannot be written is rolled back with its results and analyzed again by the next run. """
+    monkeypatch.setattr(analysisLoop, "batch_size", 5)
+    mark_processed = progress.mark_processed
+    calls = []
+
+    def crash_on_second_batch(connection, progress_records):
+        calls.append(len(progress_records))
+        if len(calls) == 2:
+            raise RuntimeError("crash before the progress write")
+        mark_processed(connection, progress_records)
+
+    monkeypatch.setattr(progress, "mark_processed", crash_on_second_batch)
+    transcript_files = analysisLoop.compileTranscriptFileListInPath(corpus.transcript_path)
+    with pytest.raises(RuntimeError):
+        analysisLoop.analyze_transcript_files(transcript_files, corpus.result_path).dispose()
+
+    database_engine = analysisLoop.initGlobalResultPersistence(corpus.result_path)
+    with database_engine.connect() as connection:
+        committed = connection.execute(text("SELECT COUNT(*) FROM transcripts")).scalar()
+        assert committed == connection.execute(text("SELECT COUNT(*) FROM processed_files")).scalar()
+    database_engine.dispose()
+    assert 0 < committed < len(transcript_files)
+
+    monkeypatch.setattr(progress, "mark_processed", mark_processed)
+    corpus.reads.clear()
+    database_engine = analysisLoop.analyze_transcript_files(transcript_files, corpus.result_path)
+    # only the files without committed results are read again
+    assert len(corpus.reads) == len(transcript_files) - committed
+    with database_engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*), COUNT(DISTINCT sessionId) FROM transcripts")).fetchone() == (12, 12)
+        assert connection.execute(text("SELECT COUNT(*) FROM processed_files WHERE status = 'done'")).scalar() == 12
+    database_engine.dispose()
@@ -0,0 +1,110 @@
+import shutil
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import analyzer.conversation.basic_llm as basic_llm
+import provenance
+import result_store
+from conftest import transcript
+
+
+@pytest.fixture
+def analyses(tmp_path, monkeypatch):
+    monkeypatch.setattr(basic_llm, "prompt_cache", {})
+    # own copy of the sentiment prompt to edit it
+    sentiment = basic_llm.get_sentiment_analysis()
+    prompt_file = tmp_path / "prmt_sentiment_analysis.md"
+    shutil.copy(sentiment.prompt_file, prompt_file)
+    sentiment.prompt_file = str(prompt_file)
+    return [basic_llm.get_categorization_analysis(), sentiment]
+
+
+@pytest.fixture
+def database_engine(tmp_path, analyses):
+    database_engine = create_engine(f"sqlite:///{tmp_path / 'results.db'}")
+    result_store.init_result_table(database_engine, analyses)
+    yield database_engine
+    database_engine.dispose()
+
+
+def analyze(database_engine, analyses, transcripts):
+    """ Compute the stale analyses of the transcripts (with placeholder results) and store them with their provenance. """
+    tracker = provenance.ProvenanceTracker(database_engine, analyses, "test-model")
+    stale, transcript_hashes = tracker.stale_analyses(transcripts)
+    resultDF = pd.DataFrame({"sessionId": [t["conversation"]["sessionId"] for t in transcripts]})
+    for analysis in analyses:
+        for column in analysis.output_columns():
+            resultDF[column] = "result"
+    sources = [f"{sessionId}.json" for sessionId in resultDF["sessionId"]]
+    with database_engine.begin() as connection:
+        result_store.upsert_results(connection, resultDF)
+        provenance.record_provenance(connection, tracker.provenance_records(resultDF, stale, transcript_hashes, sources))
+    return stale
+
+
+def edit_prompt(analysis):
+    with open(analysis.prompt_file, "a", encoding="utf-8") as prompt:
+        prompt.write("\nAnswer briefly.\n")
+    # the next run reads the prompt file again
+    basic_llm.prompt_cache.clear()
+
+
+def stale_names(database_engine, analyses, transcripts):
+    tracker = provenance.ProvenanceTracker(database_engine, analyses, "test-model")
+    return tracker, tracker.stale_analyses(transcripts)[0]
+
+
+def test_current_results_are_not_stale(database_engine, analyses):
+    transcripts = [transcript("s1", "My meter reading"), transcript("s2", "A billing question")]
+    assert analyze(database_engine, analyses, transcripts) == [("categorization", "sentiment")] * 2
+    tracker, stale = stale_names(database_engine, analyses, transcripts)
+    assert not tracker.reread_processed
+    assert stale == [(), ()]
+
+
+def test_prompt_edit_only_stales_its_analysis(database_engine, analyses):
+    transcripts = [transcript("s1", "My meter reading"), transcript("s2", "A billing question")]
+    analyze(database_engine, analyses, transcripts)
+    edit_prompt(analyses[1])
+    tracker, stale = stale_names(database_engine, analyses, transcripts)
+    assert tracker.stale_analysis_names == ["sentiment"]
+    assert tracker.reread_processed
+    assert stale == [("sentiment",), ("sentiment",)]
+
+
+def test_settings_change_stales_all_analyses(database_engine, analyses, monkeypatch):
+    transcripts = [transcript("s1", "My meter reading")]
+    analyze(database_engine, analyses, transcripts)
+    monkeypatch.setattr(basic_llm, "max_transcript_tokens", 500)
+    tracker, stale = stale_names(database_engine, analyses, transcripts)
+    assert tracker.stale_analysis_names == ["categorization", "sentiment"]
+    assert stale == [("categorization", "sentiment")]
+
+
+def test_transcript_change_stales_only_that_transcript(database_engine, analyses):
+    analyze(database_engine, analyses, [transcript("s1", "My meter reading"), transcript("s2", "A billing question")])
+    tracker, stale = stale_names(database_engine, analyses, [transcript("s1", "My meter reading"), transcript("s2", "A changed question")])
+    # changed transcripts are found by the progress table, not by reading all processed transcripts
+    assert not tracker.reread_processed
+    assert stale == [(), ("categorization", "sentiment")]
+
+
+def test_orphaned_results_stop_rereading(database_engine, analyses):
+    analyze(database_engine, analyses, [transcript("s1", "My meter reading"), transcript("deleted", "A billing question")])
+    edit_prompt(analyses[1])
+
+    # the transcript file of "deleted" is gone: only s1 is read again
+    tracker = provenance.ProvenanceTracker(database_engine, analyses, "test-model")
+    assert tracker.reread_processed
+    assert analyze(database_engine, analyses, [transcript("s1", "My meter reading")]) == [("sentiment",)]
+    assert tracker.mark_orphaned_results() == 1
+
+    tracker, stale = stale_names(database_engine, analyses, [transcript("s1", "My meter reading")])
+    assert not tracker.reread_processed
+    assert stale == [()]
+
+    # the orphaned result is recomputed when its transcript is analyzed again
+    tracker, stale = stale_names(database_engine, analyses, [transcript("deleted", "A billing question")])
+    assert stale == [("sentiment",)]
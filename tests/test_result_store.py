@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import analyzer.conversation.basic_llm as basic_llm
+import result_store
+
+
+@pytest.fixture
+def database_engine(tmp_path):
+    database_engine = create_engine(f"sqlite:///{tmp_path / 'results.db'}")
+    yield database_engine
+    database_engine.dispose()
+
+
+def stored_rows(database_engine, columns):
+    return pd.read_sql(f"SELECT {', '.join(result_store.quote_identifier(column) for column in columns)} FROM transcripts ORDER BY sessionId", database_engine)
+
+
+def test_reanalyzing_one_column_keeps_the_others(database_engine):
+    analyses = [basic_llm.get_categorization_analysis(), basic_llm.get_sentiment_analysis()]
+    result_store.init_result_table(database_engine, analyses)
+    resultDF = pd.DataFrame({"sessionId": ["s1", "s2"], "turnCount": [2, 4], "topic": ["Billing", "Meter"], "Sentiment": ["neutral", "negative"]})
+    with database_engine.begin() as connection:
+        result_store.upsert_results(connection, resultDF)
+
+    # only the sentiment is analyzed again
+    reanalyzedDF = pd.DataFrame({"sessionId": ["s1", "s2"], "turnCount": [0, 0], "topic": ["No analysis"] * 2, "Sentiment": ["positive", "neutral"]})
+    with database_engine.begin() as connection:
+        assert result_store.upsert_results(connection, reanalyzedDF, columns=["Sentiment"]) == 2
+
+    rows = stored_rows(database_engine, ["sessionId", "turnCount", "topic", "Sentiment"])
+    assert rows.values.tolist() == [["s1", 2, "Billing", "positive"], ["s2", 4, "Meter", "neutral"]]
+
+
+def test_legacy_table_with_duplicate_sessionIds_is_migrated(database_engine):
+    # table written by pandas to_sql of earlier versions: no primary key, a transcript analyzed twice
+    legacyDF = pd.DataFrame({"sessionId": ["s1", "s2", "s1"], "turnCount": [2, 4, 3], "topic": ["old", "Meter", "new"], "legacyColumn": ["a", "b", "c"]})
+    legacyDF.to_sql("transcripts", database_engine, index=False)
+
+    result_store.init_result_table(database_engine, [basic_llm.get_categorization_analysis()])
+
+    # the last row of each sessionId is kept, columns of the legacy table are kept as well
+    rows = stored_rows(database_engine, ["sessionId", "turnCount", "topic", "legacyColumn"])
+    assert rows.values.tolist() == [["s1", 3, "new", "c"], ["s2", 4, "Meter", "b"]]
+    with database_engine.begin() as connection:
+        result_store.upsert_results(connection, pd.DataFrame({"sessionId": ["s1"], "topic": ["newer"]}), columns=["topic"])
+    assert stored_rows(database_engine, ["sessionId", "topic"]).values.tolist() == [["s1", "newer"], ["s2", "Meter"]]
+
+
+def test_duplicateOf_is_declared_only_with_deduplication():
+    assert "duplicateOf" not in result_store.declared_columns([])
+    assert result_store.declared_columns([], deduplicate=True)["duplicateOf"] == "TEXT"
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+import run_metrics
+from run_metrics import RunMetrics
+
+
+def run_concurrently(metrics, names):
+    """ Run a stage timer per name in its own thread, all stages active at the same time. """
+    barrier = threading.Barrier(len(names))
+    errors = []
+
+    def stage(name):
+        try:
+            with metrics.stage_timer(name):
+                barrier.wait(timeout=5)
+                sum(range(1000))
+                barrier.wait(timeout=5)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stage, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_concurrent_stage_timers_with_profiling(tmp_path):
+    metrics = RunMetrics(profile_path=str(tmp_path))
+    assert run_concurrently(metrics, ["read", "llm"]) == []
+
+    summary = metrics.summary()
+    assert summary["stages"]["read"]["calls"] == 1
+    assert summary["stages"]["llm"]["calls"] == 1
+    # only one stage is profiled at a time
+    assert len(metrics._profiles) == 1
+    assert metrics.skipped_profiles == 1
+    metrics.write_profiles()
+    assert len(list(tmp_path.glob("*.prof"))) == 1
+
+
+def test_stage_runs_when_profiler_cannot_be_enabled(tmp_path, monkeypatch):
+    class ActiveProfiler:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(run_metrics.cProfile, "Profile", ActiveProfiler)
+    metrics = RunMetrics(profile_path=str(tmp_path))
+    with metrics.stage_timer("read"):
+        pass
+    # the profiler lock is released again
+    with metrics.stage_timer("read"):
+        pass
+    assert metrics.summary()["stages"]["read"]["calls"] == 2
+    assert metrics.skipped_profiles == 2
+
+
+def test_conversation_length_percentiles(tmp_path):
+    metrics = RunMetrics()
+    assert metrics.summary()["conversation_length_percentiles"] == {}
+    # two batches of conversations with 1..100 utterances and ten words per utterance
+    metrics.add_conversation_lengths(range(1, 51), range(10, 510, 10))
+    metrics.add_conversation_lengths(range(51, 101), range(510, 1010, 10))
+
+    percentiles = metrics.summary()["conversation_length_percentiles"]
+    assert percentiles["utterances"]["p50"] == 50.5
+    assert percentiles["utterances"]["p99"] == pytest.approx(99.01)
+    assert percentiles["words"]["p90"] == pytest.approx(901.0)
+
+    textfile = tmp_path / "convospector.prom"
+    metrics.write_prometheus_textfile(str(textfile))
+    assert 'convospector_conversation_length{kind="utterances",quantile="0.5"} 50.5' in textfile.read_text().splitlines()
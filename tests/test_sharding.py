@@ -0,0 +1,35 @@
+import pytest
+
+import analysisLoop
+import sharding
+
+
+def run_shards(corpus, num_shards):
+    corpus.responses.calls = 0
+    corpus.reads.clear()
+    for shard_index in range(num_shards):
+        analysisLoop.analyze_shard(shard_index, num_shards)
+    database_engine = analysisLoop.initGlobalResultPersistence(corpus.result_path)
+    sharding.merge_shards(database_engine, corpus.result_path, num_shards)
+    database_engine.dispose()
+
+
+@pytest.mark.parametrize("incremental_reanalysis", [True, False])
+def test_resharding_keeps_progress(corpus, monkeypatch, incremental_reanalysis):
+    monkeypatch.setattr(analysisLoop, "incremental_reanalysis", incremental_reanalysis)
+    run_shards(corpus, 2)
+    assert corpus.responses.calls == 24
+    assert len(corpus.reads) == 12
+
+    # another number of shards is seeded with the merged progress
+    run_shards(corpus, 4)
+    assert corpus.responses.calls == 0
+    assert corpus.reads == []
+
+    # an unsharded run continues with the merged progress of the main database
+    corpus.responses.calls = 0
+    transcript_files = analysisLoop.compileTranscriptFileListInPath(analysisLoop.transcript_path)
+    database_engine = analysisLoop.analyze_transcript_files(transcript_files, corpus.result_path)
+    database_engine.dispose()
+    assert corpus.responses.calls == 0
+    assert corpus.reads == []